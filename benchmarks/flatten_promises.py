@@ -0,0 +1,120 @@
+"""
+Compares :py:func:`coal.flatten_promises` with the recursive walker it
+replaced, on deep and on wide data.
+
+Run with ``python benchmarks/flatten_promises.py``.
+"""
+
+from __future__ import print_function
+
+import numbers
+import sys
+import timeit
+
+from coal import Promise, Task, TaskQueue, flatten_promises
+from coal._compat import collections_abc, string_types
+
+
+class ValueTask(Task):
+
+    def __init__(self, value):
+        self.value = value
+        super(ValueTask, self).__init__()
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(task.value)
+
+
+def recursive_flatten_promises(data):
+    # The recursive walker as it was before flatten_promises switched to an
+    # explicit stack, kept here as the baseline.
+    promises = []
+
+    def flatten_obj(obj):
+        if isinstance(obj, numbers.Number) or isinstance(obj, string_types):
+            return
+        elif callable(obj):
+            return
+        elif isinstance(obj, collections_abc.Container):
+            if isinstance(obj, collections_abc.Sequence):
+                member_generator = (
+                    (i, value) for i, value in enumerate(obj)
+                )
+            else:
+                member_generator = (
+                    (k, obj[k]) for k in obj.keys()
+                )
+            for k, v in member_generator:
+                flatten_key(obj, k, v)
+
+    def flatten_key(coll, k, v):
+        if isinstance(v, Promise):
+            promises.append(v)
+
+            def afterwards(nextV):
+                flatten_key(coll, k, nextV)
+
+            v.then(afterwards)
+        else:
+            coll[k] = v
+            flatten_obj(v)
+
+    flatten_obj(data)
+
+    queue = TaskQueue()
+    while len(promises) > 0:
+        tasks = [promise.task for promise in promises]
+        queue.add_tasks(tasks)
+        promises = []
+        queue.work()
+
+
+def deep_data(depth):
+    data = {"leaf": ValueTask(depth).promise}
+    for i in range(depth):
+        data = {"child": data, "n": i}
+    return data
+
+
+def wide_data(width):
+    return [
+        {"id": i, "name": "item", "value": ValueTask(i).promise}
+        for i in range(width)
+    ]
+
+
+def bench(name, build, impl, number=5):
+    total = 0.0
+    for i in range(number):
+        data = build()
+        total += timeit.timeit(lambda: impl(data), number=1)
+    print("%-40s %8.2f ms" % (name, total / number * 1000))
+
+
+def main():
+    # The recursive walker needs a couple of frames per level.
+    sys.setrecursionlimit(10000)
+
+    for depth in (100, 1000, 3000):
+        build = lambda: deep_data(depth)
+        bench("deep %i, recursive" % depth, build, recursive_flatten_promises)
+        bench("deep %i, explicit stack" % depth, build, flatten_promises)
+
+    depth = 100000
+    bench(
+        "deep %i, explicit stack" % depth,
+        lambda: deep_data(depth),
+        flatten_promises,
+        number=1,
+    )
+
+    for width in (1000, 50000):
+        build = lambda: wide_data(width)
+        bench("wide %i, recursive" % width, build, recursive_flatten_promises)
+        bench("wide %i, explicit stack" % width, build, flatten_promises)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Measures how long ``import coal``, and the import of each submodule, takes
+in a fresh interpreter, over and above starting the interpreter itself.
+
+Run with ``python benchmarks/import_time.py``.
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = [
+    "import coal",
+    "import coal.caching",
+    "import coal.asynchronous",
+    "import coal.backends",
+    "import coal.persistence",
+    "import coal.trace",
+]
+
+
+def run(statement):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT
+    subprocess.check_call([sys.executable, "-c", statement], env=env)
+
+
+def bench(statement, number=20):
+    # the best of several runs, since process startup is noisy.
+    return min(
+        timeit.timeit(lambda: run(statement), number=1)
+        for i in range(number)
+    )
+
+
+def main():
+    baseline = bench("pass")
+    print("%-30s %8.2f ms" % ("interpreter startup", baseline * 1000))
+    for statement in STATEMENTS:
+        print("%-30s %8.2f ms" % (
+            statement,
+            (bench(statement) - baseline) * 1000,
+        ))
+
+
+if __name__ == "__main__":
+    main()
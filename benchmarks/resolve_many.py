@@ -0,0 +1,64 @@
+"""
+Compares resolving a large batch one task at a time with
+:py:meth:`coal.Task.resolve` against resolving it in bulk with
+:py:meth:`coal.Task.resolve_many`.
+
+Run with ``python benchmarks/resolve_many.py``.
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from coal import Task, TaskQueue
+
+
+class RowTask(Task):
+
+    def __init__(self, row_id):
+        self.row_id = row_id
+        super(RowTask, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.row_id
+
+
+def build_tasks(count, callbacks):
+    queue = TaskQueue()
+    tasks = [RowTask(i) for i in range(count)]
+    queue.add_tasks(tasks)
+    for task in tasks:
+        for i in range(callbacks):
+            task.then(lambda value: value)
+    # keep the queue alive, since tasks only refer to it weakly.
+    return queue, tasks
+
+
+def resolve_one_at_a_time(tasks, values):
+    for task, value in zip(tasks, values):
+        task.resolve(value)
+
+
+def resolve_in_bulk(tasks, values):
+    RowTask.resolve_many(tasks, values)
+
+
+def bench(name, impl, count, callbacks, number=5):
+    total = 0.0
+    values = [i * 2 for i in range(count)]
+    for i in range(number):
+        queue, tasks = build_tasks(count, callbacks)
+        total += timeit.timeit(lambda: impl(tasks, values), number=1)
+    print("%-50s %8.2f ms" % (name, total / number * 1000))
+
+
+def main():
+    for count, callbacks in ((10000, 0), (10000, 1), (100000, 1)):
+        shape = "%i tasks, %i callbacks each" % (count, callbacks)
+        bench(shape + ", resolve", resolve_one_at_a_time, count, callbacks)
+        bench(shape + ", resolve_many", resolve_in_bulk, count, callbacks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares scheduling strategies on a simulated workload in virtual time:
+resolving asynchronous lookups in the order they finish or the order they
+were queued, and fixed against adaptive batch sizes.
+
+Run with ``python benchmarks/simulation.py``.
+"""
+
+from __future__ import print_function
+
+import time
+
+from coal import TaskPriority
+from coal.adaptive import AdaptiveBatchController
+from coal.simulation import (
+    Simulation,
+    exponential,
+    linear_cost,
+    lognormal,
+)
+
+
+def simulate(notifies_completion, batch_controller=None, requests=500):
+    sim = Simulation(seed=1)
+    Cache = sim.task_type(
+        "Cache",
+        priority=TaskPriority.CACHE,
+        latency=exponential(0.0005),
+        batch_cost=linear_cost(0.0002, 0.00001),
+    )
+    Database = sim.task_type(
+        "Database",
+        latency=exponential(0.002),
+        batch_cost=linear_cost(0.001, 0.0002),
+        max_batch_size=50,
+    )
+    Service = sim.async_task_type(
+        "Service",
+        latency=lognormal(0.02, 0.8),
+        notifies_completion=notifies_completion,
+    )
+
+    def lookup(key):
+        service = Service(key)
+        # a different row for each service result, so the followups don't
+        # coalesce with the rows looked up up front.
+        return service.then(
+            lambda value: service.followup(Database(("service", value)))
+        )
+
+    def request(random):
+        keys = random.sample(range(10000), 100)
+        return {
+            "cached": [Cache(k).promise for k in keys],
+            "rows": [Database(k).promise for k in keys],
+            "services": [lookup(k) for k in keys[:5]],
+        }
+
+    start = time.time()
+    sim.run(request, count=requests, batch_controller=batch_controller)
+    return sim, time.time() - start
+
+
+def main():
+    for name, notifies_completion, controller in (
+        ("completion order", True, None),
+        ("queued order", False, None),
+        ("completion order, adaptive", True,
+         AdaptiveBatchController(target_latency=0.02)),
+    ):
+        sim, elapsed = simulate(notifies_completion, controller)
+        print("%s (simulated in %.2f s)" % (name, elapsed))
+        print(sim.report())
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Compares queueing tasks one at a time with :py:meth:`coal.TaskQueue.add_task`
+against queueing them in bulk with :py:meth:`coal.TaskQueue.add_tasks`.
+
+Run with ``python benchmarks/task_queue.py``.
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from coal import Task, TaskQueue
+
+
+class KeyedTask(Task):
+
+    def __init__(self, batch_key, coalesce_key):
+        self._batch_key = batch_key
+        self._coalesce_key = coalesce_key
+        super(KeyedTask, self).__init__()
+
+    @property
+    def batch_key(self):
+        return self._batch_key
+
+    @property
+    def coalesce_key(self):
+        return self._coalesce_key
+
+
+def build_tasks(count, batches, distinct):
+    return [
+        KeyedTask(i % batches, i % distinct)
+        for i in range(count)
+    ]
+
+
+def add_one_at_a_time(tasks):
+    queue = TaskQueue()
+    for task in tasks:
+        queue.add_task(task)
+
+
+def add_in_bulk(tasks):
+    queue = TaskQueue()
+    queue.add_tasks(tasks)
+
+
+def bench(name, impl, count, batches, distinct, number=5):
+    total = 0.0
+    for i in range(number):
+        tasks = build_tasks(count, batches, distinct)
+        total += timeit.timeit(lambda: impl(tasks), number=1)
+    print("%-50s %8.2f ms" % (name, total / number * 1000))
+
+
+def main():
+    for count, batches, distinct in (
+        (100000, 1, 100000),
+        (100000, 10, 1000),
+        (100000, 1000, 100000),
+    ):
+        shape = "%i tasks, %i batches, %i keys" % (count, batches, distinct)
+        bench(shape + ", add_task", add_one_at_a_time,
+              count, batches, distinct)
+        bench(shape + ", add_tasks", add_in_bulk, count, batches, distinct)
+
+
+if __name__ == "__main__":
+    main()
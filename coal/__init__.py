@@ -1,34 +1,214 @@
 
-from datetime import datetime
-import collections
-import numbers
+from datetime import datetime, timedelta
+import os
+import sys
+import weakref
+
+from coal._compat import (
+    collections_abc,
+    integer_types,
+    iteritems,
+    string_types,
+)
 
 
 __all__ = [
     "Promise",
     "Defer",
     "when",
+    "optional",
     "Task",
     "TaskQueue",
     "flatten_promises",
+    "FlattenHandler",
+    "FlattenHandlerRegistry",
+    "flatten_handlers",
 ]
 
+# Submodules, which aren't imported until they're needed so that importing
+# coal stays quick for short-lived processes.
+_SUBMODULES = frozenset([
+    "adaptive",
+    "asynchronous",
+    "backends",
+    "caching",
+    "fork",
+    "persistence",
+    "prefetch",
+    "sharding",
+    "simulation",
+    "stats",
+    "trace",
+    "tracing",
+])
+
+
+def __getattr__(name):
+    # Lets coal.caching and the like be used without importing them first,
+    # on Python 3.7+ which looks here for attributes a module doesn't have.
+    if name in _SUBMODULES:
+        import importlib
+        return importlib.import_module("coal." + name)
+    raise AttributeError("module 'coal' has no attribute %r" % name)
+
+
+try:
+    if os.environ.get("COAL_NO_SPEEDUPS"):
+        raise ImportError("coal._speedups is disabled by COAL_NO_SPEEDUPS")
+    from coal import _speedups
+except ImportError:
+    # not built, or built for another interpreter.
+    _speedups = None
+
+
+class _PyDeferBase(object):
+    """
+    The parts of :py:class:`Defer` that :py:mod:`coal._speedups` implements
+    in C, used when it isn't available.
+    """
+    __slots__ = ()
+
+    def _add_callback(self, callback):
+        if self.pending is not None:
+            self.pending.append(callback)
+        elif isinstance(self.value, Promise):
+            self.value.then(callback)
+        else:
+            callback(self.value)
+
+    def resolve(self, value):
+        if self.value is not self.NOT_YET_RESOLVED:
+            raise DuplicateResolutionError(
+                'Defer is already resolved'
+            )
+        pending = self.pending
+        if pending is not None:
+            self.value = value
+            # release the callbacks, and whatever they refer to, once
+            # they've been called.
+            self.pending = None
+            if isinstance(value, Promise):
+                for callback in pending:
+                    value.then(callback)
+            else:
+                # plain values are kept as they are rather than wrapped in
+                # a ProxyPromise, which saves an allocation per resolve.
+                for callback in pending:
+                    callback(value)
+
+
+def _py_chain(result, callback):
+    # the callback that Promise.then adds, resolving result with what
+    # callback returns.
+    def chain(value):
+        result.resolve(callback(value))
+    return chain
+
+
+class _PyTaskQueueBase(object):
+    """
+    The parts of :py:class:`TaskQueue` that :py:mod:`coal._speedups`
+    implements in C, used when it isn't available.
+    """
+    __slots__ = ()
+
+    def add_task(self, task):
+        self.add_tasks((task,))
+        return task
+
+    def add_tasks(self, tasks):
+        """
+        Queue all of ``tasks`` with the same effect as calling
+        :py:meth:`add_task` for each, but in a single pass that looks up
+        each task's subqueue once and keeps the lookups in locals, which
+        adds up when queueing large numbers of tasks.
+        """
+        subqueues = self.subqueues
+        for task in tasks:
+            priority = task.priority
+            compound_key = (type(task), task.batch_key)
+            coalesce_key = task.coalesce_key
+            subqueue = subqueues[priority]
+            batch = subqueue.get(compound_key)
+            if batch is None:
+                batch = subqueue[compound_key] = {}
+
+            existing = batch.get(coalesce_key)
+            if existing is None:
+                batch[coalesce_key] = task
+                task.assign_queue(self)
+            elif existing is not task:
+                # we already have a matching task, so merge them.
+                existing.merge(task)
+                merges = self.merges[priority]
+                merges[compound_key] = merges.get(compound_key, 0) + 1
+
+
+if _speedups is None:
+    _DeferBase = _PyDeferBase
+    _chain = _py_chain
+    _TaskQueueBase = _PyTaskQueueBase
+else:
+    class _DeferBase(object):
+        __slots__ = ()
+        _add_callback = _speedups.defer_add_callback
+        resolve = _speedups.defer_resolve
+
+    _chain = _speedups.chain
+
+    class _TaskQueueBase(object):
+        __slots__ = ()
+        add_task = _speedups.queue_add_task
+        add_tasks = _speedups.queue_add_tasks
+
 
 class Promise(object):
-    task = None
+    """
+    The promise of a :py:class:`Defer`, to which callbacks can be added
+    with :py:meth:`then`.
+
+    The promise refers to its defer but not the other way around, and a
+    task's promise refers to the task but the task keeps only a weak
+    reference to the promise. This avoids reference cycles between tasks,
+    defers and promises, so they're freed as soon as they're unused rather
+    than waiting for the cycle collector.
+    """
+    _defer = None
+    _task = None
+
+    def __init__(self, defer=None, task=None):
+        self._defer = defer
+        self._task = task
+
+    @property
+    def task(self):
+        if self._task is not None or self._defer is None:
+            return self._task
+        return self._defer.task
+
+    @task.setter
+    def task(self, task):
+        if self._defer is None:
+            self._task = task
+        else:
+            # stored on the defer so that it outlives this promise object.
+            self._defer.task = task
+
+    def then(self, callback):
+        result = Defer()
+        self._defer._add_callback(_chain(result, callback))
+
+        # propagate out any assigned task so that we correctly indicate
+        # what needs to get done before the new promise will be
+        # resolved fully.
+        return Promise(result, self.task)
 
 
 def force_promise(value):
     if isinstance(value, Promise):
         return value
     else:
-        promise = Promise()
-
-        def then(callback):
-            return force_promise(callback(value))
-
-        promise.then = then
-        return promise
+        return ProxyPromise(value)
 
 
 def when(value, callback):
@@ -36,41 +216,69 @@ def when(value, callback):
 
 
 class ProxyPromise(Promise):
+    """
+    An already-resolved promise of a plain value.
+    """
+
     def __init__(self, value):
         self.value = value
 
-    def then(callback):
-        callback(self.value)
+    def then(self, callback):
+        return force_promise(callback(self.value))
 
 
-class Defer(object):
+class OptionalPromise(Promise):
+    """
+    Marks ``promise`` as optional to :py:func:`flatten_promises`, which
+    replaces it with ``default`` rather than waiting for it once its
+    ``timeout`` or the time budget of the flattening runs out. See
+    :py:func:`optional`.
+    """
 
-    NOT_YET_RESOLVED = {}
+    def __init__(self, promise, default=None, timeout=None):
+        self.promise = force_promise(promise)
+        self.default = default
+        self.timeout = timeout
 
-    def __init__(self):
-        self.pending = []
-        self.value = self.NOT_YET_RESOLVED
-        self.promise = Promise()
+    @property
+    def task(self):
+        return getattr(self.promise, "task", None)
 
-        # Construct "then" on the fly in here so that it can
-        # access "self" via closure.
-        def then(callback):
-            result = Defer()
+    def then(self, callback):
+        return self.promise.then(callback)
 
-            wrapper_callback = lambda value: result.resolve(callback(value))
 
-            if self.pending is not None:
-                self.pending.append(wrapper_callback)
-            else:
-                self.value.then(wrapper_callback)
+def optional(promise, default=None, timeout=None):
+    """
+    Mark ``promise`` as optional to :py:func:`flatten_promises`: if it's
+    still pending after ``timeout`` seconds, or when the ``timeout`` given
+    to :py:func:`flatten_promises` runs out, it's replaced with ``default``
+    rather than waited for. Any promises within its value are abandoned
+    along with it.
+    """
+    return OptionalPromise(promise, default, timeout)
 
-            # propagate out any assigned task so that we correctly indicate
-            # what needs to get done before the new promise will be
-            # resolved fully.
-            result.promise.task = self.promise.task
-            return result.promise
 
-        self.promise.then = then
+class Defer(_DeferBase):
+
+    NOT_YET_RESOLVED = {}
+
+    def __init__(self):
+        self.pending = []
+        self.value = self.NOT_YET_RESOLVED
+        self.task = None
+        self._promise_ref = None
+
+    @property
+    def promise(self):
+        # Only weakly referenced, since the promise refers to the defer.
+        promise = None
+        if self._promise_ref is not None:
+            promise = self._promise_ref()
+        if promise is None:
+            promise = Promise(self)
+            self._promise_ref = weakref.ref(promise)
+        return promise
 
     def merge(self, other_defer):
         if self.pending is None and other_defer.pending is None:
@@ -88,18 +296,6 @@ class Defer(object):
             # resolves other_defer later.
             other_defer.pending = []
 
-    def resolve(self, value):
-        if self.value is not self.NOT_YET_RESOLVED:
-            raise DuplicateResolutionError(
-                'Defer is already resolved'
-            )
-        if self.pending is not None:
-            value = force_promise(value)
-            self.value = value
-            for callback in self.pending:
-                value.then(callback)
-            self.pending = None
-
 
 class TaskPriority(object):
     CACHE = 1
@@ -114,23 +310,126 @@ class TaskPriority(object):
 
 class Task(object):
     priority = TaskPriority.SYNC_LOOKUP
+    # the most tasks of this type to pass to work at once, or None to
+    # pass the whole batch.
+    max_batch_size = None
+    # whether to keep the results of this type in the result store of the
+    # queue, if it has one.
+    persist_results = False
+    # set by TaskQueue.requeue once the task has been handed back, so that
+    # it's only counted in the queue's stats on its first pass.
+    requeued = False
 
     def __init__(self):
         self.defer = Defer()
-        self.promise = self.defer.promise
-        self.promise.task = self
+        self._promise_ref = None
         # this will be assigned once the task is queued
-        self.queue = None
+        self._queue_ref = None
+
+    @property
+    def promise(self):
+        # Only weakly referenced, since the promise refers to the task.
+        promise = None
+        if self._promise_ref is not None:
+            promise = self._promise_ref()
+        if promise is None:
+            promise = Promise(self.defer, self)
+            self._promise_ref = weakref.ref(promise)
+        return promise
+
+    @property
+    def queue(self):
+        # Only weakly referenced, since the queue refers to its tasks.
+        if self._queue_ref is None:
+            return None
+        return self._queue_ref()
+
+    @queue.setter
+    def queue(self, queue):
+        if queue is None:
+            self._queue_ref = None
+        else:
+            self._queue_ref = weakref.ref(queue)
 
     def resolve(self, value):
-        if self.queue is not None:
-            self.defer.resolve(value)
-            self.queue._record_result(self, value)
+        queue = self.queue
+        if queue is not None:
+            defer = self.defer
+            if defer.value is not Defer.NOT_YET_RESOLVED:
+                # raises, before the first result is overwritten.
+                defer.resolve(value)
+            # recorded first, so that it's kept even if a callback raises,
+            # but the task is resolved even if recording it fails.
+            try:
+                queue._record_result(self, value)
+            finally:
+                defer.resolve(value)
         else:
             raise Exception(
                 "Can't resolve a task that isn't in a task queue"
             )
 
+    @classmethod
+    def resolve_many(cls, tasks, values):
+        """
+        Resolve each of ``tasks`` with the item of ``values`` at the same
+        position, which has the same effect as resolving them one at a time
+        but records the results in one pass, for use by :py:meth:`work`
+        implementations with large batches. ``values`` can be any sequence
+        of the same length, including a column of a result set or a NumPy
+        array.
+        """
+        tasks = list(tasks)
+        if hasattr(values, "tolist"):
+            # NumPy arrays and the like: their elements are cheaper to
+            # handle as Python values than as their own scalar types.
+            values = values.tolist()
+        elif not isinstance(values, (list, tuple)):
+            values = list(values)
+        if len(values) != len(tasks):
+            raise ValueError(
+                "Can't resolve %i tasks with %i values" % (
+                    len(tasks),
+                    len(values),
+                )
+            )
+        if not tasks:
+            return
+
+        # Tasks assigned to the same queue share its weak reference.
+        queue_ref = tasks[0]._queue_ref
+        for task in tasks:
+            if task._queue_ref is not queue_ref:
+                # not all in one queue, which the batches given to work
+                # always are.
+                for task, value in zip(tasks, values):
+                    task.resolve(value)
+                return
+        queue = None
+        if queue_ref is not None:
+            queue = queue_ref()
+        if queue is None:
+            raise Exception(
+                "Can't resolve a task that isn't in a task queue"
+            )
+
+        not_yet_resolved = Defer.NOT_YET_RESOLVED
+        for task in tasks:
+            if task.defer.value is not not_yet_resolved:
+                # resolve them one at a time, up to the one that raises,
+                # without overwriting its first result.
+                for task, value in zip(tasks, values):
+                    task.resolve(value)
+                return
+
+        # recorded before any callbacks run, as by resolve, so that one
+        # that raises doesn't lose the rest of the results.
+        try:
+            queue._record_results(tasks, values)
+        finally:
+            for task, value in zip(tasks, values):
+                task.defer.resolve(value)
+
     def then(self, callback):
         return self.promise.then(callback)
 
@@ -141,7 +440,12 @@ class Task(object):
         self.queue = queue
 
     def followup(self, task):
-        return self.queue.add_task(task)
+        queue = self.queue
+        if queue is None:
+            raise Exception(
+                "Can't follow up a task that isn't in a task queue"
+            )
+        return queue.add_task(task)
 
     def merge(self, other_task):
         self.defer.merge(other_task.defer)
@@ -160,20 +464,24 @@ class Task(object):
     def work(cls, tasks):
         raise NotImplemented('work not implemented for %r' % cls)
 
-    def __del__(self):
-        # Explicitly unassign these during __del__ to break some
-        # reference cycles we created, in the hope that this stuff
-        # can then get collected faster.
-        self.queue = None
-        self.promise = None
-        self.defer = None
-
 
 class WorkLogEntry(object):
     class WorkLogTaskBatch(object):
+        @property
+        def tasks(self):
+            # Logs are often kept well after the request that produced
+            # them, so they don't keep its tasks alive: this only has
+            # those tasks that still exist elsewhere.
+            tasks = []
+            for task_ref in self._task_refs:
+                task = task_ref()
+                if task is not None:
+                    tasks.append(task)
+            return tasks
+
         def __repr__(self):
             return "<coal.WorkLogTaskBatch %i %s>" % (
-                len(self.tasks),
+                self.count,
                 self.task_type.__name__,
             )
 
@@ -188,12 +496,22 @@ class WorkLogEntry(object):
         tasks,
         start_time,
         end_time,
+        cached=0,
+        merged=0,
+        shards=None,
     ):
         batch = WorkLogEntry.WorkLogTaskBatch()
         batch.task_type = task_type
         batch.batch_key = batch_key
-        batch.tasks = tasks
+        batch._task_refs = [weakref.ref(task) for task in tasks]
         batch.count = len(tasks)
+        # how many more tasks were resolved from earlier results, and
+        # how many were merged into others, instead of being worked.
+        batch.cached = cached
+        batch.merged = merged
+        # if the task type split the batch up, a dict of how many tasks
+        # went to each shard.
+        batch.shards = shards
         batch.start_time = start_time
         batch.end_time = end_time
         batch.time_spent = end_time - start_time
@@ -216,7 +534,7 @@ class WorkLogEntry(object):
             self.priority_name,
             ",".join([
                 "%i %s" % (
-                    len(x.tasks),
+                    x.count,
                     x.task_type.__name__,
                 )
                 for x in self.task_batches
@@ -224,45 +542,130 @@ class WorkLogEntry(object):
         )
 
 
-class TaskQueue(object):
+class TaskQueue(_TaskQueueBase):
+    """
+    Queues tasks and works them in batches, one priority phase at a time.
 
-    def __init__(self):
+    If a ``tracer`` is given then :py:meth:`work` and :py:meth:`work_once`
+    record a span for each call, each phase and each batch worked. It can be
+    an OpenTelemetry tracer, or anything else with a compatible
+    ``start_as_current_span`` method such as the tracers in
+    :py:mod:`coal.tracing`.
+
+    Batches bigger than their task type's :py:attr:`Task.max_batch_size`
+    are worked in chunks of that size. A ``batch_controller``, such as
+    :py:class:`coal.adaptive.AdaptiveBatchController`, can instead choose
+    the size for each task type, and is told how long each chunk took.
+
+    Results are remembered for the rest of the queue's life, so that later
+    tasks with the same coalesce key are resolved without being worked. A
+    ``result_store``, such as :py:class:`coal.persistence.ResultStore`, can
+    also keep the results of task types that set
+    :py:attr:`Task.persist_results` between queues and processes.
+
+    Batches are timed with :py:meth:`datetime.datetime.now`, or with the
+    ``now`` method of ``clock`` if one is given, such as the virtual clocks
+    of :py:mod:`coal.simulation`.
+
+    A ``stats``, such as :py:class:`coal.stats.CoalescingStats`, is told
+    about each batch before it's worked, with how many tasks were merged
+    into it and how many were resolved from earlier results.
+    """
+
+    def __init__(
+        self,
+        tracer=None,
+        batch_controller=None,
+        result_store=None,
+        clock=None,
+        stats=None,
+    ):
+        self.tracer = tracer
+        self.batch_controller = batch_controller
+        self.result_store = result_store
+        self.clock = clock
+        self.stats = stats
         self.subqueues = {}
         self.results = {}
+        # counts of the tasks merged into each batch of each subqueue.
+        self.merges = {}
+        # how many tasks have been handed back by requeue.
+        self.requeued = 0
+        # the budget passed to work, while working.
+        self.budget = None
+        # the shards reported for the chunk being worked.
+        self._shards = None
         for x in TaskPriority.all_values():
             self.subqueues[getattr(TaskPriority, x)] = {}
-
-    def add_task(self, task):
-        priority = task.priority
-        batch_key = task.batch_key
-        coalesce_key = task.coalesce_key
-        task_type = type(task)
-
-        compound_key = (task_type, batch_key)
-        if compound_key not in self.subqueues[priority]:
-            self.subqueues[priority][compound_key] = {}
-
-        if coalesce_key in self.subqueues[priority][compound_key]:
-            # we already have a matching task, so merge them.
-            self.subqueues[priority][compound_key][coalesce_key].merge(task)
-        else:
-            self.subqueues[priority][compound_key][coalesce_key] = task
-            task.assign_queue(self)
-
-        return task
-
-    def add_tasks(self, tasks):
+            self.merges[getattr(TaskPriority, x)] = {}
+
+    def requeue(self, tasks):
+        """
+        Queue ``tasks`` again, to be worked in a later phase. This is for
+        :py:meth:`Task.work` implementations to hand back tasks that they
+        haven't resolved yet, such as slow asynchronous tasks, so that
+        higher-priority work that's been queued meanwhile can go first.
+        """
         for task in tasks:
-            self.add_task(task)
+            task.requeued = True
+            compound_key = (type(task), task.batch_key)
+            subqueue = self.subqueues[task.priority]
+            batch = subqueue.get(compound_key)
+            if batch is None:
+                batch = subqueue[compound_key] = {}
+            existing = batch.get(task.coalesce_key)
+            if existing is None:
+                batch[task.coalesce_key] = task
+            elif existing is not task:
+                existing.merge(task)
+        self.requeued += len(tasks)
+
+    def report_shards(self, shards):
+        """
+        For :py:meth:`Task.work` implementations that split their batch
+        between several backend nodes, to report how: ``shards`` is a dict
+        of how many tasks were sent to each node. It's recorded in the work
+        log and trace of the batch.
+        """
+        self._shards = shards
+
+    def has_work_before(self, priority):
+        """
+        Returns whether there are tasks queued with a higher priority than
+        ``priority``, which would be worked before it.
+        """
+        for priority_name in TaskPriority.all_values():
+            priority_id = getattr(TaskPriority, priority_name)
+            if priority_id == priority:
+                return False
+            if len(self.subqueues[priority_id]) > 0:
+                return True
+        return False
 
     def _record_result(self, task, value):
-        priority = task.priority
-        batch_key = task.batch_key
-        coalesce_key = task.coalesce_key
-        task_type = type(task)
-        result_key = (task_type, batch_key, coalesce_key)
-
-        self.results[result_key] = value
+        self._record_results((task,), (value,))
+
+    def _record_results(self, tasks, values):
+        results = self.results
+        result_store = self.result_store
+        # kept in the store only once they're all in results, since the
+        # store may fail to take one.
+        persisted = []
+        for task, value in zip(tasks, values):
+            coalesce_key = task.coalesce_key
+            if coalesce_key == id(task):
+                # the default, which no other task can share; recording it
+                # would only keep the value alive, and a later task could
+                # be given the same id.
+                continue
+            task_type = type(task)
+            result_key = (task_type, task.batch_key, coalesce_key)
+
+            results[result_key] = value
+            if result_store is not None and task_type.persist_results:
+                persisted.append((result_key, value))
+        for result_key, value in persisted:
+            result_store.put(result_key, value)
 
     def work_once(self, log_list=None):
         subqueue = None
@@ -279,6 +682,8 @@ class TaskQueue(object):
         # Reset this subqueue so that if any new items are queued while
         # we're working they won't mutate our existing queue.
         self.subqueues[priority_id] = {}
+        merges = self.merges[priority_id]
+        self.merges[priority_id] = {}
 
         log_entry = None
         if log_list is not None:
@@ -287,144 +692,871 @@ class TaskQueue(object):
 
         attempted = 0
 
-        for compound_key, tasks in subqueue.iteritems():
+        with self._start_span("coal.phase", {
+            "coal.priority": priority_name,
+            "coal.batches": len(subqueue),
+        }) as span:
+            for compound_key, tasks in iteritems(subqueue):
+                attempted = attempted + self._work_batch(
+                    compound_key[0],
+                    compound_key[1],
+                    tasks,
+                    merges.get(compound_key, 0),
+                    log_entry,
+                )
+            span.set_attribute("coal.attempted", attempted)
 
-            task_type = compound_key[0]
-            batch_key = compound_key[1]
+        return attempted
 
+    def _work_batch(self, task_type, batch_key, tasks, merged, log_entry):
+        with self._start_span("coal.batch", {
+            "coal.task_type": task_type.__name__,
+            "coal.batch_key": repr(batch_key),
+        }) as span:
             # First see if any of the tasks already have results from
             # previous phases.
             pending_tasks = []
-            for coalesce_key, task in tasks.iteritems():
+            results = self.results
+            result_store = None
+            if task_type.persist_results:
+                result_store = self.result_store
+            for coalesce_key, task in iteritems(tasks):
                 result_key = (task_type, batch_key, coalesce_key)
-                if result_key in self.results:
+                if result_key in results:
                     # we already know the result, so just resolve
-                    # immediately.
-                    task.resolve(self.results[result_key])
-                else:
-                    pending_tasks.append(task)
-
-            task_count = len(pending_tasks)
-            attempted = attempted + task_count
-            start_time = datetime.now()
-            task_type.work(pending_tasks)
-            end_time = datetime.now()
-
-            if log_entry is not None:
-                log_entry.log_task_batch(
-                    task_type,
-                    batch_key,
-                    pending_tasks,
-                    start_time,
-                    end_time,
+                    # immediately, without recording it again.
+                    task.defer.resolve(results[result_key])
+                    continue
+                if result_store is not None:
+                    value = result_store.get(result_key, _NO_RESULT)
+                    if value is not _NO_RESULT:
+                        results[result_key] = value
+                        task.defer.resolve(value)
+                        continue
+                pending_tasks.append(task)
+
+            cached = len(tasks) - len(pending_tasks)
+            if self.stats is not None:
+                # requeued tasks were already observed on their first pass.
+                fresh = dict(
+                    (coalesce_key, task)
+                    for coalesce_key, task in iteritems(tasks)
+                    if not task.requeued
+                )
+                fresh_pending = sum(
+                    1 for task in pending_tasks if not task.requeued
+                )
+                self.stats.observe_batch(
+                    task_type, batch_key, fresh, merged,
+                    len(fresh) - fresh_pending,
                 )
 
-        return attempted
+            now = datetime.now
+            if self.clock is not None:
+                now = self.clock.now
+            time_spent = timedelta(0)
+            all_shards = set()
+            for i, chunk in enumerate(self._chunks(task_type, pending_tasks)):
+                # work may report how it split the chunk up, with
+                # report_shards.
+                self._shards = None
+                start_time = now()
+                if chunk:
+                    task_type.work(chunk)
+                end_time = now()
+                shards = self._shards
+                self._shards = None
+                time_spent += end_time - start_time
+
+                if chunk and self.batch_controller is not None:
+                    self.batch_controller.observe(
+                        task_type,
+                        len(chunk),
+                        (end_time - start_time).total_seconds(),
+                    )
+
+                if log_entry is not None:
+                    log_entry.log_task_batch(
+                        task_type,
+                        batch_key,
+                        chunk,
+                        start_time,
+                        end_time,
+                        # only count these against the first chunk.
+                        cached=cached if i == 0 else 0,
+                        merged=merged if i == 0 else 0,
+                        shards=shards,
+                    )
+                if shards is not None:
+                    all_shards.update(shards)
+
+            if span is not _NO_SPAN:
+                span.set_attribute("coal.batch.size", len(pending_tasks))
+                span.set_attribute("coal.batch.coalesced", merged)
+                span.set_attribute("coal.batch.cache_hits", cached)
+                span.set_attribute("coal.batch.chunks", i + 1)
+                if all_shards:
+                    span.set_attribute("coal.batch.shards", len(all_shards))
+                span.set_attribute(
+                    "coal.batch.duration_ms",
+                    time_spent.total_seconds() * 1000,
+                )
+
+        # Tasks resolved from earlier results count as attempted too,
+        # so that work() doesn't stop while their followups remain.
+        return len(tasks)
 
-    def work(self, cycle_limit=15, log_list=None):
+    def _chunks(self, task_type, tasks):
+        # The limit is read again for each chunk, so that the batch
+        # controller can shrink the rest of a batch after a slow chunk.
+        start = 0
+        while True:
+            limit = task_type.max_batch_size
+            if self.batch_controller is not None:
+                limit = self.batch_controller.batch_size(task_type)
+            if limit is None:
+                end = len(tasks)
+            else:
+                end = start + limit
+            yield tasks[start:end]
+            start = end
+            if start >= len(tasks):
+                return
+
+    def work(self, cycle_limit=15, log_list=None, budget=None):
+        """
+        Work the queued tasks a phase at a time until none remain.
+
+        A ``budget`` can stop the work early. It has an ``expired`` method,
+        which is called before each phase and stops the work by returning
+        true, and a ``remaining`` method that returns how many seconds
+        until it might expire, or None. While working, it's available as
+        :py:attr:`budget` to tasks that would otherwise wait longer, such
+        as :py:class:`coal.asynchronous.ThreadTask`, which hand back their
+        tasks with :py:meth:`requeue` once it expires.
+        """
+        previous_budget = self.budget
+        self.budget = budget
+        try:
+            return self._work(cycle_limit, log_list, budget)
+        finally:
+            self.budget = previous_budget
+
+    def _work(self, cycle_limit, log_list, budget):
         cycles = 0
         total_attempted = 0
-        while True:
-            attempted = self.work_once(log_list=log_list)
-            if attempted == 0:
-                return total_attempted
-            total_attempted = total_attempted + attempted
-            cycles = cycles + 1
-            if cycles > cycle_limit:
-                raise TooManyCyclesError(
-                    "Work queue did not deplete after %i cycles" % (
-                        self.cycle_limit
+        with self._start_span("coal.work", {}) as span:
+            while True:
+                if budget is not None and budget.expired():
+                    attempted = 0
+                else:
+                    requeued = self.requeued
+                    attempted = self.work_once(log_list=log_list)
+                if attempted == 0:
+                    span.set_attribute("coal.cycles", cycles)
+                    span.set_attribute("coal.attempted", total_attempted)
+                    return total_attempted
+                requeued = self.requeued - requeued
+                total_attempted = total_attempted + attempted - requeued
+                # A phase that handed tasks back will be finished later, so
+                # only count it then.
+                if requeued == 0:
+                    cycles = cycles + 1
+                if cycles > cycle_limit:
+                    raise TooManyCyclesError(
+                        "Work queue did not deplete after %i cycles" % (
+                            cycle_limit
+                        )
                     )
-                )
 
+    def _start_span(self, name, attributes):
+        if self.tracer is None:
+            return _NO_SPAN
+        return self.tracer.start_as_current_span(
+            name,
+            attributes=attributes,
+        )
 
-def flatten_promises(data, log_list=None):
 
-    promises = []
+# distinguishes a missing result in a result store from a stored None.
+_NO_RESULT = object()
 
-    def flatten_obj(obj):
-        if isinstance(obj, numbers.Number) or isinstance(obj, basestring):
-            # numbers and strings can never contain promises, so
-            # nothing to do here.
-            return
-        elif callable(obj):
-            # skip callable stuff assuming it's stuff like methods.
-            # This assumption means we won't resolve promises inside
-            # callable objects, which is a reasonable compromise.
-            return
-        # the string check has to be before this one because strings
-        # are sequences and thus containers.
-        elif isinstance(obj, collections.Container):
-            if isinstance(obj, collections.Sequence):
-                member_generator = (
-                    (i, value) for i, value in enumerate(obj)
-                )
-            elif isinstance(obj, collections.Mapping):
-                member_generator = (
-                    (k, obj[k]) for k in obj.keys()
-                )
-            else:
-                raise TypeError(
-                    "Don't know how to find promises in %s" % (
-                        type(obj).__name__
-                    )
-                )
-            for k, v in member_generator:
-                flatten_key(obj, k, v)
+
+class _NoSpan(object):
+    # Stands in for both a span and its context manager when a TaskQueue
+    # has no tracer.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+# Exact types that can never contain promises, checked before pushing
+# members onto the flatten_promises stack to keep it small.
+_SCALAR_TYPES = frozenset(
+    integer_types + string_types + (float, bool, type(None))
+)
+
+
+def _normalize_fields(fields):
+    # Turns the "fields" argument of flatten_promises into a nested dict
+    # mapping member names to the spec for that member, where None means
+    # "everything below here".
+    if fields is None or fields is True:
+        return None
+    if isinstance(fields, collections_abc.Mapping):
+        return dict(
+            (k, _normalize_fields(v)) for k, v in iteritems(fields)
+        )
+    if isinstance(fields, string_types):
+        fields = [fields]
+
+    spec = {}
+    for path in fields:
+        names = path.split(".")
+        current = spec
+        for name in names[:-1]:
+            if name in current and current[name] is None:
+                # a shorter path already selected everything here.
+                break
+            current = current.setdefault(name, {})
         else:
-            public_names = (
+            current[names[-1]] = None
+    return spec
+
+
+class FlattenHandler(object):
+    """
+    Tells :py:func:`flatten_promises` how to find the members of a family of
+    types that might hold promises, and how to put their results back.
+
+    Handlers for mutable types implement :py:meth:`replace`. Handlers for
+    immutable types set :py:attr:`mutable` to False and implement
+    :py:meth:`rebuild` instead, and the rebuilt object then replaces the
+    original wherever it was found.
+    """
+    types = ()
+    mutable = True
+
+    def handles(self, obj_type):
+        return issubclass(obj_type, self.types)
+
+    def members(self, obj, spec):
+        """
+        Yields ``(key, value, spec)`` for each member of ``obj`` selected by
+        the projection ``spec``, where the last item is the projection for
+        the member itself. ``spec`` is None when everything is selected.
+        """
+        raise NotImplementedError(
+            'members not implemented for %r' % self
+        )
+
+    def replace(self, obj, key, value):
+        raise NotImplementedError(
+            'replace not implemented for %r' % self
+        )
+
+    def rebuild(self, obj, replacements):
+        """
+        Returns a copy of ``obj`` with the members in the dict
+        ``replacements`` replaced.
+        """
+        raise NotImplementedError(
+            'rebuild not implemented for %r' % self
+        )
+
+
+def _sub_spec(spec, name):
+    if spec is None:
+        return None
+    return spec[name]
+
+
+class ObjectFlattenHandler(FlattenHandler):
+    types = (object,)
+
+    def members(self, obj, spec):
+        if spec is None:
+            attr_names = (
                 name for name in dir(obj) if not name.startswith("_")
             )
-            for attr_name in public_names:
-                try:
-                    v = getattr(obj, attr_name)
-                except AttributeError:
-                    # Ignore attributes that we can't read.
-                    continue
-                flatten_attr(obj, attr_name, v)
+        else:
+            attr_names = spec
+        for attr_name in attr_names:
+            try:
+                v = getattr(obj, attr_name)
+            except AttributeError:
+                # Ignore attributes that we can't read.
+                continue
+            yield attr_name, v, _sub_spec(spec, attr_name)
+
+    def replace(self, obj, key, value):
+        try:
+            setattr(obj, key, value)
+        except AttributeError:
+            # ignore attributes that we can't write.
+            pass
+
+
+class SlotsFlattenHandler(ObjectFlattenHandler):
+    """
+    Handles objects whose attributes are all declared in ``__slots__``,
+    reading just those rather than searching ``dir()``.
+    """
+
+    def handles(self, obj_type):
+        classes = [c for c in obj_type.__mro__ if c is not object]
+        return len(classes) > 0 and all(
+            "__slots__" in vars(c) for c in classes
+        )
+
+    def members(self, obj, spec):
+        if spec is None:
+            spec = dict(
+                (name, None) for name in self._slot_names(type(obj))
+            )
+        return super(SlotsFlattenHandler, self).members(obj, spec)
+
+    @staticmethod
+    def _slot_names(obj_type):
+        for c in obj_type.__mro__:
+            slots = vars(c).get("__slots__", ())
+            if isinstance(slots, string_types):
+                slots = (slots,)
+            for name in slots:
+                if not name.startswith("_"):
+                    yield name
+
+
+class DataclassFlattenHandler(ObjectFlattenHandler):
+    """
+    Handles dataclasses, reading just their public fields. Frozen
+    dataclasses are rebuilt with ``dataclasses.replace``.
+    """
+
+    def handles(self, obj_type):
+        return hasattr(obj_type, "__dataclass_fields__")
+
+    def members(self, obj, spec):
+        if spec is None:
+            # Any dataclass instance means the module is already loaded.
+            dataclasses = sys.modules["dataclasses"]
+            spec = dict(
+                (field.name, None) for field in dataclasses.fields(obj)
+                if not field.name.startswith("_")
+            )
+        return super(DataclassFlattenHandler, self).members(obj, spec)
+
+    def rebuild(self, obj, replacements):
+        return sys.modules["dataclasses"].replace(obj, **replacements)
+
+
+class FrozenDataclassFlattenHandler(DataclassFlattenHandler):
+    mutable = False
+
+    def handles(self, obj_type):
+        params = getattr(obj_type, "__dataclass_params__", None)
+        return params is not None and params.frozen
+
 
-    def flatten_key(coll, k, v):
-        if isinstance(v, Promise):
-            promises.append(v)
+class SequenceFlattenHandler(FlattenHandler):
+    types = (collections_abc.Sequence,)
 
-            def afterwards(nextV):
-                flatten_key(coll, k, nextV)
+    def members(self, obj, spec):
+        # the projection applies to each item, not to the indices.
+        for i, v in enumerate(obj):
+            yield i, v, spec
 
-            v.then(afterwards)
+    def replace(self, obj, key, value):
+        obj[key] = value
+
+
+class TupleFlattenHandler(SequenceFlattenHandler):
+    types = (tuple,)
+    mutable = False
+
+    def rebuild(self, obj, replacements):
+        return type(obj)(
+            replacements.get(i, v) for i, v in enumerate(obj)
+        )
+
+
+class NamedTupleFlattenHandler(FlattenHandler):
+    mutable = False
+
+    def handles(self, obj_type):
+        return issubclass(obj_type, tuple) and hasattr(obj_type, "_fields")
+
+    def members(self, obj, spec):
+        names = obj._fields
+        if spec is not None:
+            names = [name for name in spec if name in names]
+        for name in names:
+            yield name, getattr(obj, name), _sub_spec(spec, name)
+
+    def rebuild(self, obj, replacements):
+        return obj._replace(**replacements)
+
+
+class MappingFlattenHandler(FlattenHandler):
+    types = (collections_abc.Mapping,)
+
+    def members(self, obj, spec):
+        if spec is None:
+            keys = obj.keys()
         else:
-            coll[k] = v
-            flatten_obj(v)
+            keys = [k for k in spec if k in obj]
+        for k in keys:
+            yield k, obj[k], _sub_spec(spec, k)
+
+    def replace(self, obj, key, value):
+        obj[key] = value
+
+
+class SetFlattenHandler(FlattenHandler):
+    """
+    Handles mutable sets, whose members are keyed by themselves.
+    """
+    types = (collections_abc.MutableSet,)
+
+    def members(self, obj, spec):
+        # copy, since replacing members as we go would upset iteration.
+        for v in list(obj):
+            yield v, v, spec
+
+    def replace(self, obj, key, value):
+        obj.discard(key)
+        obj.add(value)
+
+
+class FrozenSetFlattenHandler(SetFlattenHandler):
+    types = (collections_abc.Set,)
+    mutable = False
+
+    def rebuild(self, obj, replacements):
+        return type(obj)(replacements.get(v, v) for v in obj)
+
+
+class NumPyFlattenHandler(FlattenHandler):
+    """
+    Handles NumPy arrays, of which only those with the object dtype can
+    hold promises.
+    """
+
+    def handles(self, obj_type):
+        # Any array instance means the module is already loaded.
+        numpy = sys.modules.get("numpy")
+        return numpy is not None and issubclass(obj_type, numpy.ndarray)
+
+    def members(self, obj, spec):
+        if obj.dtype.hasobject:
+            numpy = sys.modules["numpy"]
+            for index, v in numpy.ndenumerate(obj):
+                yield index, v, spec
+
+    def replace(self, obj, key, value):
+        obj[key] = value
+
+
+class FlattenHandlerRegistry(object):
+    """
+    Chooses the :py:class:`FlattenHandler` for each type that
+    :py:func:`flatten_promises` encounters. Handlers registered later take
+    precedence over those registered earlier.
+    """
+
+    def __init__(self, handlers=()):
+        self.handlers = []
+        self._by_type = {}
+        for handler in handlers:
+            self.register(handler)
 
-    def flatten_attr(obj, name, v):
-        if isinstance(v, Promise):
-            promises.append(v)
+    def register(self, handler):
+        self.handlers.append(handler)
+        self._by_type = {}
 
-            def afterwards(nextV):
-                flatten_attr(obj, name, nextV)
+    def handler_for(self, obj_type):
+        try:
+            return self._by_type[obj_type]
+        except KeyError:
+            pass
 
-            v.then(afterwards)
+        for handler in reversed(self.handlers):
+            if handler.handles(obj_type):
+                break
         else:
-            if v is not getattr(obj, name):
-                try:
-                    setattr(obj, name, v)
-                except AttributeError:
-                    # ignore attributes that we can't write.
-                    pass
-            flatten_obj(v)
-
-    flatten_obj(data)
-
-    queue = TaskQueue()
-
-    while len(promises) > 0:
-        tasks = (
-            promise.task for promise in promises
-            if getattr(promise, "task", None) is not None
-        )
+            if issubclass(obj_type, collections_abc.Container):
+                raise TypeError(
+                    "Don't know how to find promises in %s" % (
+                        obj_type.__name__
+                    )
+                )
+            handler = ObjectFlattenHandler()
+
+        self._by_type[obj_type] = handler
+        return handler
+
+
+flatten_handlers = FlattenHandlerRegistry([
+    SlotsFlattenHandler(),
+    DataclassFlattenHandler(),
+    FrozenDataclassFlattenHandler(),
+    SequenceFlattenHandler(),
+    TupleFlattenHandler(),
+    NamedTupleFlattenHandler(),
+    MappingFlattenHandler(),
+    FrozenSetFlattenHandler(),
+    SetFlattenHandler(),
+    NumPyFlattenHandler(),
+])
+
+
+class _Rebuild(object):
+    # An immutable object found while flattening, along with the results
+    # of its promises and everywhere it needs to be put once rebuilt.
+    def __init__(self, obj, handler):
+        self.obj = obj
+        self.handler = handler
+        self.replacements = {}
+        self.slots = []
+
+
+def _write_slot(slot, value):
+    target, handler, key = slot
+    if handler is None:
+        # target is a _Rebuild
+        target.replacements[key] = value
+    else:
+        handler.replace(target, key, value)
+
+
+def flatten_promises(
+    data,
+    log_list=None,
+    fields=None,
+    weak_visited=False,
+    handlers=None,
+    queue=None,
+    timeout=None,
+):
+    """
+    Replace all of the promises within ``data`` with their results,
+    working the tasks behind them until none remain, and return the
+    flattened data.
+
+    The members of each object are found using the
+    :py:class:`FlattenHandlerRegistry` ``handlers``, defaulting to
+    :py:data:`flatten_handlers`. Immutable objects that held promises are
+    rebuilt, so the return value differs from ``data`` if ``data`` itself
+    was rebuilt.
+
+    The tasks are worked on ``queue`` if given, along with anything already
+    queued on it, or otherwise on a new :py:class:`TaskQueue`.
+
+    By default every public attribute and every container member is
+    visited. ``fields`` can instead select a projection of ``data``, either
+    as an iterable of dotted paths like ``"author.name"`` or as a nested
+    dict like ``{"author": {"name": True}}``. Only the selected members are
+    visited, so only the tasks behind them are run. Sequences are
+    transparent to the projection: the spec applies to each of their items.
+
+    Each object is visited only once, even if it is referenced from several
+    places or from itself, so shared sub-objects have their promises
+    replaced in all references at once and cyclic graphs terminate. Visited
+    objects are kept alive until flattening completes so their identities
+    can't be reused; pass ``weak_visited=True`` to track them by weak
+    reference instead where the type allows it, letting objects that are
+    dropped from ``data`` during flattening be collected early.
+
+    Promises marked with :py:func:`optional` are replaced with their
+    defaults, rather than waited for, once their own timeouts pass or once
+    the flattening has taken ``timeout`` seconds, if given. The rest are
+    always waited for. Time is checked between phases of work, and
+    measured with the queue's clock if it has one. Once only abandoned
+    promises remain, flattening returns without working the rest of the
+    queue: tasks that had started working in the background carry on, and
+    any still queued on a ``queue`` that was passed in stay queued on it.
+    """
+
+    if handlers is None:
+        handlers = flatten_handlers
+    if queue is None:
+        queue = TaskQueue()
+
+    now = datetime.now
+    if queue.clock is not None:
+        now = queue.clock.now
+    flattener = _Flattener(handlers, weak_visited, now, timeout)
+    root = [data]
+    root_slot = (root, SequenceFlattenHandler(), 0)
+    flattener.stack.append(
+        (data, _normalize_fields(fields), root_slot, None)
+    )
+    flattener.walk()
+
+    found_tasks = flattener.found_tasks
+    while True:
+        tasks = list(found_tasks.values())
+        found_tasks.clear()
         queue.add_tasks(tasks)
-        promises = []
-        # The resolution of promises may cause more promises to be queued.
-        queue.work(log_list=log_list)
+        queue.work(log_list=log_list, budget=flattener)
+        # The resolution of promises may have found more promises.
+        if len(found_tasks) == 0:
+            break
+        if flattener.finished_early and flattener.pending == 0:
+            break
+
+    flattener.rebuild()
+    return root[0]
+
+
+class _Flattener(object):
+    # The state of one call to flatten_promises. This is an object rather
+    # than closures within flatten_promises because closures that refer to
+    # each other form reference cycles, which would keep the visited data
+    # alive until the cycle collector next runs.
+
+    def __init__(self, handlers, weak_visited, now, timeout):
+        self.handlers = handlers
+        self.weak_visited = weak_visited
+        self.now = now
+        self.start = now()
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = self.start + timedelta(seconds=timeout)
+        # the _Optional of each optional promise found, and how many
+        # promises are still pending, not counting abandoned ones.
+        self.optionals = []
+        self.pending = 0
+        self.finished_early = False
+        # maps id(task) to each task found since the queue was last worked,
+        # so that a promise found in several places only has its task
+        # queued once.
+        self.found_tasks = {}
+        # maps (id(obj), id(spec)) to obj, or to a weak reference to it.
+        self.visited = {}
+        # maps the same keys to the _Rebuild of each immutable object.
+        self.rebuilds = {}
+        self.rebuild_order = []
+        # (obj, spec, slot, owner) tuples still to be walked, where the slot
+        # says where obj was found and owner is the _Optional that obj is
+        # part of the value of, if any. An explicit stack rather than
+        # recursion keeps deeply-nested data within the interpreter's
+        # recursion limit and avoids a few calls per level.
+        self.stack = []
+        self.walking = False
+        # imported here rather than with the module, since it's only
+        # needed once something's flattened.
+        import numbers
+        self.number_type = numbers.Number
+
+    def first_visit(self, obj, spec, slot):
+        visited = self.visited
+        key = (id(obj), id(spec))
+        if key in visited:
+            if key in self.rebuilds:
+                self.rebuilds[key].slots.append(slot)
+            return False
+        ref = obj
+        if self.weak_visited:
+            try:
+                # forget the object once it's gone, since its id may then
+                # be reused by an object we've not visited.
+                ref = weakref.ref(obj, lambda _, key=key: visited.pop(key))
+            except TypeError:
+                # builtins like list and dict can't be weakly referenced.
+                pass
+        visited[key] = ref
+        return True
+
+    def walk(self):
+        if self.walking:
+            # a promise resolved while we were already walking, so the
+            # outer loop will pick up whatever it pushed.
+            return
+        self.walking = True
+        stack = self.stack
+        walk_obj = self.walk_obj
+        try:
+            while stack:
+                walk_obj(*stack.pop())
+        finally:
+            self.walking = False
+
+    def walk_obj(self, obj, spec, slot, owner):
+        if isinstance(obj, self.number_type) or isinstance(obj, string_types):
+            # numbers and strings can never contain promises, so
+            # nothing to do here.
+            return
+        elif callable(obj):
+            # skip callable stuff assuming it's stuff like methods.
+            # This assumption means we won't resolve promises inside
+            # callable objects, which is a reasonable compromise.
+            return
+        elif obj is self:
+            # reachable through the budget of the queue of any task in the
+            # data, and walking our own stack as it grows would never end.
+            return
+        elif not self.first_visit(obj, spec, slot):
+            return
+
+        handler = self.handlers.handler_for(type(obj))
+        if handler.mutable:
+            target = obj
+            target_handler = handler
+        else:
+            # results are collected up and the object rebuilt at the end.
+            target = _Rebuild(obj, handler)
+            target.slots.append(slot)
+            self.rebuilds[(id(obj), id(spec))] = target
+            self.rebuild_order.append(target)
+            target_handler = None
+
+        stack = self.stack
+        for k, v, member_spec in handler.members(obj, spec):
+            if isinstance(v, Promise):
+                self.watch((target, target_handler, k), v, member_spec, owner)
+            elif type(v) not in _SCALAR_TYPES:
+                stack.append(
+                    (v, member_spec, (target, target_handler, k), owner)
+                )
+
+    def watch(self, slot, promise, spec, owner):
+        if isinstance(promise, OptionalPromise):
+            deadline = self.deadline
+            if promise.timeout is not None:
+                own_deadline = self.start + timedelta(
+                    seconds=promise.timeout
+                )
+                if deadline is None or own_deadline < deadline:
+                    deadline = own_deadline
+            owner = _Optional(owner, slot, promise.default, deadline)
+            self.optionals.append(owner)
+            promise = promise.promise
+
+        task = getattr(promise, "task", None)
+        if task is not None and task.queue is None:
+            self.found_tasks[id(task)] = task
+        self._count_pending(owner, 1)
+
+        def afterwards(value):
+            if owner is not None and owner.abandoned():
+                return
+            if isinstance(value, Promise):
+                self.watch(slot, value, spec, owner)
+            else:
+                _write_slot(slot, value)
+                self.stack.append((value, spec, slot, owner))
+                self.walk()
+            self._count_pending(owner, -1)
+
+        promise.then(afterwards)
+
+    def _count_pending(self, owner, change):
+        self.pending += change
+        while owner is not None:
+            owner.pending += change
+            owner = owner.owner
+
+    def expired(self):
+        # Replaces the optional promises whose time has run out with their
+        # defaults, and returns whether only abandoned promises remain, in
+        # which case there's no more work worth waiting for.
+        if self.optionals:
+            now = self.now()
+            expired = False
+            for optional in self.optionals:
+                if (
+                    optional.deadline is not None and
+                    optional.deadline <= now and
+                    optional.pending > 0 and
+                    not optional.abandoned()
+                ):
+                    _write_slot(optional.slot, optional.default)
+                    optional.expired = True
+                    self._count_pending(optional, -optional.pending)
+                    expired = True
+            if expired:
+                self.finished_early = True
+            self.optionals = [
+                optional for optional in self.optionals
+                if optional.pending > 0 and not optional.abandoned()
+            ]
+        return self.finished_early and self.pending == 0
+
+    def remaining(self):
+        # The seconds until an optional promise's time runs out, or None.
+        deadlines = [
+            optional.deadline for optional in self.optionals
+            if optional.deadline is not None
+        ]
+        if not deadlines:
+            return None
+        return max(0, (min(deadlines) - self.now()).total_seconds())
+
+    def rebuild(self):
+        # Each object has to be rebuilt after the immutable objects within
+        # it, so that their rebuilt copies are in place. An object that's
+        # shared can be visited before some of the objects that contain
+        # it, so they're put in order by a depth-first search from each
+        # object through the immutable objects within it.
+        members = {}
+        for rebuild in self.rebuild_order:
+            for target, handler, key in rebuild.slots:
+                if handler is None:
+                    members.setdefault(id(target), []).append(rebuild)
+
+        seen = set()
+        for root in self.rebuild_order:
+            if id(root) in seen:
+                continue
+            # (rebuild, whether its members have been rebuilt) pairs.
+            stack = [(root, False)]
+            while stack:
+                rebuild, ready = stack.pop()
+                if ready:
+                    if rebuild.replacements:
+                        value = rebuild.handler.rebuild(
+                            rebuild.obj, rebuild.replacements
+                        )
+                        for slot in rebuild.slots:
+                            _write_slot(slot, value)
+                    continue
+                if id(rebuild) in seen:
+                    continue
+                seen.add(id(rebuild))
+                stack.append((rebuild, True))
+                for member in members.get(id(rebuild), ()):
+                    if id(member) not in seen:
+                        stack.append((member, False))
+
+
+class _Optional(object):
+    # An optional promise found by flatten_promises, and the promises found
+    # within its value, which are abandoned along with it.
+
+    def __init__(self, owner, slot, default, deadline):
+        # the _Optional that this one is part of the value of, if any.
+        self.owner = owner
+        self.slot = slot
+        self.default = default
+        self.deadline = deadline
+        self.pending = 0
+        self.expired = False
+
+    def abandoned(self):
+        optional = self
+        while optional is not None:
+            if optional.expired:
+                return True
+            optional = optional.owner
+        return False
 
 
 class DuplicateResolutionError(Exception):
@@ -437,3 +1569,11 @@ class AlreadyQueuedError(Exception):
 
 class TooManyCyclesError(Exception):
     pass
+
+
+if _speedups is not None:
+    _speedups.configure(
+        Promise,
+        Defer.NOT_YET_RESOLVED,
+        DuplicateResolutionError,
+    )
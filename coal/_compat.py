@@ -0,0 +1,43 @@
+"""
+Smooths over the differences between Python 2 and Python 3 that coal runs
+into, so that the rest of the package can be written once for both.
+"""
+
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    import collections as collections_abc
+
+    text_type = unicode
+    integer_types = (int, long)
+
+    def iteritems(d):
+        return d.iteritems()
+
+    def itervalues(d):
+        return d.itervalues()
+
+    # a syntax error on Python 3, so it's only compiled here.
+    exec("def reraise(tp, value, tb=None):\n    raise tp, value, tb\n")
+
+else:
+    import collections.abc as collections_abc
+
+    text_type = str
+    integer_types = (int,)
+
+    def iteritems(d):
+        return iter(d.items())
+
+    def itervalues(d):
+        return iter(d.values())
+
+    def reraise(tp, value, tb=None):
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
+
+# both kinds of string, which can't contain promises or be walked into.
+string_types = (bytes, text_type)
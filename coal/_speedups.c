@@ -0,0 +1,836 @@
+/*
+ * C implementations of the hottest parts of coal: resolving defers and
+ * adding callbacks to them, chaining promises, and coalescing tasks as
+ * they're queued. coal/__init__.py uses these in place of its pure-Python
+ * versions when this module has been built, and they must behave the same.
+ */
+
+#include <Python.h>
+#include <stddef.h>
+
+#if PY_MAJOR_VERSION >= 3
+#define COAL_INT_FROM_LONG PyLong_FromLong
+#define COAL_DICT_GET PyDict_GetItemWithError
+#else
+#define COAL_INT_FROM_LONG PyInt_FromLong
+#define COAL_DICT_GET PyDict_GetItem
+#endif
+
+#if PY_VERSION_HEX >= 0x03090000
+/* calls without building argument tuples or bound methods. */
+#define COAL_VECTORCALL
+#endif
+
+/* Set by configure(), once coal/__init__.py has defined them. */
+static PyObject *promise_type = NULL;
+static PyObject *not_yet_resolved = NULL;
+static PyObject *duplicate_resolution_error = NULL;
+
+static PyObject *str_append = NULL;
+static PyObject *str_assign_queue = NULL;
+static PyObject *str_batch_key = NULL;
+static PyObject *str_coalesce_key = NULL;
+static PyObject *str_merge = NULL;
+static PyObject *str_merges = NULL;
+static PyObject *str_pending = NULL;
+static PyObject *str_priority = NULL;
+static PyObject *str_resolve = NULL;
+static PyObject *str_subqueues = NULL;
+static PyObject *str_then = NULL;
+static PyObject *str_value = NULL;
+static PyObject *int_one = NULL;
+
+static int
+check_configured(void)
+{
+    if (promise_type == NULL) {
+        PyErr_SetString(
+            PyExc_RuntimeError,
+            "coal._speedups.configure hasn't been called"
+        );
+        return -1;
+    }
+    return 0;
+}
+
+/* Calls callback(value), or value.then(callback) for a promise. */
+static int
+call_callback(PyObject *callback, PyObject *value, int is_promise)
+{
+    PyObject *result;
+    if (is_promise) {
+        result = PyObject_CallMethodObjArgs(value, str_then, callback, NULL);
+    }
+    else {
+        result = PyObject_CallFunctionObjArgs(callback, value, NULL);
+    }
+    if (result == NULL) {
+        return -1;
+    }
+    Py_DECREF(result);
+    return 0;
+}
+
+static int
+call_callbacks(PyObject *pending, PyObject *value)
+{
+    PyObject *iterator, *callback;
+    Py_ssize_t i;
+    int is_promise = PyObject_IsInstance(value, promise_type);
+    if (is_promise < 0) {
+        return -1;
+    }
+
+    if (PyList_CheckExact(pending)) {
+        for (i = 0; i < PyList_GET_SIZE(pending); i++) {
+            callback = PyList_GET_ITEM(pending, i);
+            Py_INCREF(callback);
+            if (call_callback(callback, value, is_promise) < 0) {
+                Py_DECREF(callback);
+                return -1;
+            }
+            Py_DECREF(callback);
+        }
+        return 0;
+    }
+
+    iterator = PyObject_GetIter(pending);
+    if (iterator == NULL) {
+        return -1;
+    }
+    while ((callback = PyIter_Next(iterator)) != NULL) {
+        if (call_callback(callback, value, is_promise) < 0) {
+            Py_DECREF(callback);
+            Py_DECREF(iterator);
+            return -1;
+        }
+        Py_DECREF(callback);
+    }
+    Py_DECREF(iterator);
+    return PyErr_Occurred() ? -1 : 0;
+}
+
+
+/* Defer */
+
+static PyObject *
+defer_resolve(PyObject *self, PyObject *value)
+{
+    PyObject *current, *pending;
+    int failed;
+
+    if (check_configured() < 0) {
+        return NULL;
+    }
+    current = PyObject_GetAttr(self, str_value);
+    if (current == NULL) {
+        return NULL;
+    }
+    Py_DECREF(current);
+    if (current != not_yet_resolved) {
+        PyErr_SetString(duplicate_resolution_error, "Defer is already resolved");
+        return NULL;
+    }
+
+    pending = PyObject_GetAttr(self, str_pending);
+    if (pending == NULL) {
+        return NULL;
+    }
+    if (pending == Py_None) {
+        Py_DECREF(pending);
+        Py_RETURN_NONE;
+    }
+    failed = (
+        PyObject_SetAttr(self, str_value, value) < 0 ||
+        PyObject_SetAttr(self, str_pending, Py_None) < 0 ||
+        call_callbacks(pending, value) < 0
+    );
+    Py_DECREF(pending);
+    if (failed) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+defer_add_callback(PyObject *self, PyObject *callback)
+{
+    PyObject *pending, *value, *result;
+    int is_promise;
+
+    if (check_configured() < 0) {
+        return NULL;
+    }
+    pending = PyObject_GetAttr(self, str_pending);
+    if (pending == NULL) {
+        return NULL;
+    }
+    if (pending != Py_None) {
+        if (PyList_CheckExact(pending)) {
+            if (PyList_Append(pending, callback) < 0) {
+                Py_DECREF(pending);
+                return NULL;
+            }
+        }
+        else {
+            result = PyObject_CallMethodObjArgs(
+                pending, str_append, callback, NULL
+            );
+            if (result == NULL) {
+                Py_DECREF(pending);
+                return NULL;
+            }
+            Py_DECREF(result);
+        }
+        Py_DECREF(pending);
+        Py_RETURN_NONE;
+    }
+    Py_DECREF(pending);
+
+    value = PyObject_GetAttr(self, str_value);
+    if (value == NULL) {
+        return NULL;
+    }
+    is_promise = PyObject_IsInstance(value, promise_type);
+    if (is_promise < 0 || call_callback(callback, value, is_promise) < 0) {
+        Py_DECREF(value);
+        return NULL;
+    }
+    Py_DECREF(value);
+    Py_RETURN_NONE;
+}
+
+/* Chain: the callback that Promise.then adds to a defer. */
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *result;
+    PyObject *callback;
+#ifdef COAL_VECTORCALL
+    vectorcallfunc vectorcall;
+#endif
+} Chain;
+
+static int
+Chain_traverse(Chain *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->result);
+    Py_VISIT(self->callback);
+    return 0;
+}
+
+static int
+Chain_clear(Chain *self)
+{
+    Py_CLEAR(self->result);
+    Py_CLEAR(self->callback);
+    return 0;
+}
+
+static void
+Chain_dealloc(Chain *self)
+{
+    PyObject_GC_UnTrack(self);
+    Chain_clear(self);
+    PyObject_GC_Del(self);
+}
+
+static PyObject *
+chain_resolve(Chain *self, PyObject *value)
+{
+    PyObject *result;
+
+    if (value == NULL) {
+        return NULL;
+    }
+    result = PyObject_CallMethodObjArgs(self->result, str_resolve, value, NULL);
+    Py_DECREF(value);
+    if (result == NULL) {
+        return NULL;
+    }
+    Py_DECREF(result);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Chain_call(Chain *self, PyObject *args, PyObject *kwargs)
+{
+    return chain_resolve(self, PyObject_Call(self->callback, args, kwargs));
+}
+
+#ifdef COAL_VECTORCALL
+static PyObject *
+Chain_vectorcall(
+    PyObject *self,
+    PyObject *const *args,
+    size_t nargsf,
+    PyObject *kwnames
+)
+{
+    return chain_resolve(
+        (Chain *)self,
+        PyObject_Vectorcall(((Chain *)self)->callback, args, nargsf, kwnames)
+    );
+}
+#endif
+
+static PyTypeObject ChainType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "coal._speedups.Chain",                     /* tp_name */
+    sizeof(Chain),                              /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)Chain_dealloc,                  /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    (ternaryfunc)Chain_call,                    /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,    /* tp_flags */
+    "Resolves result with what callback returns.", /* tp_doc */
+    (traverseproc)Chain_traverse,               /* tp_traverse */
+    (inquiry)Chain_clear,                       /* tp_clear */
+};
+
+static PyObject *
+speedups_chain(PyObject *module, PyObject *args)
+{
+    PyObject *result, *callback;
+    Chain *chain;
+
+    if (!PyArg_ParseTuple(args, "OO:chain", &result, &callback)) {
+        return NULL;
+    }
+    chain = PyObject_GC_New(Chain, &ChainType);
+    if (chain == NULL) {
+        return NULL;
+    }
+    Py_INCREF(result);
+    chain->result = result;
+    Py_INCREF(callback);
+    chain->callback = callback;
+#ifdef COAL_VECTORCALL
+    chain->vectorcall = Chain_vectorcall;
+#endif
+    PyObject_GC_Track(chain);
+    return (PyObject *)chain;
+}
+
+
+/* TaskQueue */
+
+static int
+count_merge(PyObject *merges, PyObject *priority, PyObject *compound_key)
+{
+    PyObject *priority_merges, *count, *new_count;
+    int status;
+
+    priority_merges = PyObject_GetItem(merges, priority);
+    if (priority_merges == NULL) {
+        return -1;
+    }
+    if (!PyDict_Check(priority_merges)) {
+        Py_DECREF(priority_merges);
+        PyErr_SetString(PyExc_TypeError, "TaskQueue.merges must hold dicts");
+        return -1;
+    }
+    count = COAL_DICT_GET(priority_merges, compound_key);
+    if (count == NULL) {
+        if (PyErr_Occurred()) {
+            Py_DECREF(priority_merges);
+            return -1;
+        }
+        new_count = int_one;
+        Py_INCREF(new_count);
+    }
+    else {
+        new_count = PyNumber_Add(count, int_one);
+        if (new_count == NULL) {
+            Py_DECREF(priority_merges);
+            return -1;
+        }
+    }
+    status = PyDict_SetItem(priority_merges, compound_key, new_count);
+    Py_DECREF(new_count);
+    Py_DECREF(priority_merges);
+    return status;
+}
+
+static int
+add_one_task(
+    PyObject *self,
+    PyObject *subqueues,
+    PyObject *merges,
+    PyObject *task
+)
+{
+    PyObject *priority = NULL, *batch_key = NULL, *coalesce_key = NULL;
+    PyObject *compound_key = NULL, *subqueue = NULL, *batch, *existing;
+    PyObject *result;
+    int status = -1;
+
+    priority = PyObject_GetAttr(task, str_priority);
+    if (priority == NULL) {
+        goto done;
+    }
+    batch_key = PyObject_GetAttr(task, str_batch_key);
+    if (batch_key == NULL) {
+        goto done;
+    }
+    coalesce_key = PyObject_GetAttr(task, str_coalesce_key);
+    if (coalesce_key == NULL) {
+        goto done;
+    }
+    compound_key = PyTuple_Pack(2, (PyObject *)Py_TYPE(task), batch_key);
+    if (compound_key == NULL) {
+        goto done;
+    }
+
+    subqueue = PyObject_GetItem(subqueues, priority);
+    if (subqueue == NULL) {
+        goto done;
+    }
+    if (!PyDict_Check(subqueue)) {
+        PyErr_SetString(PyExc_TypeError, "TaskQueue.subqueues must hold dicts");
+        goto done;
+    }
+    batch = COAL_DICT_GET(subqueue, compound_key);
+    if (batch == NULL) {
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+        batch = PyDict_New();
+        if (batch == NULL) {
+            goto done;
+        }
+        if (PyDict_SetItem(subqueue, compound_key, batch) < 0) {
+            Py_DECREF(batch);
+            goto done;
+        }
+    }
+    else {
+        Py_INCREF(batch);
+    }
+
+    existing = PyDict_Check(batch) ? COAL_DICT_GET(batch, coalesce_key) : NULL;
+    if (existing == NULL) {
+        if (PyErr_Occurred() || PyDict_SetItem(batch, coalesce_key, task) < 0) {
+            Py_DECREF(batch);
+            goto done;
+        }
+        Py_DECREF(batch);
+        result = PyObject_CallMethodObjArgs(task, str_assign_queue, self, NULL);
+        if (result == NULL) {
+            goto done;
+        }
+        Py_DECREF(result);
+    }
+    else if (existing != task) {
+        /* we already have a matching task, so merge them. */
+        Py_INCREF(existing);
+        Py_DECREF(batch);
+        result = PyObject_CallMethodObjArgs(existing, str_merge, task, NULL);
+        Py_DECREF(existing);
+        if (result == NULL) {
+            goto done;
+        }
+        Py_DECREF(result);
+        if (count_merge(merges, priority, compound_key) < 0) {
+            goto done;
+        }
+    }
+    else {
+        Py_DECREF(batch);
+    }
+    status = 0;
+
+done:
+    Py_XDECREF(priority);
+    Py_XDECREF(batch_key);
+    Py_XDECREF(coalesce_key);
+    Py_XDECREF(compound_key);
+    Py_XDECREF(subqueue);
+    return status;
+}
+
+static int
+get_queue_dicts(PyObject *self, PyObject **subqueues, PyObject **merges)
+{
+    *subqueues = PyObject_GetAttr(self, str_subqueues);
+    if (*subqueues == NULL) {
+        return -1;
+    }
+    *merges = PyObject_GetAttr(self, str_merges);
+    if (*merges == NULL) {
+        Py_DECREF(*subqueues);
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+queue_add_task(PyObject *self, PyObject *task)
+{
+    PyObject *subqueues, *merges;
+    int status;
+
+    if (get_queue_dicts(self, &subqueues, &merges) < 0) {
+        return NULL;
+    }
+    status = add_one_task(self, subqueues, merges, task);
+    Py_DECREF(subqueues);
+    Py_DECREF(merges);
+    if (status < 0) {
+        return NULL;
+    }
+    Py_INCREF(task);
+    return task;
+}
+
+static PyObject *
+queue_add_tasks(PyObject *self, PyObject *tasks)
+{
+    PyObject *subqueues, *merges, *iterator, *task;
+
+    iterator = PyObject_GetIter(tasks);
+    if (iterator == NULL) {
+        return NULL;
+    }
+    if (get_queue_dicts(self, &subqueues, &merges) < 0) {
+        Py_DECREF(iterator);
+        return NULL;
+    }
+    while ((task = PyIter_Next(iterator)) != NULL) {
+        if (add_one_task(self, subqueues, merges, task) < 0) {
+            Py_DECREF(task);
+            break;
+        }
+        Py_DECREF(task);
+    }
+    Py_DECREF(iterator);
+    Py_DECREF(subqueues);
+    Py_DECREF(merges);
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/*
+ * Method: a function that binds to instances like a Python function does,
+ * so that the functions above can be used as methods of the pure-Python
+ * Defer and TaskQueue. Using C base classes for those instead would cost
+ * more than it saves, since Python 3.11+ lays out the attributes of plain
+ * Python objects more efficiently.
+ */
+
+typedef PyObject *(*method_impl)(PyObject *self, PyObject *arg);
+
+typedef struct {
+    PyObject_HEAD
+    method_impl impl;
+    const char *name;
+    const char *doc;
+#ifdef COAL_VECTORCALL
+    vectorcallfunc vectorcall;
+#endif
+} Method;
+
+static PyObject *
+method_wrong_arguments(Method *self)
+{
+    PyErr_Format(
+        PyExc_TypeError,
+        "%s() takes exactly one argument after self",
+        self->name
+    );
+    return NULL;
+}
+
+static PyObject *
+Method_call(Method *self, PyObject *args, PyObject *kwargs)
+{
+    if (
+        PyTuple_GET_SIZE(args) != 2 ||
+        (kwargs != NULL && PyDict_Size(kwargs) != 0)
+    ) {
+        return method_wrong_arguments(self);
+    }
+    return self->impl(PyTuple_GET_ITEM(args, 0), PyTuple_GET_ITEM(args, 1));
+}
+
+#ifdef COAL_VECTORCALL
+static PyObject *
+Method_vectorcall(
+    PyObject *self,
+    PyObject *const *args,
+    size_t nargsf,
+    PyObject *kwnames
+)
+{
+    if (
+        PyVectorcall_NARGS(nargsf) != 2 ||
+        (kwnames != NULL && PyTuple_GET_SIZE(kwnames) != 0)
+    ) {
+        return method_wrong_arguments((Method *)self);
+    }
+    return ((Method *)self)->impl(args[0], args[1]);
+}
+#endif
+
+static PyObject *
+Method_descr_get(PyObject *self, PyObject *obj, PyObject *type)
+{
+    if (obj == NULL || obj == Py_None) {
+        Py_INCREF(self);
+        return self;
+    }
+#if PY_MAJOR_VERSION >= 3
+    return PyMethod_New(self, obj);
+#else
+    return PyMethod_New(self, obj, type);
+#endif
+}
+
+static PyObject *
+Method_get_doc(Method *self, void *closure)
+{
+#if PY_MAJOR_VERSION >= 3
+    return PyUnicode_FromString(self->doc);
+#else
+    return PyString_FromString(self->doc);
+#endif
+}
+
+static PyObject *
+Method_get_name(Method *self, void *closure)
+{
+#if PY_MAJOR_VERSION >= 3
+    return PyUnicode_FromString(self->name);
+#else
+    return PyString_FromString(self->name);
+#endif
+}
+
+static PyGetSetDef Method_getset[] = {
+    {"__doc__", (getter)Method_get_doc, NULL, NULL, NULL},
+    {"__name__", (getter)Method_get_name, NULL, NULL, NULL},
+    {NULL, NULL, NULL, NULL, NULL}
+};
+
+static PyTypeObject MethodType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "coal._speedups.Method",                    /* tp_name */
+    sizeof(Method),                             /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    0,                                          /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    (ternaryfunc)Method_call,                   /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    0,                                          /* tp_doc */
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    0,                                          /* tp_methods */
+    0,                                          /* tp_members */
+    Method_getset,                              /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    Method_descr_get,                           /* tp_descr_get */
+};
+
+static int
+add_method(
+    PyObject *module,
+    const char *name,
+    method_impl impl,
+    const char *doc
+)
+{
+    Method *method = PyObject_New(Method, &MethodType);
+    if (method == NULL) {
+        return -1;
+    }
+    method->impl = impl;
+    method->name = name;
+    method->doc = doc;
+#ifdef COAL_VECTORCALL
+    method->vectorcall = Method_vectorcall;
+#endif
+    return PyModule_AddObject(module, name, (PyObject *)method);
+}
+
+
+/* The module */
+
+static PyObject *
+speedups_configure(PyObject *module, PyObject *args)
+{
+    PyObject *new_promise_type, *new_not_yet_resolved, *new_error;
+
+    if (!PyArg_ParseTuple(
+        args,
+        "OOO:configure",
+        &new_promise_type,
+        &new_not_yet_resolved,
+        &new_error
+    )) {
+        return NULL;
+    }
+    Py_XDECREF(promise_type);
+    Py_XDECREF(not_yet_resolved);
+    Py_XDECREF(duplicate_resolution_error);
+    Py_INCREF(new_promise_type);
+    promise_type = new_promise_type;
+    Py_INCREF(new_not_yet_resolved);
+    not_yet_resolved = new_not_yet_resolved;
+    Py_INCREF(new_error);
+    duplicate_resolution_error = new_error;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"configure", speedups_configure, METH_VARARGS,
+     "configure(promise_type, not_yet_resolved, duplicate_error)"},
+    {"chain", speedups_chain, METH_VARARGS,
+     "chain(result, callback): a callable that resolves the defer result "
+     "with what callback returns."},
+    {NULL, NULL, 0, NULL}
+};
+
+static int
+intern_strings(void)
+{
+#if PY_MAJOR_VERSION >= 3
+#define COAL_INTERN(var, name) \
+    if ((var = PyUnicode_InternFromString(name)) == NULL) return -1;
+#else
+#define COAL_INTERN(var, name) \
+    if ((var = PyString_InternFromString(name)) == NULL) return -1;
+#endif
+    COAL_INTERN(str_append, "append");
+    COAL_INTERN(str_assign_queue, "assign_queue");
+    COAL_INTERN(str_batch_key, "batch_key");
+    COAL_INTERN(str_coalesce_key, "coalesce_key");
+    COAL_INTERN(str_merge, "merge");
+    COAL_INTERN(str_merges, "merges");
+    COAL_INTERN(str_pending, "pending");
+    COAL_INTERN(str_priority, "priority");
+    COAL_INTERN(str_resolve, "resolve");
+    COAL_INTERN(str_subqueues, "subqueues");
+    COAL_INTERN(str_then, "then");
+    COAL_INTERN(str_value, "value");
+#undef COAL_INTERN
+    int_one = COAL_INT_FROM_LONG(1);
+    return int_one == NULL ? -1 : 0;
+}
+
+static int
+init_module(PyObject *module)
+{
+    MethodType.tp_dealloc = (destructor)PyObject_Del;
+#ifdef COAL_VECTORCALL
+    MethodType.tp_flags |= (
+        Py_TPFLAGS_HAVE_VECTORCALL | Py_TPFLAGS_METHOD_DESCRIPTOR
+    );
+    MethodType.tp_vectorcall_offset = offsetof(Method, vectorcall);
+    MethodType.tp_call = PyVectorcall_Call;
+    ChainType.tp_flags |= Py_TPFLAGS_HAVE_VECTORCALL;
+    ChainType.tp_vectorcall_offset = offsetof(Chain, vectorcall);
+    ChainType.tp_call = PyVectorcall_Call;
+#endif
+    if (
+        intern_strings() < 0 ||
+        PyType_Ready(&MethodType) < 0 ||
+        PyType_Ready(&ChainType) < 0
+    ) {
+        return -1;
+    }
+    if (
+        add_method(
+            module, "defer_resolve", defer_resolve,
+            "Resolve the defer with value, calling its pending callbacks."
+        ) < 0 ||
+        add_method(
+            module, "defer_add_callback", defer_add_callback,
+            "Call callback once the defer is resolved, or now if it is."
+        ) < 0 ||
+        add_method(
+            module, "queue_add_task", queue_add_task,
+            "Queue task, merging it into a matching queued task if there "
+            "is one."
+        ) < 0 ||
+        add_method(
+            module, "queue_add_tasks", queue_add_tasks,
+            "Queue all of tasks with the same effect as calling add_task "
+            "for each."
+        ) < 0
+    ) {
+        return -1;
+    }
+    return 0;
+}
+
+#if PY_MAJOR_VERSION >= 3
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "coal._speedups",
+    "C implementations of the hottest parts of coal.",
+    -1,
+    speedups_methods
+};
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    PyObject *module = PyModule_Create(&speedups_module);
+    if (module == NULL) {
+        return NULL;
+    }
+    if (init_module(module) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
+
+#else
+
+PyMODINIT_FUNC
+init_speedups(void)
+{
+    PyObject *module = Py_InitModule3(
+        "coal._speedups",
+        speedups_methods,
+        "C implementations of the hottest parts of coal."
+    );
+    if (module != NULL) {
+        init_module(module);
+    }
+}
+
+#endif
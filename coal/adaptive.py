@@ -0,0 +1,99 @@
+"""
+:py:mod:`coal.adaptive` builds on the basic functionality of
+:py:mod:`coal` to tune the batch size of each task type from the latency
+its batches are observed to have.
+
+Bigger batches mean fewer round-trips, but the right size depends on how
+the backend is coping at the moment. An :py:class:`AdaptiveBatchController`
+attached to a :py:class:`coal.TaskQueue` limits each task type's batches
+to a size that it adjusts with an additive-increase/multiplicative-decrease
+(AIMD) policy: each full batch that finished within the target latency
+grows the limit a little, and each batch that exceeded it cuts the limit
+by a fraction, always staying within the configured bounds. When a backend
+slows down the batches for it quickly shrink, keeping tail latency in
+check, and as it recovers they grow back to regain throughput.
+
+The controller is meant to be shared by the queues of many requests, so
+that it learns from all of them::
+
+    controller = AdaptiveBatchController(target_latency=0.05)
+
+    def handle_request():
+        queue = TaskQueue(batch_controller=controller)
+        ...
+"""
+
+import threading
+
+from coal import fork
+
+
+class AdaptiveBatchController(object):
+    """
+    Adjusts the batch size limit of each task type to keep its batches
+    within ``target_latency`` seconds, or within the latency given for it
+    in the dict ``target_latencies``.
+
+    Limits start at ``initial_size``, or at the task type's
+    :py:attr:`coal.Task.max_batch_size` if it has one, and are kept between
+    ``min_size`` and ``max_size``, and never above the task type's
+    :py:attr:`coal.Task.max_batch_size`. A batch that was full and on time adds
+    ``increase`` to its limit and a slow batch multiplies it by
+    ``decrease``.
+    """
+
+    def __init__(
+        self,
+        target_latency,
+        target_latencies=None,
+        min_size=1,
+        max_size=1000,
+        initial_size=100,
+        increase=1,
+        decrease=0.5,
+    ):
+        self.target_latency = target_latency
+        self.target_latencies = dict(target_latencies or {})
+        self.min_size = min_size
+        self.max_size = max_size
+        self.initial_size = initial_size
+        self.increase = increase
+        self.decrease = decrease
+        self.sizes = {}
+        self.lock = threading.Lock()
+        fork.register(self)
+
+    def after_fork_in_child(self):
+        # the batch sizes are kept, so that workers start with them.
+        self.lock = threading.Lock()
+
+    def _clamp(self, task_type, size):
+        size = max(self.min_size, min(self.max_size, int(size)))
+        limit = getattr(task_type, "max_batch_size", None)
+        if limit is not None and size > limit:
+            # a hard limit of the backend, which even min_size can't exceed.
+            size = limit
+        return size
+
+    def batch_size(self, task_type):
+        size = self.sizes.get(task_type)
+        if size is None:
+            size = task_type.max_batch_size
+            if size is None:
+                size = self.initial_size
+        return self._clamp(task_type, size)
+
+    def observe(self, task_type, count, seconds):
+        """
+        Take note that a batch of ``count`` tasks of ``task_type`` took
+        ``seconds`` to work.
+        """
+        target = self.target_latencies.get(task_type, self.target_latency)
+        with self.lock:
+            size = self.batch_size(task_type)
+            if seconds > target:
+                size = self._clamp(task_type, size * self.decrease)
+            elif count >= size:
+                # only grow when the limit was what held the batch back.
+                size = self._clamp(task_type, size + self.increase)
+            self.sizes[task_type] = size
@@ -0,0 +1,319 @@
+"""
+:py:mod:`coal.asynchronous` builds on the basic functionality of
+:py:mod:`coal` to provide a foundation for modelling tasks that
+run asynchronously and concurrently with other processing, as opposed to those
+that are run in synchronous batches.
+
+This sort of task is characterized by the work beginning in the background
+shortly after the task is instantiated, so in some cases the work may be
+done by the time the task makes it to the front of a job queue. The blocking
+"work" phase of the task is then simply to wait for the task to complete
+if it hasn't already.
+
+The :py:attr:`coal.TaskPriority.ASYNC_LOOKUP` task priority will cause tasks
+to run only after all `CACHE` and `SYNC_LOOKUP` tasks have completed, thus
+giving the background job the longest possible time to complete before we
+start to block on it.
+
+To keep a traffic spike from launching an unbounded amount of background
+work, a task type can be given an :py:class:`AdmissionController`. Tasks
+that arrive while it's at capacity don't start in the background, and are
+worked synchronously in their phase instead.
+
+Task types whose background work signals its completion, such as
+:py:class:`ThreadTask`, are resolved in the order they finish rather than
+the order they were queued. Once some have finished, if resolving them
+queued higher-priority followups (such as `SYNC_LOOKUP` tasks), the rest
+are handed back to the queue, so that those followups can be worked while
+the slower tasks carry on in the background. They're also handed back if
+the queue's time budget runs out while waiting for them, such as that of
+:py:func:`coal.flatten_promises` with optional promises.
+"""
+
+from coal import Task, TaskPriority, fork
+from coal._compat import reraise
+
+import sys
+import threading
+
+
+# notified whenever an asynchronous task's background work completes.
+_completion = threading.Condition()
+
+
+def _reset_completion():
+    # a thread in the parent may have held it when the process forked.
+    global _completion
+    _completion = threading.Condition()
+
+
+fork.at_fork(after_in_child=_reset_completion)
+
+
+class AdmissionController(object):
+    """
+    Limits how many asynchronous tasks can be working in the background at
+    once, both overall (``max_in_flight``) and for each task type (the dict
+    ``type_limits``). Either can be None for no limit.
+
+    An :py:class:`AsyncTask` type uses a controller assigned to its
+    :py:attr:`AsyncTask.admission` attribute. The tasks that are turned
+    away don't start working in the background, and are instead worked
+    synchronously when their phase comes around. The number of tasks that
+    were admitted and deferred is kept in :py:attr:`admitted` and
+    :py:attr:`deferred`, both overall and in dicts keyed by task type.
+    """
+
+    def __init__(self, max_in_flight=None, type_limits=None):
+        self.max_in_flight = max_in_flight
+        self.type_limits = dict(type_limits or {})
+        self.in_flight = 0
+        self.in_flight_by_type = {}
+        self.admitted = 0
+        self.admitted_by_type = {}
+        self.deferred = 0
+        self.deferred_by_type = {}
+        self.lock = threading.Lock()
+        fork.register(self)
+
+    def try_admit(self, task_type):
+        """
+        Returns whether a task of ``task_type`` may start working now, in
+        which case :py:meth:`release` must be called once it's done.
+        """
+        with self.lock:
+            type_in_flight = self.in_flight_by_type.get(task_type, 0)
+            type_limit = self.type_limits.get(task_type)
+            if (
+                (
+                    self.max_in_flight is not None and
+                    self.in_flight >= self.max_in_flight
+                ) or
+                (type_limit is not None and type_in_flight >= type_limit)
+            ):
+                self.deferred += 1
+                self.deferred_by_type[task_type] = (
+                    self.deferred_by_type.get(task_type, 0) + 1
+                )
+                return False
+
+            self.in_flight += 1
+            self.in_flight_by_type[task_type] = type_in_flight + 1
+            self.admitted += 1
+            self.admitted_by_type[task_type] = (
+                self.admitted_by_type.get(task_type, 0) + 1
+            )
+            return True
+
+    def release(self, task_type):
+        with self.lock:
+            self.in_flight -= 1
+            self.in_flight_by_type[task_type] -= 1
+
+    def after_fork_in_child(self):
+        # the tasks in flight are the parent's, and won't finish here.
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.in_flight_by_type = {}
+
+
+class AsyncTask(Task):
+    priority = TaskPriority.ASYNC_LOOKUP
+    # an AdmissionController to limit how many tasks of this type can work
+    # in the background at once, or None for no limit.
+    admission = None
+    # whether start_working calls its callback from the background as soon
+    # as the work is done, rather than only when wait_for_result is called,
+    # so that tasks can be resolved in the order they complete.
+    notifies_completion = False
+
+    def __init__(self):
+        super(AsyncTask, self).__init__()
+
+        self.started = False
+        self.completed = False
+        admission = self.admission
+        if admission is None:
+            self._start(None)
+        elif admission.try_admit(type(self)):
+            self._start(admission)
+
+    def _start(self, admission):
+        def callback(value):
+            self.background_result = value
+            self._mark_completed()
+
+        self.started = True
+        # the controller whose slot this task holds until it completes.
+        self._admission = admission
+        try:
+            self.start_working(callback)
+        except Exception:
+            self._admission = None
+            if admission is not None:
+                admission.release(type(self))
+            raise
+
+    def _mark_completed(self):
+        # Called once the background work is done, whether it succeeded or
+        # not, and maybe more than once.
+        with _completion:
+            if self.completed:
+                return
+            admission = self._admission
+            if admission is not None:
+                self._admission = None
+                admission.release(type(self))
+            self.completed = True
+            _completion.notify_all()
+
+    def start_working(self, callback):
+        """
+        Start the work in the background, arranging for ``callback`` to be
+        called with its result. Implementations should call ``callback`` as
+        soon as the work is over, even if it failed, since the task holds
+        its admission slot until then, or until :py:meth:`wait_for_result`
+        has returned.
+        """
+        raise Exception('start_working is not implemented for %r' % (
+            self
+        ))
+
+    def wait_for_result(self):
+        raise Exception('wait_for_completion is not implemented for %r' % (
+            self
+        ))
+
+    def _wait(self):
+        try:
+            self.wait_for_result()
+        finally:
+            # the work is over once it's been waited for, even if it failed
+            # without calling its callback, so give back its slot.
+            self._mark_completed()
+
+    @classmethod
+    def work_synchronously(cls, tasks):
+        """
+        Work the tasks that weren't admitted to work in the background.
+        By default they're started and waited for one at a time, but
+        task types that can do better in a batch can override this.
+        """
+        for task in tasks:
+            task._start(None)
+            task._wait()
+            task._resolve_background_result()
+
+    @classmethod
+    def work(cls, tasks):
+        deferred = [task for task in tasks if not task.started]
+        started = [task for task in tasks if task.started]
+
+        # Work the deferred tasks first, so the started ones get as long as
+        # possible to finish in the background.
+        if deferred:
+            cls.work_synchronously(deferred)
+
+        if not cls.notifies_completion:
+            # The "work" phase is just to wait for all of the tasks to
+            # complete. Since async jobs happen in their own phase we
+            # assume that it doesn't really matter what order we block on
+            # them in, since we're always gonna wait for the longest one to
+            # complete before we work on anything else.
+            for task in started:
+                task._wait()
+                task._resolve_background_result()
+            return
+
+        if not started:
+            return
+        queue = started[0].queue
+        # the queue's time budget, if it has one, is checked whenever it
+        # might have run out.
+        budget = queue.budget
+        remaining = started
+        while remaining:
+            timeout = None
+            if budget is not None:
+                timeout = budget.remaining()
+            if timeout is None or timeout > 0:
+                cls._wait_for_completion(remaining, timeout)
+            done = []
+            still_running = []
+            for task in remaining:
+                if task.completed:
+                    done.append(task)
+                else:
+                    still_running.append(task)
+
+            if not done:
+                if budget is not None and budget.expired():
+                    # nothing's waiting on the rest any more, so leave
+                    # them to finish in the background.
+                    queue.requeue(remaining)
+                    return
+                continue
+
+            for task in done:
+                task._wait()
+                task._resolve_background_result()
+            remaining = still_running
+
+            if remaining and queue.has_work_before(cls.priority):
+                # let the followups of the finished tasks go ahead while
+                # the rest keep working in the background.
+                queue.requeue(remaining)
+                return
+
+    @classmethod
+    def _wait_for_completion(cls, tasks, timeout):
+        # Returns once any of tasks has completed, or after timeout seconds
+        # if it isn't None, or sooner if another task completes meanwhile.
+        with _completion:
+            for task in tasks:
+                if task.completed:
+                    return
+            _completion.wait(timeout)
+
+    def _resolve_background_result(self):
+        error = getattr(self, "background_error", None)
+        if error is not None:
+            self.background_error = None
+            reraise(*error)
+        try:
+            result = self.background_result
+        except AttributeError:
+            raise Exception('Async task %r did not complete' % self)
+        self.resolve(result)
+
+
+class ThreadTask(AsyncTask):
+    notifies_completion = True
+
+    def start_working(self, callback):
+        def impl():
+            try:
+                callback(self.thread_work())
+            except BaseException:
+                # raised by _resolve_background_result, in the thread
+                # that's waiting for the result.
+                self.background_error = sys.exc_info()
+            finally:
+                # so that work doesn't wait forever for a failed task.
+                self._mark_completed()
+        self.thread = threading.Thread(
+            target=impl
+        )
+        self.thread.start()
+
+    def wait_for_result(self):
+        self.thread.join()
+
+    def thread_work(self):
+        raise Exception('thread_work is not implemented for %r' % self)
+
+    @classmethod
+    def work_synchronously(cls, tasks):
+        # No need for a thread if we're going to wait for it anyway.
+        for task in tasks:
+            task.resolve(task.thread_work())
@@ -0,0 +1,501 @@
+"""
+:py:mod:`coal.backends` builds on the basic functionality of
+:py:mod:`coal` to manage the connections that tasks use to reach their
+backends, so that the batches of a request (and of later requests) share
+warm connections rather than each connecting for itself.
+
+A :py:class:`Backend` owns a :py:class:`ConnectionPool` of connections to
+one service. A task type binds to a backend by subclassing
+:py:class:`BackendTask` and implementing
+:py:meth:`BackendTask.work_with_connection`, which is then given a pooled
+connection for each batch and returns the values of its tasks. The tasks
+are resolved once the connection is back in the pool. Idle connections
+are handed out most recently used first, so the batches of consecutive
+phases reuse the same few connections, and connections that have been
+idle for a while are health checked before they're reused.
+
+As a reference, :py:class:`KeyValueBackend` talks to a simple line-based
+key-value protocol in the style of memcached, with
+:py:class:`KeyValueGetTask` and :py:class:`KeyValueSetTask` to read and
+write it in batches. :py:class:`KeyValueServer` implements the protocol
+in memory as a local stand-in for a real cache server. Values are pickled
+on their way to the server and unpickled when they're read back, so only
+point a :py:class:`KeyValueBackend` at a server you trust, since whoever
+can write to it can run code in every process that reads from it.
+"""
+
+import contextlib
+import socket
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from coal import Task, TaskPriority, fork
+from coal._compat import PY2, iteritems
+from coal.caching import CACHE_MISS
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+def _decode(data):
+    # strings are bytes on Python 2, so they're left as they are there.
+    if PY2:
+        return data
+    return data.decode("utf-8")
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to ``max_size`` connections made by calling ``connect``.
+
+    Connections that have been idle for more than ``check_interval``
+    seconds are passed to ``health_check``, if given, before being handed
+    out again, and are discarded if it returns false or raises. Those idle
+    for more than ``max_idle_time`` seconds are discarded without a check.
+    Connections are closed by calling ``close`` on them.
+    """
+
+    def __init__(
+        self,
+        connect,
+        max_size=10,
+        health_check=None,
+        check_interval=30,
+        max_idle_time=None,
+        acquire_timeout=None,
+    ):
+        self.connect = connect
+        self.max_size = max_size
+        self.health_check = health_check
+        self.check_interval = check_interval
+        self.max_idle_time = max_idle_time
+        self.acquire_timeout = acquire_timeout
+        # (connection, time it was released) pairs, most recent last.
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
+        self.created = 0
+        self.discarded = 0
+        fork.register(self)
+
+    def acquire(self):
+        deadline = None
+        if self.acquire_timeout is not None:
+            deadline = time.time() + self.acquire_timeout
+
+        with self.condition:
+            while True:
+                if self.idle:
+                    conn, released = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    # reserve a slot, then connect outside of the lock.
+                    self.size += 1
+                    conn = None
+                    break
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhaustedError(
+                            "No connection available after %s seconds" % (
+                                self.acquire_timeout
+                            )
+                        )
+                    self.condition.wait(remaining)
+
+        if conn is not None:
+            if self._usable(conn, time.time() - released):
+                return conn
+            # replace it with a new connection in the same slot.
+            self.discarded += 1
+            self._close(conn)
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        self.created += 1
+        return conn
+
+    def _usable(self, conn, idle_time):
+        if self.max_idle_time is not None and idle_time > self.max_idle_time:
+            return False
+        if self.health_check is not None and idle_time > self.check_interval:
+            try:
+                return self.health_check(conn)
+            except Exception:
+                return False
+        return True
+
+    def _discard(self, conn):
+        with self.condition:
+            self.size -= 1
+            self.discarded += 1
+            self.condition.notify()
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def release(self, conn, broken=False):
+        """
+        Return ``conn`` to the pool, or close it if it's ``broken``.
+        """
+        if broken:
+            self._discard(conn)
+            return
+        with self.condition:
+            self.idle.append((conn, time.time()))
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        A context manager that acquires a connection and releases it
+        afterwards, closing it instead if the block raised.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, broken=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        """
+        Close all of the idle connections.
+        """
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for conn, released in idle:
+            self._close(conn)
+
+    def before_fork(self):
+        self.close()
+
+    def after_fork_in_child(self):
+        # the connections are the parent's, which may still be using them,
+        # and those that other threads had acquired won't be released here.
+        # Closing our copies of the idle ones doesn't disconnect the parent.
+        idle = self.idle
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+        for conn, released in idle:
+            self._close(conn)
+
+
+class Backend(object):
+    """
+    Base class for a service that tasks talk to through pooled
+    connections. Subclasses implement :py:meth:`connect` and optionally
+    :py:meth:`check`. Keyword arguments are passed on to the
+    :py:class:`ConnectionPool`.
+    """
+
+    def __init__(self, **pool_options):
+        self.pool = ConnectionPool(
+            self.connect,
+            health_check=self.check,
+            **pool_options
+        )
+
+    def connect(self):
+        raise NotImplementedError(
+            'connect not implemented for %r' % self
+        )
+
+    def check(self, conn):
+        return True
+
+    def connection(self):
+        return self.pool.connection()
+
+    def close(self):
+        self.pool.close()
+
+
+class BackendTask(Task):
+    """
+    Base class for task types that work their batches using a connection
+    to :py:attr:`backend`.
+    """
+    backend = None
+
+    @classmethod
+    def work_with_connection(cls, conn, tasks):
+        """
+        Look up ``tasks`` using ``conn``, returning a sequence of their
+        values in the same order.
+        """
+        raise NotImplementedError(
+            'work_with_connection not implemented for %r' % cls
+        )
+
+    @classmethod
+    def work(cls, tasks):
+        if cls.backend is None:
+            raise Exception('backend not set for %r' % cls)
+        with cls.backend.connection() as conn:
+            values = cls.work_with_connection(conn, tasks)
+        # resolved once the connection is back in the pool, so that a
+        # callback that raises doesn't have it thrown away as broken.
+        cls.resolve_many(tasks, values)
+
+
+class KeyValueProtocolError(Exception):
+    pass
+
+
+class KeyValueConnection(object):
+    """
+    A connection speaking the key-value protocol of
+    :py:class:`KeyValueServer`. Keys are strings without whitespace, and
+    values can be anything picklable, such as the sentinels of
+    :py:mod:`coal.caching`.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def _send(self, data):
+        self.sock.sendall(data)
+
+    def _read_line(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise KeyValueProtocolError("Connection closed")
+        return _decode(line[:-2])
+
+    def get_multi(self, keys):
+        """
+        Returns a dict of the values of those of ``keys`` that are set.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        self._send(_encode("GET %s\r\n" % " ".join(keys)))
+        values = {}
+        while True:
+            line = self._read_line()
+            if line == "END":
+                return values
+            parts = line.split(" ")
+            if len(parts) != 3 or parts[0] != "VALUE":
+                raise KeyValueProtocolError("Unexpected %r" % line)
+            data = self.reader.read(int(parts[2]) + 2)
+            values[parts[1]] = pickle.loads(data[:-2])
+
+    def set_multi(self, mapping, ttl=None):
+        """
+        Sets each key of ``mapping`` to its value, expiring after ``ttl``
+        seconds if given. A ``ttl`` of 0 or None means they never expire.
+        """
+        expiry = ""
+        if ttl:
+            expiry = " %i" % ttl
+        for key, value in iteritems(mapping):
+            value = pickle.dumps(value, 2)
+            self._send(
+                _encode("SET %s %i%s\r\n" % (key, len(value), expiry)) +
+                value + b"\r\n"
+            )
+        for key in mapping:
+            line = self._read_line()
+            if line != "STORED":
+                raise KeyValueProtocolError("Unexpected %r" % line)
+
+    def ping(self):
+        self._send(b"PING\r\n")
+        return self._read_line() == "PONG"
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class KeyValueBackend(Backend):
+    """
+    A :py:class:`Backend` for a server speaking the protocol of
+    :py:class:`KeyValueServer` at ``address``, a ``(host, port)`` pair.
+    """
+
+    def __init__(self, address, timeout=5, **pool_options):
+        self.address = address
+        self.timeout = timeout
+        super(KeyValueBackend, self).__init__(**pool_options)
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return KeyValueConnection(sock)
+
+    def check(self, conn):
+        return conn.ping()
+
+
+class KeyValueGetTask(BackendTask):
+    """
+    Gets a key from a :py:class:`KeyValueBackend`, resolving with
+    :py:data:`coal.caching.CACHE_MISS` if it isn't set. Subclasses set
+    :py:attr:`backend`.
+    """
+    priority = TaskPriority.CACHE
+
+    def __init__(self, key):
+        self.key = key
+        super(KeyValueGetTask, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    @classmethod
+    def work_with_connection(cls, conn, tasks):
+        values = conn.get_multi(task.key for task in tasks)
+        return [values.get(task.key, CACHE_MISS) for task in tasks]
+
+
+class KeyValueSetTask(BackendTask):
+    """
+    Sets a key on a :py:class:`KeyValueBackend`, expiring after ``ttl``
+    seconds if given and not 0, so it can serve as the update task of a
+    cache tier for :py:func:`coal.caching.cache_lookup_promise`. Subclasses
+    set :py:attr:`backend`.
+    """
+    priority = TaskPriority.CLEANUP
+
+    def __init__(self, key, value, ttl=None):
+        self.key = key
+        self.value = value
+        self.ttl = ttl
+        super(KeyValueSetTask, self).__init__()
+
+    @property
+    def batch_key(self):
+        # the keys of a batch are all set with the same ttl.
+        return self.ttl
+
+    @classmethod
+    def work_with_connection(cls, conn, tasks):
+        conn.set_multi(
+            dict((task.key, task.value) for task in tasks),
+            ttl=tasks[0].ttl,
+        )
+        return [None] * len(tasks)
+
+
+class _KeyValueHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        data = self.server.data
+        expiries = self.server.expiries
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = _decode(line.strip()).split(" ")
+            command = parts[0]
+            if command == "GET":
+                response = []
+                for key in parts[1:]:
+                    expiry = expiries.get(key)
+                    if expiry is not None and expiry <= time.time():
+                        data.pop(key, None)
+                        expiries.pop(key, None)
+                    if key in data:
+                        value = data[key]
+                        response.append(
+                            _encode("VALUE %s %i\r\n" % (key, len(value))) +
+                            value + b"\r\n"
+                        )
+                response.append(b"END\r\n")
+                self.wfile.write(b"".join(response))
+            elif command == "SET":
+                value = self.rfile.read(int(parts[2]) + 2)[:-2]
+                data[parts[1]] = value
+                if len(parts) > 3 and int(parts[3]):
+                    expiries[parts[1]] = time.time() + int(parts[3])
+                else:
+                    expiries.pop(parts[1], None)
+                self.wfile.write(b"STORED\r\n")
+            elif command == "PING":
+                self.wfile.write(b"PONG\r\n")
+            else:
+                self.wfile.write(b"ERROR\r\n")
+            self.wfile.flush()
+
+
+class KeyValueServer(socketserver.ThreadingTCPServer):
+    """
+    An in-memory server for the key-value protocol, as a local stand-in for
+    a real cache server. Values are kept in :py:attr:`data` as the bytes
+    they were sent as, and expire if they were set with a non-zero ttl.
+    Counts the connections it accepts in :py:attr:`connections`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        socketserver.ThreadingTCPServer.__init__(
+            self,
+            address,
+            _KeyValueHandler,
+        )
+        self.data = {}
+        # key -> the time.time() at which it expires.
+        self.expiries = {}
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        socketserver.ThreadingTCPServer.process_request(
+            self,
+            request,
+            client_address,
+        )
+
+    def start(self):
+        """
+        Serve from a background thread, returning the address to connect
+        to.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -20,6 +20,17 @@ a key from `Memcached <http://memcached.org/>` (or similar) using its
 `get_multi` command, allowing as much as possible to be retrieved in a single
 cache round-trip and then the few misses to be handled via a more expensive
 lookup, eventually writing the results back to memcached using `set_multi`.
+Where there are several caches, such as a process-local cache in front of
+memcached, :py:func:`cache_hierarchy_promise` tries each in turn.
+
+Items that don't exist at all would otherwise miss the cache every time and
+be looked up again on every request. To avoid that, real lookups can
+resolve with :py:data:`KNOWN_ABSENT`, which is cached like any other value
+and, when it's found in the cache, returned without doing the real lookup.
+Similarly, real lookups that fail can resolve with a
+:py:class:`LookupFailed` rather than raising, which can be cached briefly
+to shed load from a backend that's having trouble. Both sentinels survive
+being pickled, so they can be stored in the usual caches.
 """
 
 
@@ -32,10 +43,47 @@ CACHE_MISS = CacheMiss()
 del CacheMiss  # Don't need the class anymore, just the instance.
 
 
+# and another to signal that an item is known not to exist.
+class KnownAbsent(object):
+    def __reduce__(self):
+        # unpickle as the singleton rather than as a copy of it.
+        return "KNOWN_ABSENT"
+
+    def __repr__(self):
+        return "KNOWN_ABSENT"
+
+KNOWN_ABSENT = KnownAbsent()
+del KnownAbsent
+
+
+class LookupFailed(object):
+    """
+    The result of a lookup that failed with ``error``, typically a message
+    or an exception.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+    def __eq__(self, other):
+        return isinstance(other, LookupFailed) and self.error == other.error
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((LookupFailed, self.error))
+
+    def __repr__(self):
+        return "LookupFailed(%r)" % (self.error,)
+
+
 def cache_lookup_promise(
     cache_lookup_task,
     real_lookup_task,
-    cache_update_task_builder=None
+    cache_update_task_builder=None,
+    negative_ttl=None,
+    error_ttl=None,
 ):
     """
     A helper function to construct a typical task graph to handle
@@ -47,21 +95,98 @@ def cache_lookup_promise(
 
     Can also optionally include a final task to write the result from the
     "real" lookup back to the cache, so the value will be cached for next time.
+
+    If ``negative_ttl`` is given, a :py:data:`KNOWN_ABSENT` result is cached
+    by calling ``cache_update_task_builder(KNOWN_ABSENT, ttl=negative_ttl)``
+    so that it can expire sooner than other values. A
+    :py:class:`LookupFailed` result is only cached if ``error_ttl`` is
+    given, in the same way. Either way, these results are returned as they
+    are for the caller to check for.
     """
-    def handle_cache_result(value):
-        if value is CACHE_MISS:
+    return cache_hierarchy_promise(
+        [(cache_lookup_task, cache_update_task_builder)],
+        real_lookup_task,
+        negative_ttl=negative_ttl,
+        error_ttl=error_ttl,
+    )
+
+
+def cache_hierarchy_promise(
+    tiers,
+    real_lookup_task,
+    negative_ttl=None,
+    error_ttl=None,
+):
+    """
+    Like :py:func:`cache_lookup_promise`, but for a hierarchy of caches,
+    such as a process-local cache in front of memcached in front of a
+    regional cache.
+
+    ``tiers`` is a list of ``(cache_lookup_task, cache_update_task_builder)``
+    pairs, fastest first, where the builder may be ``None`` for a tier that
+    shouldn't be written to. Each tier is only tried if all of the tiers
+    before it missed, so when many items are looked up at once each tier's
+    batch has just the items that are still missing. A value found in a
+    tier, or by the real lookup, is written back to all of the tiers
+    before it, which with cleanup-priority update tasks happens in batches
+    at the end.
+    """
+    tiers = list(tiers)
+
+    def backfill(from_task, value, tier_count):
+        for cache_lookup_task, cache_update_task_builder in tiers[:tier_count]:
+            if cache_update_task_builder is None:
+                continue
+            update_task = _cache_update_task(
+                cache_update_task_builder,
+                value,
+                negative_ttl,
+                error_ttl,
+            )
+            if update_task is not None:
+                from_task.followup(update_task)
+
+    def lookup(index, previous_task):
+        if index == len(tiers):
             # need to do the real lookup, then
             def handle_load_result(value):
-                if cache_update_task_builder is not None:
-                    real_lookup_task.followup(
-                        cache_update_task_builder(value)
-                    )
+                backfill(real_lookup_task, value, len(tiers))
 
             real_lookup_task.then(handle_load_result)
-            cache_lookup_task.followup(real_lookup_task)
+            if previous_task is not None:
+                previous_task.followup(real_lookup_task)
             return real_lookup_task.promise
-        else:
-            # we can just return the value we got from the cache
-            return value
 
-    return cache_lookup_task.then(handle_cache_result)
+        cache_lookup_task = tiers[index][0]
+
+        def handle_cache_result(value):
+            if value is CACHE_MISS:
+                return lookup(index + 1, cache_lookup_task)
+            else:
+                # we can just return the value we got from the cache,
+                # once the faster caches have a copy of it too.
+                backfill(cache_lookup_task, value, index)
+                return value
+
+        if previous_task is not None:
+            previous_task.followup(cache_lookup_task)
+        return cache_lookup_task.then(handle_cache_result)
+
+    return lookup(0, None)
+
+
+def _cache_update_task(
+    cache_update_task_builder,
+    value,
+    negative_ttl,
+    error_ttl,
+):
+    # Builds the task to cache value, or returns None if it shouldn't be.
+    if value is KNOWN_ABSENT and negative_ttl is not None:
+        return cache_update_task_builder(value, ttl=negative_ttl)
+    elif isinstance(value, LookupFailed):
+        if error_ttl is None:
+            return None
+        return cache_update_task_builder(value, ttl=error_ttl)
+    else:
+        return cache_update_task_builder(value)
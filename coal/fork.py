@@ -0,0 +1,130 @@
+"""
+:py:mod:`coal.fork` builds on the basic functionality of :py:mod:`coal` to
+make its long-lived objects safe to share with processes forked from the
+one that created them, as prefork servers do with their workers.
+
+A forked child has a copy of its parent's memory but only the thread that
+forked. Locks that another thread held at the time stay held forever, the
+background work of asynchronous tasks and the connections of other
+threads don't exist, and sockets and files are shared with the parent.
+So in the child, coal's objects reset what can't be shared:
+
+* admission controllers forget the tasks in flight in the parent,
+* connection pools drop the parent's connections and connect afresh,
+* result stores open their own handle on the file, so its offset isn't
+  shared with the parent (a store should still have only one writer, so
+  workers should open it read-only if the parent, or another worker,
+  writes to it),
+* trace writers name requests after the child's own pid,
+
+and every lock is replaced. What's safe to share is kept, so workers
+start warm: a result store's index and memory-mapped pages, a
+:py:class:`coal.prefetch.Prefetcher`'s profiles and a
+:py:class:`coal.adaptive.AdaptiveBatchController`'s batch sizes.
+
+On Python 3.7+ this happens automatically through
+:py:func:`os.register_at_fork`. Elsewhere, call
+:py:func:`after_fork_in_child` from the server's post-fork hook, such as
+gunicorn's ``post_fork`` (it does nothing if it has already run in this
+process, so it's also safe to call on 3.7+).
+
+Caches can be warmed in the parent before forking with functions
+registered by :py:func:`warmer`, which :py:func:`prepare_to_fork` runs
+before readying coal's objects to be forked::
+
+    @coal.fork.warmer
+    def warm_prefetcher():
+        for data in sample_requests():
+            prefetcher.flatten_promises("home", data)
+
+    # in the server's pre-fork hook, or before forking workers:
+    coal.fork.prepare_to_fork()
+"""
+
+import gc
+import os
+import weakref
+
+
+# objects with after_fork_in_child methods, and maybe before_fork methods.
+_objects = weakref.WeakSet()
+# (before, after_in_child) pairs of functions.
+_callbacks = []
+_warmers = []
+# the process that coal's objects were last readied for.
+_pid = os.getpid()
+
+
+def register(obj):
+    """
+    Have ``obj.after_fork_in_child()`` called in forked children, and
+    ``obj.before_fork()``, if it has one, by :py:func:`prepare_to_fork`.
+    Only a weak reference to ``obj`` is kept. Returns ``obj``.
+    """
+    _objects.add(obj)
+    return obj
+
+
+def at_fork(before=None, after_in_child=None):
+    """
+    Like :py:func:`os.register_at_fork`, for module-level state: calls
+    ``before()`` in :py:func:`prepare_to_fork` and ``after_in_child()`` in
+    forked children.
+    """
+    _callbacks.append((before, after_in_child))
+
+
+def warmer(func):
+    """
+    Register ``func`` to be called by :py:func:`prepare_to_fork`, to fill
+    caches that forked children will share. Returns ``func``, so it can be
+    used as a decorator.
+    """
+    _warmers.append(func)
+    return func
+
+
+def prepare_to_fork():
+    """
+    Run the registered warmers, then ready coal's objects to be forked.
+    Connection pools close their idle connections, so that children don't
+    inherit sockets they can't use.
+
+    On Python 3.7+ this also moves everything allocated so far out of the
+    view of the cycle collector with :py:func:`gc.freeze`, so collections
+    in children don't write to, and so copy, the pages of the warm caches
+    they share with the parent.
+    """
+    for func in list(_warmers):
+        func()
+    for before, after_in_child in list(_callbacks):
+        if before is not None:
+            before()
+    for obj in list(_objects):
+        before_fork = getattr(obj, "before_fork", None)
+        if before_fork is not None:
+            before_fork()
+    if hasattr(gc, "freeze"):
+        gc.collect()
+        gc.freeze()
+
+
+def after_fork_in_child():
+    """
+    Reset the state of coal's objects that can't be shared with the
+    parent process. Does nothing if it has already run in this process.
+    """
+    global _pid
+    pid = os.getpid()
+    if pid == _pid:
+        return
+    _pid = pid
+    for before, after_in_child in list(_callbacks):
+        if after_in_child is not None:
+            after_in_child()
+    for obj in list(_objects):
+        obj.after_fork_in_child()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=after_fork_in_child)
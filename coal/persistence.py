@@ -0,0 +1,265 @@
+"""
+:py:mod:`coal.persistence` builds on the basic functionality of
+:py:mod:`coal` to keep task results on disk, so that a process that
+restarts (or another process on the same host) starts with a warm result
+cache rather than a cold one.
+
+A :py:class:`ResultStore` given as the ``result_store`` of a
+:py:class:`coal.TaskQueue` is consulted for results that the queue doesn't
+already know, and records the results of task types that set
+:py:attr:`coal.Task.persist_results`::
+
+    store = ResultStore("/var/cache/myapp/results")
+
+    def run_job():
+        queue = TaskQueue(result_store=store)
+        ...
+
+The store is a single append-only file of pickled results, each keyed by
+the task type's name and the pickled ``(batch_key, coalesce_key)`` of the
+task. The file is memory-mapped and only the keys are read when it's
+opened, so loading a large store is fast and each value is unpickled only
+when it's asked for. Values, batch keys and coalesce keys must be
+picklable, and equal keys must pickle the same, which is the case for the
+usual strings, numbers and tuples of them.
+
+A store should have only one writer, but any number of processes can open
+it with ``readonly=True`` to share the same pages of the file, calling
+:py:meth:`ResultStore.refresh` to see what's been written since. When a
+store grows beyond ``max_size`` bytes it's compacted into a new file
+holding only the most recently written results.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from coal import fork
+
+
+_HEADER = b"COALRS1\n"
+# the lengths of the key and the value that follow.
+_RECORD = struct.Struct("!II")
+
+
+def _serialize_key(result_key):
+    task_type, batch_key, coalesce_key = result_key
+    return (
+        ("%s.%s\n" % (task_type.__module__, task_type.__name__)).encode(
+            "utf-8"
+        ) + pickle.dumps((batch_key, coalesce_key), 2)
+    )
+
+
+class ResultStoreError(Exception):
+    pass
+
+
+class ResultStore(object):
+    """
+    A file-backed map of task results at ``path``, which is created if it
+    doesn't exist unless the store is ``readonly``.
+
+    If ``max_size`` is given, then whenever the file grows beyond it the
+    store is compacted to the most recently written results that fit in
+    ``compact_to`` times ``max_size`` bytes, leaving room to grow before the
+    next compaction. The most recent result is always kept, however large.
+    """
+
+    def __init__(self, path, max_size=None, compact_to=0.5, readonly=False):
+        self.path = path
+        self.max_size = max_size
+        self.compact_to = compact_to
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._open()
+        fork.register(self)
+
+    def _open(self):
+        if self.readonly:
+            self._file = open(self.path, "rb")
+        else:
+            self._file = open(self.path, "a+b")
+            self._file.seek(0, os.SEEK_END)
+            if self._file.tell() == 0:
+                self._file.write(_HEADER)
+                self._file.flush()
+        self._file.seek(0)
+        if self._file.read(len(_HEADER)) != _HEADER:
+            self._file.close()
+            raise ResultStoreError("%s isn't a result store" % self.path)
+
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        # maps each serialized key to the (offset, length) of its latest
+        # value, least recently written first.
+        self.index = collections.OrderedDict()
+        self._map = None
+        self._mapped_size = 0
+        self._scanned = len(_HEADER)
+        self._scan()
+        if not self.readonly and self._scanned < self._mapped_size:
+            # drop what's left of a record that was never finished, so
+            # that new records follow on from the last complete one.
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+            self._file.truncate(self._scanned)
+
+    def _remap(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size > self._mapped_size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(
+                self._file.fileno(),
+                size,
+                access=mmap.ACCESS_READ,
+            )
+            self._mapped_size = size
+
+    def _scan(self):
+        # Indexes the records after those already scanned, reading just
+        # their keys.
+        self._remap()
+        data = self._map
+        end = self._mapped_size
+        index = self.index
+        offset = self._scanned
+        while offset + _RECORD.size <= end:
+            key_length, value_length = _RECORD.unpack_from(data, offset)
+            key_start = offset + _RECORD.size
+            value_start = key_start + key_length
+            if value_start + value_length > end:
+                # the writer hasn't finished writing this one yet.
+                break
+            key = data[key_start:value_start]
+            index.pop(key, None)
+            index[key] = (value_start, value_length)
+            offset = value_start + value_length
+        self._scanned = offset
+
+    def refresh(self):
+        """
+        Pick up the results written by another process since the store was
+        opened or last refreshed, reopening the file if it's been compacted.
+        """
+        with self.lock:
+            if os.stat(self.path).st_ino != self._inode:
+                self._close()
+                self._open()
+            else:
+                self._scan()
+
+    def get(self, result_key, default=None):
+        """
+        Returns the stored value for ``result_key``, a ``(task_type,
+        batch_key, coalesce_key)`` triple, or ``default`` if there isn't
+        one.
+        """
+        key = _serialize_key(result_key)
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return default
+            start, length = location
+            if start + length > self._mapped_size:
+                self._remap()
+            data = self._map[start:start + length]
+        return pickle.loads(data)
+
+    def __contains__(self, result_key):
+        return _serialize_key(result_key) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def put(self, result_key, value):
+        """
+        Store ``value`` as the result for ``result_key``.
+        """
+        if self.readonly:
+            raise ResultStoreError("%s is open read-only" % self.path)
+        key = _serialize_key(result_key)
+        data = pickle.dumps(value, 2)
+        with self.lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(_RECORD.pack(len(key), len(data)) + key + data)
+            self._file.flush()
+            value_start = offset + _RECORD.size + len(key)
+            self.index.pop(key, None)
+            self.index[key] = (value_start, len(data))
+            self._scanned = value_start + len(data)
+            if self.max_size is not None and self._scanned > self.max_size:
+                self._compact()
+
+    def compact(self):
+        """
+        Rewrite the file with just the latest result for each key, and
+        only as many of those as fit within the size bound if there is one.
+        """
+        if self.readonly:
+            raise ResultStoreError("%s is open read-only" % self.path)
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        self._remap()
+        limit = None
+        if self.max_size is not None:
+            limit = int(self.max_size * self.compact_to)
+
+        # keep the most recently written records that fit, and the most
+        # recent one even if it doesn't, since it's just been put.
+        kept = []
+        size = len(_HEADER)
+        for key, (start, length) in reversed(self.index.items()):
+            record_size = _RECORD.size + len(key) + length
+            if kept and limit is not None and size + record_size > limit:
+                break
+            kept.append((key, start, length))
+            size += record_size
+
+        temp_path = self.path + ".compacting"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(_HEADER)
+            for key, start, length in reversed(kept):
+                temp_file.write(_RECORD.pack(len(key), length))
+                temp_file.write(key)
+                temp_file.write(self._map[start:start + length])
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        # readers that still have the old file open keep reading it until
+        # they refresh.
+        os.rename(temp_path, self.path)
+        self._close()
+        self._open()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def after_fork_in_child(self):
+        # The index and the mapped pages are kept, and shared with the
+        # parent, but the file's offset would be shared too, so the child
+        # opens its own.
+        self.lock = threading.Lock()
+        if self._file.closed:
+            return
+        self._file.close()
+        self._file = open(self.path, "rb" if self.readonly else "a+b")
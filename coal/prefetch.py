@@ -0,0 +1,181 @@
+"""
+:py:mod:`coal.prefetch` builds on the basic functionality of
+:py:mod:`coal` to speculatively queue the tasks that a request is likely
+to need before :py:func:`coal.flatten_promises` discovers them.
+
+Requests to the same entry point tend to run the same lookups. A
+:py:class:`Prefetcher` remembers which cache and asynchronous lookups each
+of the recent requests to an entry point asked for, and queues those that
+most of them asked for at the start of the next request. They are then
+batched into the first phase of their priority, and the tasks discovered
+later find their results already waiting, so a request whose lookups
+depend on one another doesn't need a round-trip for each level of the
+dependency.
+
+Only task types that know how to recreate a task from its keys take part.
+Such a task type implements a class method ``prefetch_task`` that takes a
+batch key and a coalesce key and returns a new task, or None if that task
+can't be prefetched::
+
+    class GetUser(Task):
+        priority = TaskPriority.CACHE
+
+        @classmethod
+        def prefetch_task(cls, batch_key, coalesce_key):
+            return cls(coalesce_key)
+
+Since prefetched tasks are only useful to tasks that coalesce with them,
+``coalesce_key`` should identify what is being looked up rather than the
+task instance.
+"""
+
+import collections
+import threading
+
+from coal import TaskPriority, TaskQueue, flatten_promises, fork
+
+
+class Prefetcher(object):
+    """
+    Records the lookups made by requests to each entry point and prefetches
+    those made by at least ``threshold`` of the last ``history`` of them.
+
+    Only tasks with one of the ``priorities`` are recorded; by default the
+    cache and asynchronous lookups, which are cheap or can overlap with
+    other work if the prediction is wrong.
+
+    A single instance can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        history=20,
+        threshold=0.5,
+        priorities=(TaskPriority.CACHE, TaskPriority.ASYNC_LOOKUP),
+    ):
+        self.history = history
+        self.threshold = threshold
+        self.priorities = frozenset(priorities)
+        # entry point -> deque of the frozensets of task keys recorded
+        # for each recent request.
+        self.profiles = {}
+        # entry point -> dict counting how many of the recent requests
+        # ran each task key.
+        self.counts = {}
+        self.lock = threading.Lock()
+        fork.register(self)
+
+    def after_fork_in_child(self):
+        # the profiles are kept, so that workers start with them.
+        self.lock = threading.Lock()
+
+    def task_queue(self):
+        """
+        Returns a new task queue for a request, which notes the keys of the
+        prefetchable tasks that the request asks for so they can be passed
+        to :py:meth:`record`.
+        """
+        return RecordingTaskQueue(self.priorities)
+
+    def record(self, entry_point, queue):
+        """
+        Record the lookups that were asked for on ``queue``, a queue from
+        :py:meth:`task_queue` that was used for a request to
+        ``entry_point``.
+        """
+        keys = queue.requested_keys
+        with self.lock:
+            profile = self.profiles.get(entry_point)
+            if profile is None:
+                profile = self.profiles[entry_point] = collections.deque()
+                self.counts[entry_point] = {}
+            counts = self.counts[entry_point]
+
+            profile.append(frozenset(keys))
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+
+            while len(profile) > self.history:
+                for key in profile.popleft():
+                    counts[key] -= 1
+                    if counts[key] == 0:
+                        del counts[key]
+
+    def likely_keys(self, entry_point):
+        """
+        Returns the ``(task_type, batch_key, coalesce_key)`` of each task
+        that the next request to ``entry_point`` is likely to run.
+        """
+        with self.lock:
+            profile = self.profiles.get(entry_point)
+            if not profile:
+                return []
+            minimum = self.threshold * len(profile)
+            return [
+                key for key, count in self.counts[entry_point].items()
+                if count >= minimum
+            ]
+
+    def prefetch(self, entry_point, queue):
+        """
+        Queue onto ``queue`` the tasks that the next request to
+        ``entry_point`` is likely to run, returning how many were queued.
+        """
+        tasks = []
+        for task_type, batch_key, coalesce_key in self.likely_keys(
+            entry_point
+        ):
+            task = task_type.prefetch_task(batch_key, coalesce_key)
+            if task is not None:
+                # so that a wrong guess isn't then recorded as having been
+                # asked for.
+                task.prefetched = True
+                tasks.append(task)
+        queue.add_tasks(tasks)
+        return len(tasks)
+
+    def flatten_promises(self, entry_point, data, **kwargs):
+        """
+        Like :py:func:`coal.flatten_promises`, but first prefetching the
+        likely tasks for ``entry_point`` and afterwards recording the
+        tasks that were asked for.
+        """
+        queue = self.task_queue()
+        self.prefetch(entry_point, queue)
+        result = flatten_promises(data, queue=queue, **kwargs)
+        self.record(entry_point, queue)
+        return result
+
+
+class RecordingTaskQueue(TaskQueue):
+    """
+    A task queue that notes the keys of the tasks added to it that have
+    one of the given priorities and can be prefetched.
+    """
+
+    def __init__(self, priorities):
+        super(RecordingTaskQueue, self).__init__()
+        self.priorities = priorities
+        self.requested_keys = set()
+
+    def _note(self, task):
+        if task.priority not in self.priorities:
+            return
+        if getattr(task, "prefetched", False):
+            return
+        task_type = type(task)
+        if getattr(task_type, "prefetch_task", None) is None:
+            return
+        self.requested_keys.add(
+            (task_type, task.batch_key, task.coalesce_key)
+        )
+
+    def add_task(self, task):
+        self._note(task)
+        return super(RecordingTaskQueue, self).add_task(task)
+
+    def add_tasks(self, tasks):
+        tasks = list(tasks)
+        for task in tasks:
+            self._note(task)
+        super(RecordingTaskQueue, self).add_tasks(tasks)
@@ -0,0 +1,142 @@
+"""
+:py:mod:`coal.sharding` builds on the basic functionality of
+:py:mod:`coal` to help with tasks whose batches need to be split between
+several backend nodes, such as a set of memcached servers or database
+shards.
+
+A task type declares a :py:class:`HashRing` of its nodes by subclassing
+:py:class:`ShardedTask`. Each batch is then split into one sub-batch per
+node by consistent hashing of each task's :py:attr:`ShardedTask.shard_key`,
+and the sub-batches are worked concurrently, so a batch spanning several
+nodes takes about as long as its slowest node rather than the sum of all
+of them. Consistent hashing means that adding or removing a node only
+moves the keys on the neighbouring parts of the ring.
+
+Each sub-batch's :py:meth:`ShardedTask.work_shard` only fetches values.
+The tasks are resolved afterwards in the queue's own thread, so their
+callbacks and followups never run concurrently.
+
+The split is recorded in the work log as the ``shards`` of the batch.
+"""
+
+import bisect
+import hashlib
+import sys
+import threading
+
+from coal import Task
+from coal._compat import reraise, text_type
+
+
+def _hash(value):
+    if not isinstance(value, bytes):
+        value = text_type(value).encode("utf-8")
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Maps keys onto ``nodes`` by consistent hashing, placing each node at
+    ``replicas`` points around the ring to spread keys evenly.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((_hash("%s-%i" % (node, i)), node))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def node_for(self, key):
+        if not self._nodes:
+            raise ValueError("Can't find a node in an empty HashRing")
+        index = bisect.bisect(self._hashes, _hash(key))
+        if index == len(self._hashes):
+            # wrap around to the start of the ring.
+            index = 0
+        return self._nodes[index]
+
+    def split(self, tasks, key=lambda task: task.shard_key):
+        """
+        Returns a dict mapping each node to the list of ``tasks`` whose keys
+        belong to it.
+        """
+        by_node = {}
+        for task in tasks:
+            node = self.node_for(key(task))
+            node_tasks = by_node.get(node)
+            if node_tasks is None:
+                node_tasks = by_node[node] = []
+            node_tasks.append(task)
+        return by_node
+
+
+class ShardedTask(Task):
+    """
+    Base class for task types whose batches are split between the nodes of
+    :py:attr:`hash_ring` and then worked by :py:meth:`work_shard`.
+    """
+    hash_ring = None
+
+    @property
+    def shard_key(self):
+        return self.coalesce_key
+
+    @classmethod
+    def work_shard(cls, node, tasks):
+        """
+        Look up ``tasks`` on ``node``, returning a sequence of their values
+        in the same order. It may run in a thread of its own, so it
+        shouldn't resolve the tasks itself.
+        """
+        raise NotImplementedError(
+            'work_shard not implemented for %r' % cls
+        )
+
+    @classmethod
+    def work(cls, tasks):
+        if cls.hash_ring is None:
+            raise Exception('hash_ring not set for %r' % cls)
+
+        by_node = cls.hash_ring.split(tasks)
+        items = list(by_node.items())
+        # the values returned for each item, or the exc_info it raised.
+        values = [None] * len(items)
+        errors = [None] * len(items)
+
+        def work_shard(index, node, node_tasks):
+            try:
+                values[index] = cls.work_shard(node, node_tasks)
+            except Exception:
+                errors[index] = sys.exc_info()
+
+        # Work the first sub-batch in this thread while the others run in
+        # their own.
+        threads = [
+            threading.Thread(target=work_shard, args=(i,) + items[i])
+            for i in range(1, len(items))
+        ]
+        for thread in threads:
+            thread.start()
+        if items:
+            work_shard(0, *items[0])
+        for thread in threads:
+            thread.join()
+
+        for (node, node_tasks), node_values, error in zip(
+            items, values, errors,
+        ):
+            if error is None:
+                cls.resolve_many(node_tasks, node_values)
+        for error in errors:
+            if error is not None:
+                reraise(*error)
+
+        if tasks:
+            tasks[0].queue.report_shards(dict(
+                (node, len(node_tasks)) for node, node_tasks in items
+            ))
@@ -0,0 +1,334 @@
+"""
+:py:mod:`coal.simulation` builds on the basic functionality of
+:py:mod:`coal` to run workloads through the real scheduler in virtual time,
+so that changes to how tasks are queued, batched and worked can be
+evaluated deterministically and in a fraction of the time they'd take for
+real.
+
+A :py:class:`Simulation` has a :py:class:`VirtualClock` and makes
+synthetic task types whose work advances the clock rather than sleeping.
+A batch of a synchronous task type costs a sampled round-trip latency plus
+a cost that depends on the size of the batch. An asynchronous task type's
+tasks each finish a sampled latency after they're created, overlapping
+with the other work of the request, and are resolved in the order they
+finish, as :py:class:`coal.asynchronous.ThreadTask` does::
+
+    sim = Simulation(seed=1)
+    GetUser = sim.task_type(
+        "GetUser",
+        latency=exponential(0.002),
+        batch_cost=linear_cost(0.001, 0.0001),
+    )
+    GetFeed = sim.async_task_type("GetFeed", latency=lognormal(0.05, 0.5))
+
+    def request(random):
+        user_ids = random.sample(range(1000), 20)
+        return {
+            "users": [GetUser(i).promise for i in user_ids],
+            "feed": GetFeed(user_ids[0]).promise,
+        }
+
+    sim.run(request, count=10000)
+    print(sim.report())
+
+Each request is worked by a new :py:class:`coal.TaskQueue` using the
+simulation's clock, one request after another, and its end-to-end latency
+is the virtual time it took. The simulation counts the backend calls made
+by each task type: one per batch of a synchronous type, and one per task
+of an asynchronous type.
+
+Latencies are given as distributions, which are callables that take a
+:py:class:`random.Random` and return a number of seconds, and batch costs
+as callables that take the size of a batch and return a number of
+seconds. All of the randomness comes from the simulation's own generator,
+so a simulation with the same seed always gives the same results.
+"""
+
+import collections
+import heapq
+import itertools
+import math
+from datetime import datetime, timedelta
+import random
+
+from coal import Task, TaskPriority, TaskQueue, flatten_promises
+from coal.asynchronous import AsyncTask
+from coal.trace import percentile
+
+
+class VirtualClock(object):
+    """
+    A clock that only moves when it's told to, starting at the datetime
+    ``start``. Its :py:meth:`now` can stand in for
+    :py:meth:`datetime.datetime.now`.
+    """
+
+    def __init__(self, start=None):
+        self.start = start or datetime(2000, 1, 1)
+        # seconds since start.
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.elapsed += seconds
+
+    def advance_to(self, elapsed):
+        if elapsed > self.elapsed:
+            self.elapsed = elapsed
+
+
+def constant(seconds):
+    """
+    A distribution that's always ``seconds``.
+    """
+    return lambda random: seconds
+
+
+def uniform(low, high):
+    return lambda random: random.uniform(low, high)
+
+
+def exponential(mean):
+    return lambda random: random.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    """
+    A log-normal distribution with the given median, and the standard
+    deviation ``sigma`` of its logarithm, whose long tail suits backends
+    that are usually fast but occasionally very slow.
+    """
+    mu = math.log(median)
+    return lambda random: random.lognormvariate(mu, sigma)
+
+
+def linear_cost(fixed, per_task):
+    """
+    A batch cost of ``fixed`` seconds plus ``per_task`` seconds for each
+    task in the batch.
+    """
+    return lambda count: fixed + per_task * count
+
+
+class SimulatedTask(Task):
+    """
+    A synthetic synchronous task, identified by ``key``. It resolves with
+    ``key``, and tasks of the same type and key are coalesced.
+    """
+    simulation = None
+    latency = staticmethod(constant(0))
+    batch_cost = staticmethod(linear_cost(0, 0))
+
+    def __init__(self, key, batch_key=()):
+        self.key = key
+        self._batch_key = batch_key
+        super(SimulatedTask, self).__init__()
+
+    @property
+    def batch_key(self):
+        return self._batch_key
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    @classmethod
+    def work(cls, tasks):
+        simulation = cls.simulation
+        simulation.clock.advance(
+            cls.latency(simulation.random) + cls.batch_cost(len(tasks))
+        )
+        simulation._count_call(cls, len(tasks))
+        for task in tasks:
+            task.resolve(task.key)
+
+
+class SimulatedAsyncTask(AsyncTask):
+    """
+    A synthetic asynchronous task, identified by ``key``. Its background
+    work starts when it's created and finishes a sampled latency later,
+    when it resolves with ``key``.
+
+    With :py:attr:`coal.asynchronous.AsyncTask.notifies_completion` set,
+    as it is by default, tasks are resolved in the order they finish;
+    otherwise in the order they were queued.
+    """
+    simulation = None
+    latency = staticmethod(constant(0))
+    notifies_completion = True
+
+    def __init__(self, key, batch_key=()):
+        self.key = key
+        self._batch_key = batch_key
+        # tasks that have finished by now free up their admission slots.
+        self.simulation._finish_background_work()
+        super(SimulatedAsyncTask, self).__init__()
+
+    @property
+    def batch_key(self):
+        return self._batch_key
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    def start_working(self, callback):
+        simulation = self.simulation
+        simulation._count_call(type(self), 1)
+        self.finish_time = (
+            simulation.clock.elapsed + self.latency(simulation.random)
+        )
+        self._callback = callback
+        simulation._start_background_work(self)
+
+    def _finish(self):
+        callback = self._callback
+        if callback is not None:
+            self._callback = None
+            callback(self.key)
+
+    def wait_for_result(self):
+        self.simulation.clock.advance_to(self.finish_time)
+        self._finish()
+
+    @classmethod
+    def _wait_for_completion(cls, tasks, timeout):
+        # the clock moves on to the first of them to finish, or by timeout
+        # if that's sooner, rather than waiting.
+        simulation = cls.simulation
+        clock = simulation.clock
+        finish_time = min(task.finish_time for task in tasks)
+        if timeout is not None and clock.elapsed + timeout < finish_time:
+            clock.advance(timeout)
+        else:
+            clock.advance_to(finish_time)
+            simulation._finish_background_work()
+
+
+class Simulation(object):
+    """
+    Runs requests through :py:class:`coal.TaskQueue` in virtual time, using
+    task types made by :py:meth:`task_type` and :py:meth:`async_task_type`.
+    Randomness is drawn from a generator seeded with ``seed``.
+
+    The end-to-end latency of each request run is kept in
+    :py:attr:`latencies`, and the backend calls and tasks worked by each
+    task type in the dicts :py:attr:`backend_calls` and
+    :py:attr:`tasks_worked`, keyed by the type's name.
+    """
+
+    def __init__(self, seed=0, start=None):
+        self.clock = VirtualClock(start)
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.backend_calls = collections.defaultdict(int)
+        self.tasks_worked = collections.defaultdict(int)
+        # (finish time, sequence, task) for background work that hasn't
+        # finished, soonest first.
+        self._in_flight = []
+        self._sequence = itertools.count()
+
+    def task_type(
+        self,
+        name,
+        priority=TaskPriority.SYNC_LOOKUP,
+        latency=constant(0),
+        batch_cost=linear_cost(0, 0),
+        max_batch_size=None,
+    ):
+        """
+        Make a :py:class:`SimulatedTask` type called ``name``, whose
+        batches each take a round trip sampled from ``latency`` plus
+        ``batch_cost(len(batch))`` seconds.
+        """
+        return type(str(name), (SimulatedTask,), {
+            "simulation": self,
+            "priority": priority,
+            "latency": staticmethod(latency),
+            "batch_cost": staticmethod(batch_cost),
+            "max_batch_size": max_batch_size,
+        })
+
+    def async_task_type(
+        self,
+        name,
+        latency=constant(0),
+        admission=None,
+        notifies_completion=True,
+    ):
+        """
+        Make a :py:class:`SimulatedAsyncTask` type called ``name``, whose
+        tasks each take a time sampled from ``latency`` in the background.
+        ``admission`` can be a
+        :py:class:`coal.asynchronous.AdmissionController` to limit how many
+        work in the background at once.
+        """
+        return type(str(name), (SimulatedAsyncTask,), {
+            "simulation": self,
+            "latency": staticmethod(latency),
+            "admission": admission,
+            "notifies_completion": notifies_completion,
+        })
+
+    def _count_call(self, task_type, count):
+        self.backend_calls[task_type.__name__] += 1
+        self.tasks_worked[task_type.__name__] += count
+
+    def _start_background_work(self, task):
+        heapq.heappush(
+            self._in_flight,
+            (task.finish_time, next(self._sequence), task),
+        )
+
+    def _finish_background_work(self):
+        # Finish the background work that would have finished by now, as if
+        # it had been working all along.
+        in_flight = self._in_flight
+        while in_flight and in_flight[0][0] <= self.clock.elapsed:
+            heapq.heappop(in_flight)[2]._finish()
+
+    def run(self, request, count=1, queue_type=TaskQueue, **queue_options):
+        """
+        Run ``count`` requests, each of which calls ``request`` with the
+        simulation's random generator to get data containing promises, and
+        flattens it with a ``queue_type`` made with ``queue_options``.
+        Returns the simulation.
+        """
+        for i in range(count):
+            start = self.clock.elapsed
+            data = request(self.random)
+            queue = queue_type(clock=self.clock, **queue_options)
+            flatten_promises(data, queue=queue)
+            # whatever's still working in the background carries on into
+            # the next request.
+            self._finish_background_work()
+            self.latencies.append(self.clock.elapsed - start)
+        return self
+
+    def report(self):
+        latencies = self.latencies
+        count = max(len(latencies), 1)
+        lines = [
+            "requests: %i" % len(latencies),
+            "latency (ms): mean %.2f p50 %.2f p95 %.2f p99 %.2f max %.2f" % (
+                sum(latencies) * 1000 / count,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                max(latencies or [0]) * 1000,
+            ),
+            "backend calls: %i (%.2f per request)" % (
+                sum(self.backend_calls.values()),
+                float(sum(self.backend_calls.values())) / count,
+            ),
+        ]
+        for name in sorted(self.backend_calls):
+            lines.append("  %s: %i calls, %i tasks" % (
+                name,
+                self.backend_calls[name],
+                self.tasks_worked[name],
+            ))
+        return "\n".join(lines)
@@ -0,0 +1,200 @@
+"""
+:py:mod:`coal.stats` builds on the basic functionality of :py:mod:`coal`
+to measure how much work coalescing saves, and which lookups are asked for
+most often, across the requests of a process.
+
+A :py:class:`CoalescingStats` attached to the :py:class:`coal.TaskQueue`
+of each request counts, for each task type, the tasks asked for and how
+many of them were merged with another task with the same coalesce key,
+resolved from an earlier result, or worked. It also keeps an approximate
+top-K of the hottest ``(task_type, batch_key, coalesce_key)`` keys, which
+are good candidates for pinning into an in-process cache::
+
+    stats = CoalescingStats(capacity=200)
+
+    def handle_request():
+        queue = TaskQueue(stats=stats)
+        ...
+
+    for key, count, error in stats.hot_keys(20, task_type=GetUser):
+        ...
+
+The hot keys are tracked with the Space-Saving algorithm of Metwally et
+al., in a :py:class:`HotKeys` sketch that never holds more than
+``capacity`` keys however many distinct keys it sees. A key is counted
+once for each batch it's part of, so a key that's merged within a request
+counts once for that request, and the counts reflect how many requests,
+and phases of them, needed it.
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+
+from coal import fork
+from coal._compat import iteritems
+
+
+class HotKeys(object):
+    """
+    An approximate count of the most frequent keys added, in bounded
+    memory, by the Space-Saving algorithm.
+
+    It holds at most ``capacity`` keys. When a new key is added while it's
+    full, the key with the lowest count is evicted and the new key takes
+    over its count, which is recorded as the new key's maximum
+    overestimate. Any key whose true count is more than the total added
+    divided by ``capacity`` is guaranteed to be held.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        # key -> [count, error], where error is how much the count might
+        # overestimate the true count by.
+        self.counters = {}
+        # (count, sequence, key) for each key held, with the lowest count
+        # first. Counts go stale as keys are added again, and are only
+        # brought up to date when a key with a stale count reaches the top.
+        self._heap = []
+        self._sequence = itertools.count()
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, key, count=1):
+        self.total += count
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+
+        heap = self._heap
+        error = 0
+        if len(self.counters) >= self.capacity:
+            while True:
+                lowest, _, lowest_key = heap[0]
+                current = self.counters[lowest_key][0]
+                if current == lowest:
+                    break
+                heapq.heapreplace(
+                    heap,
+                    (current, next(self._sequence), lowest_key),
+                )
+            heapq.heappop(heap)
+            del self.counters[lowest_key]
+            error = lowest
+
+        self.counters[key] = [error + count, error]
+        heapq.heappush(heap, (error + count, next(self._sequence), key))
+
+    def top(self, n=None):
+        """
+        Returns a ``(key, count, error)`` triple for each of the ``n`` keys
+        with the highest counts, or all of those held, highest first. The
+        true count of each key is between ``count - error`` and ``count``.
+        """
+        items = sorted(
+            iteritems(self.counters),
+            key=lambda item: item[1][0],
+            reverse=True,
+        )
+        if n is not None:
+            items = items[:n]
+        return [(key, count, error) for key, (count, error) in items]
+
+
+class CoalescingStats(object):
+    """
+    Counts the tasks of each task type that were asked for of the queues
+    it's attached to, and how they were dealt with, and tracks the hottest
+    ``capacity`` keys in a :py:class:`HotKeys`.
+
+    A single instance can be shared between threads.
+    """
+
+    def __init__(self, capacity=100):
+        # task type -> how many tasks were asked for, merged with another
+        # task, resolved from an earlier result and worked.
+        self.requested = collections.defaultdict(int)
+        self.merged = collections.defaultdict(int)
+        self.cached = collections.defaultdict(int)
+        self.worked = collections.defaultdict(int)
+        self.sketch = HotKeys(capacity)
+        self.lock = threading.Lock()
+        fork.register(self)
+
+    def after_fork_in_child(self):
+        # the counts are kept, so that workers start with them.
+        self.lock = threading.Lock()
+
+    def observe_batch(self, task_type, batch_key, tasks, merged, cached):
+        """
+        Take note of a batch of ``task_type`` about to be worked, where
+        ``tasks`` maps each coalesce key to its task, ``merged`` tasks were
+        merged into them and ``cached`` of them were resolved from earlier
+        results.
+        """
+        sketch = self.sketch
+        with self.lock:
+            self.requested[task_type] += len(tasks) + merged
+            self.merged[task_type] += merged
+            self.cached[task_type] += cached
+            self.worked[task_type] += len(tasks) - cached
+            for coalesce_key, task in iteritems(tasks):
+                if coalesce_key == id(task):
+                    # the default, which no other task can share.
+                    continue
+                sketch.add((task_type, batch_key, coalesce_key))
+
+    def coalescing_efficiency(self, task_type):
+        """
+        The fraction of the tasks of ``task_type`` asked for that didn't
+        need to be worked, because they were merged with another or
+        resolved from an earlier result.
+        """
+        requested = self.requested[task_type]
+        if requested == 0:
+            return 0.0
+        return float(requested - self.worked[task_type]) / requested
+
+    def hot_keys(self, n=None, task_type=None):
+        """
+        Returns ``(key, count, error)`` for each of the ``n`` hottest keys,
+        or all of those held, optionally only those of ``task_type``. Each
+        key is a ``(task_type, batch_key, coalesce_key)`` triple. See
+        :py:meth:`HotKeys.top`.
+        """
+        with self.lock:
+            top = self.sketch.top()
+        if task_type is not None:
+            top = [item for item in top if item[0][0] is task_type]
+        if n is not None:
+            top = top[:n]
+        return top
+
+    def report(self, n=10):
+        lines = ["task types:"]
+        with self.lock:
+            task_types = sorted(self.requested, key=lambda t: t.__name__)
+        for task_type in task_types:
+            lines.append(
+                "  %s: %i requested, %i merged, %i cached, %i worked, "
+                "coalescing %.1f%%" % (
+                    task_type.__name__,
+                    self.requested[task_type],
+                    self.merged[task_type],
+                    self.cached[task_type],
+                    self.worked[task_type],
+                    self.coalescing_efficiency(task_type) * 100,
+                )
+            )
+        lines.append("hot keys:")
+        for (task_type, batch_key, coalesce_key), count, error in (
+            self.hot_keys(n)
+        ):
+            lines.append("  %s %r %r: %i (error %i)" % (
+                task_type.__name__, batch_key, coalesce_key, count, error,
+            ))
+        return "\n".join(lines)
@@ -0,0 +1,354 @@
+"""
+:py:mod:`coal.trace` builds on the work logs produced by
+:py:meth:`coal.TaskQueue.work` to persist them as compact traces that can
+be collected in production and analyzed or replayed offline.
+
+A trace is a file of line-delimited JSON records, one per task batch,
+written by a :py:class:`TraceWriter`. Each record carries only names,
+counts and times, so a trace holds no references to the tasks it
+describes::
+
+    {"request": "1234-1", "phase": 0, "priority": "CACHE",
+     "task_type": "myapp.tasks.GetUser", "batch_key": "()",
+     "count": 12, "cached": 0, "merged": 3,
+     "start": 1412121600.25, "duration": 0.0012}
+
+Traces can be analyzed and replayed from the command line::
+
+    python -m coal.trace analyze requests.trace
+    python -m coal.trace replay --speed 10 requests.trace
+
+Analysis reports, across the traced requests, the critical path through
+their phases, how many phases they needed, how much work coalescing and
+earlier results saved for each task type, and the distribution of batch
+sizes for each task type.
+
+Replaying runs each traced request through a :py:class:`coal.TaskQueue`
+using stub tasks that just sleep for as long as the traced batch took,
+which allows changes to the scheduler to be benchmarked offline.
+"""
+
+from __future__ import print_function
+
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from coal import Task, TaskPriority, TaskQueue, fork
+
+
+def _timestamp(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+
+def _seconds(td):
+    return td.days * 86400 + td.seconds + td.microseconds / 1000000.0
+
+
+def task_type_name(task_type):
+    return "%s.%s" % (task_type.__module__, task_type.__name__)
+
+
+class TraceWriter(object):
+    """
+    Writes work logs as trace records to a file-like object. A single
+    instance can be shared between threads.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.lock = threading.Lock()
+        # used to name requests that aren't given an id.
+        self._prefix = "%i-" % os.getpid()
+        self._counter = itertools.count(1)
+        fork.register(self)
+
+    def after_fork_in_child(self):
+        # so that workers don't reuse each other's request ids.
+        self.lock = threading.Lock()
+        self._prefix = "%i-" % os.getpid()
+        self._counter = itertools.count(1)
+
+    def write(self, log_list, request_id=None):
+        """
+        Write the work log ``log_list`` of one request. Returns the id the
+        request was recorded under, which is generated if not given.
+        """
+        if request_id is None:
+            request_id = self._prefix + str(next(self._counter))
+
+        lines = []
+        for phase, entry in enumerate(log_list):
+            for batch in entry.task_batches:
+                record = {
+                    "request": request_id,
+                    "phase": phase,
+                    "priority": entry.priority_name,
+                    "task_type": task_type_name(batch.task_type),
+                    "batch_key": repr(batch.batch_key),
+                    "count": batch.count,
+                    "cached": batch.cached,
+                    "merged": batch.merged,
+                    "start": _timestamp(batch.start_time),
+                    "duration": _seconds(batch.time_spent),
+                }
+                if batch.shards is not None:
+                    record["shards"] = dict(
+                        (str(node), count)
+                        for node, count in batch.shards.items()
+                    )
+                lines.append(json.dumps(record, sort_keys=True))
+        lines.append("")
+
+        with self.lock:
+            self.fileobj.write("\n".join(lines))
+        return request_id
+
+
+def read_trace(fileobj):
+    """
+    Yields the traced requests from ``fileobj`` as lists of their batch
+    records, in the order the requests first appear.
+    """
+    requests = collections.OrderedDict()
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        requests.setdefault(record["request"], []).append(record)
+    for records in requests.values():
+        yield records
+
+
+def _phases(records):
+    # groups a request's records into its phases, in order.
+    phases = collections.OrderedDict()
+    for record in sorted(records, key=lambda r: r["phase"]):
+        phases.setdefault(record["phase"], []).append(record)
+    return list(phases.values())
+
+
+def percentile(values, fraction):
+    """
+    The value at ``fraction`` (between 0 and 1) of the way through the
+    sorted ``values``, or 0 if there are none.
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class TraceAnalysis(object):
+    """
+    Summary statistics for a set of traced requests.
+    """
+
+    def __init__(self, requests):
+        self.request_count = 0
+        # per request: the total time spent in its phases, which run one
+        # after another and so are its critical path through coal.
+        self.critical_paths = []
+        self.phase_counts = []
+        # priority name -> total time spent in phases of that priority.
+        self.priority_time = collections.defaultdict(float)
+        # task type name -> total tasks worked, resolved from earlier
+        # results and merged.
+        self.worked = collections.defaultdict(int)
+        self.cached = collections.defaultdict(int)
+        self.merged = collections.defaultdict(int)
+        # task type name -> list of batch sizes.
+        self.batch_sizes = collections.defaultdict(list)
+
+        for records in requests:
+            self.request_count += 1
+            phases = _phases(records)
+            self.phase_counts.append(len(phases))
+            critical_path = 0.0
+            for phase in phases:
+                start = min(r["start"] for r in phase)
+                end = max(r["start"] + r["duration"] for r in phase)
+                critical_path += end - start
+                self.priority_time[phase[0]["priority"]] += end - start
+            self.critical_paths.append(critical_path)
+
+            for record in records:
+                task_type = record["task_type"]
+                self.worked[task_type] += record["count"]
+                self.cached[task_type] += record["cached"]
+                self.merged[task_type] += record["merged"]
+                self.batch_sizes[task_type].append(record["count"])
+
+    def coalescing_efficiency(self, task_type):
+        """
+        The fraction of the tasks of ``task_type`` asked for that didn't
+        need to be worked, because they were merged with another or
+        resolved from an earlier result.
+        """
+        saved = self.cached[task_type] + self.merged[task_type]
+        requested = self.worked[task_type] + saved
+        if requested == 0:
+            return 0.0
+        return float(saved) / requested
+
+    def report(self):
+        lines = []
+        count = max(self.request_count, 1)
+        lines.append("requests: %i" % self.request_count)
+        lines.append(
+            "critical path (ms): mean %.2f p50 %.2f p95 %.2f max %.2f" % (
+                sum(self.critical_paths) * 1000 / count,
+                percentile(self.critical_paths, 0.5) * 1000,
+                percentile(self.critical_paths, 0.95) * 1000,
+                max(self.critical_paths or [0]) * 1000,
+            )
+        )
+        lines.append("phases: mean %.2f max %i" % (
+            float(sum(self.phase_counts)) / count,
+            max(self.phase_counts or [0]),
+        ))
+        for priority_name in TaskPriority.all_values():
+            if priority_name in self.priority_time:
+                lines.append("  %-14s mean %.2f ms" % (
+                    priority_name,
+                    self.priority_time[priority_name] * 1000 / count,
+                ))
+        lines.append("task types:")
+        for task_type in sorted(self.batch_sizes):
+            sizes = self.batch_sizes[task_type]
+            lines.append(
+                "  %s: %i batches, %i worked, coalescing %.1f%%, "
+                "batch size min %i p50 %i p95 %i max %i" % (
+                    task_type,
+                    len(sizes),
+                    self.worked[task_type],
+                    self.coalescing_efficiency(task_type) * 100,
+                    min(sizes),
+                    percentile(sizes, 0.5),
+                    percentile(sizes, 0.95),
+                    max(sizes),
+                )
+            )
+        return "\n".join(lines)
+
+
+class StubTask(Task):
+    """
+    Stands in for a traced task when replaying. The first task of each
+    batch carries the batch's traced duration, which the batch then
+    sleeps for, scaled by ``speed``.
+    """
+    speed = 1.0
+
+    def __init__(self, batch_key, duration):
+        self._batch_key = batch_key
+        self.duration = duration
+        super(StubTask, self).__init__()
+
+    @property
+    def batch_key(self):
+        return self._batch_key
+
+    @classmethod
+    def work(cls, tasks):
+        duration = max(task.duration for task in tasks)
+        if duration > 0 and cls.speed > 0:
+            time.sleep(duration / cls.speed)
+        for task in tasks:
+            task.resolve(None)
+
+
+def replay(requests, speed=1.0, log_list=None):
+    """
+    Replays ``requests`` through a :py:class:`coal.TaskQueue` with stub
+    tasks that sleep for their traced durations divided by ``speed``, or
+    not at all if ``speed`` is zero. Each phase's tasks are queued once
+    the previous phase is done, as if they were its followups.
+
+    Returns the total wall-clock time taken, in seconds.
+    """
+    stub_types = {}
+
+    def stub_type(name, priority_name):
+        key = (name, priority_name)
+        if key not in stub_types:
+            stub_types[key] = type(
+                str(name.rsplit(".", 1)[-1]),
+                (StubTask,),
+                {
+                    "priority": getattr(TaskPriority, priority_name),
+                    "speed": speed,
+                },
+            )
+        return stub_types[key]
+
+    total = 0.0
+    for records in requests:
+        queue = TaskQueue()
+        start = time.time()
+        for phase in _phases(records):
+            for record in phase:
+                task_type = stub_type(record["task_type"], record["priority"])
+                queue.add_tasks(
+                    task_type(record["batch_key"], record["duration"])
+                    for i in range(record["count"])
+                )
+            queue.work(log_list=log_list)
+        total += time.time() - start
+    return total
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m coal.trace",
+        description="Analyze or replay coal work log traces.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    # optional by default on Python 3, which leaves args without files.
+    subparsers.required = True
+    analyze_parser = subparsers.add_parser(
+        "analyze",
+        help="report statistics for traced requests",
+    )
+    analyze_parser.add_argument("files", nargs="+")
+    replay_parser = subparsers.add_parser(
+        "replay",
+        help="replay traced requests against stub tasks",
+    )
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="divide traced durations by this; 0 means don't sleep at all",
+    )
+    replay_parser.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+
+    def requests():
+        for filename in args.files:
+            with open(filename) as fileobj:
+                for records in read_trace(fileobj):
+                    yield records
+
+    if args.command == "analyze":
+        print(TraceAnalysis(requests()).report())
+    else:
+        requests = list(requests())
+        elapsed = replay(requests, speed=args.speed)
+        print("replayed %i requests in %.2f ms (%.2f ms per request)" % (
+            len(requests),
+            elapsed * 1000,
+            elapsed * 1000 / max(len(requests), 1),
+        ))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
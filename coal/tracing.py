@@ -0,0 +1,108 @@
+"""
+:py:mod:`coal.tracing` provides a tracer for use with the ``tracer``
+argument of :py:class:`coal.TaskQueue` that keeps its spans in memory, for
+tests and for inspecting coal's batching without a tracing backend.
+
+With a tracer, :py:meth:`coal.TaskQueue.work` records a ``coal.work`` span,
+each phase a child ``coal.phase`` span and each batch within the phase a
+``coal.batch`` span with these attributes:
+
+``coal.task_type``, ``coal.batch_key``
+    which batch this is.
+``coal.batch.size``
+    how many tasks were worked.
+``coal.batch.coalesced``
+    how many tasks were merged into those, rather than worked themselves.
+``coal.batch.cache_hits``
+    how many tasks were resolved from earlier results instead.
+``coal.batch.duration_ms``
+    how long the task type's ``work`` took.
+``coal.batch.shards``
+    how many shards the batch was split between, if it was.
+
+To include coal's batching in end-to-end request traces, pass an
+`OpenTelemetry <https://opentelemetry.io/>`_ tracer instead, which has the
+same ``start_as_current_span`` method::
+
+    queue = TaskQueue(tracer=opentelemetry.trace.get_tracer("coal"))
+"""
+
+import contextlib
+import threading
+import time
+
+
+class InMemorySpan(object):
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.start_time = time.time()
+        self.end_time = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return "<coal.tracing.InMemorySpan %s %r>" % (
+            self.name,
+            self.attributes,
+        )
+
+
+class InMemoryTracer(object):
+    """
+    Records spans in memory. Spans started while another is current in the
+    same thread become its children; the others are listed in
+    :py:attr:`root_spans`.
+    """
+
+    def __init__(self):
+        self.root_spans = []
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+
+        span = InMemorySpan(name, parent, attributes)
+        if parent is None:
+            with self.lock:
+                self.root_spans.append(span)
+        else:
+            parent.children.append(span)
+
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            span.end_time = time.time()
+
+    def spans(self, name=None):
+        """
+        Returns all of the recorded spans, or just those called ``name``,
+        parents before their children.
+        """
+        found = []
+        pending = list(reversed(self.root_spans))
+        while pending:
+            span = pending.pop()
+            if name is None or span.name == name:
+                found.append(span)
+            pending.extend(reversed(span.children))
+        return found
+
+    def clear(self):
+        with self.lock:
+            self.root_spans = []
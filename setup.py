@@ -1,14 +1,40 @@
+import platform
 
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
+    from setuptools.command.build_ext import build_ext
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+    from distutils.command.build_ext import build_ext
+
+
+class optional_build_ext(build_ext):
+    # coal falls back to pure Python without its speedups, so a missing
+    # compiler shouldn't stop it being installed.
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            self.warn("not building coal._speedups: %s" % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            self.warn("not building %s: %s" % (ext.name, e))
+
+
+ext_modules = []
+if platform.python_implementation() == "CPython":
+    ext_modules.append(Extension("coal._speedups", ["coal/_speedups.c"]))
 
 setup(
     name="coal",
     version="dev",
     packages=['coal'],
+    ext_modules=ext_modules,
+    cmdclass={"build_ext": optional_build_ext},
     install_requires=[
     ]
 )
-
@@ -0,0 +1,102 @@
+
+import unittest
+import testutil
+from coal import Task, TaskQueue
+from coal.adaptive import AdaptiveBatchController
+
+
+class TestAdaptive(unittest.TestCase):
+
+    assert_work_log = testutil.assert_work_log
+
+    def test_max_batch_size(self):
+        batches = []
+
+        class Limited(Task):
+            max_batch_size = 4
+
+            @classmethod
+            def work(cls, tasks):
+                batches.append(len(tasks))
+                for task in tasks:
+                    task.resolve(None)
+
+        queue = TaskQueue()
+        queue.add_tasks(Limited() for i in range(10))
+        log_list = []
+        self.assertEqual(queue.work(log_list=log_list), 10)
+
+        self.assertEqual(batches, [4, 4, 2])
+        self.assertEqual(
+            [batch.count for batch in log_list[0].task_batches],
+            [4, 4, 2],
+        )
+
+    def test_aimd(self):
+        class Lookup(Task):
+            pass
+
+        controller = AdaptiveBatchController(
+            target_latency=0.1,
+            min_size=2,
+            max_size=12,
+            initial_size=10,
+            increase=1,
+            decrease=0.5,
+        )
+        self.assertEqual(controller.batch_size(Lookup), 10)
+
+        # a batch that didn't fill the limit doesn't grow it.
+        controller.observe(Lookup, 5, 0.01)
+        self.assertEqual(controller.batch_size(Lookup), 10)
+
+        # full, fast batches grow it additively, up to the maximum.
+        for expected in (11, 12, 12):
+            controller.observe(Lookup, controller.batch_size(Lookup), 0.01)
+            self.assertEqual(controller.batch_size(Lookup), expected)
+
+        # slow batches cut it multiplicatively, down to the minimum.
+        for expected in (6, 3, 2, 2):
+            controller.observe(Lookup, 1, 0.5)
+            self.assertEqual(controller.batch_size(Lookup), expected)
+
+    def test_task_type_limit(self):
+        class Limited(Task):
+            max_batch_size = 4
+
+        controller = AdaptiveBatchController(
+            target_latency=0.1,
+            min_size=5,
+        )
+        # even min_size doesn't override the backend's limit.
+        self.assertEqual(controller.batch_size(Limited), 4)
+        for i in range(3):
+            controller.observe(Limited, 4, 0.01)
+        self.assertEqual(controller.batch_size(Limited), 4)
+
+    def test_queue(self):
+        observed_sizes = []
+
+        class Lookup(Task):
+            max_batch_size = 8
+
+            @classmethod
+            def work(cls, tasks):
+                for task in tasks:
+                    task.resolve(None)
+
+        class Slow(AdaptiveBatchController):
+            def observe(self, task_type, count, seconds):
+                observed_sizes.append(count)
+                # pretend that every batch was too slow.
+                super(Slow, self).observe(task_type, count, 1)
+
+        controller = Slow(target_latency=0.1, min_size=2)
+        queue = TaskQueue(batch_controller=controller)
+        queue.add_tasks(Lookup() for i in range(20))
+        queue.work()
+
+        # limits start from the task type's max_batch_size, and each slow
+        # chunk shrinks the ones after it in the same batch.
+        self.assertEqual(observed_sizes, [8, 4, 2, 2, 2, 2])
+        self.assertEqual(controller.batch_size(Lookup), 2)
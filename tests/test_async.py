@@ -2,9 +2,10 @@
 import unittest
 import mock
 import logging
+import threading
 import testutil
 from coal import Task, TaskQueue, TaskPriority, Promise
-from coal.async import AsyncTask, ThreadTask
+from coal.asynchronous import AsyncTask, ThreadTask, AdmissionController
 
 
 class TestAsync(unittest.TestCase):
@@ -28,7 +29,8 @@ class TestAsync(unittest.TestCase):
         task = MockAsyncTask()
 
         # Fake being in a queue so we can resolve
-        task.queue = mock.MagicMock()
+        # (tasks only refer weakly to their queue)
+        queue = task.queue = mock.MagicMock()
 
         self.assertEqual(
             calls,
@@ -65,7 +67,7 @@ class TestAsync(unittest.TestCase):
             }
         )
 
-        task.queue._record_result.assert_called_with(
+        queue._record_result.assert_called_with(
             task,
             9,
         )
@@ -79,7 +81,9 @@ class TestAsync(unittest.TestCase):
         task = DummyThreadTask()
 
         # Fake being in a queue so we can resolve
-        task.queue = mock.MagicMock()
+        # (tasks only refer weakly to their queue)
+        queue = task.queue = mock.MagicMock()
+        queue.budget = None
 
         result_callback = mock.MagicMock()
         task.promise.then(result_callback)
@@ -87,7 +91,166 @@ class TestAsync(unittest.TestCase):
         DummyThreadTask.work([task])
 
         result_callback.assert_called_with(23)
-        task.queue._record_result.assert_called_with(
+        queue._record_result.assert_called_with(
             task,
             23,
         )
+
+    def test_thread_task_error(self):
+
+        class FailingTask(ThreadTask):
+            def thread_work(self):
+                raise ValueError("backend down")
+
+        queue = TaskQueue()
+        task = queue.add_task(FailingTask())
+        task.thread.join()
+        self.assertTrue(task.completed)
+        self.assertRaises(ValueError, queue.work)
+
+    def test_admission_after_error(self):
+
+        class FailingTask(ThreadTask):
+            admission = AdmissionController(max_in_flight=2)
+
+            def __init__(self, value):
+                self.value = value
+                super(FailingTask, self).__init__()
+
+            def thread_work(self):
+                raise ValueError("backend down")
+
+        for i in range(3):
+            tasks = [FailingTask(i * 2), FailingTask(i * 2 + 1)]
+            self.assertEqual([task.started for task in tasks], [True, True])
+            for task in tasks:
+                task.thread.join()
+            # failed tasks give back their slots too.
+            self.assertEqual(FailingTask.admission.in_flight, 0)
+
+    def test_admission_without_callback(self):
+        admission = AdmissionController(max_in_flight=1)
+
+        class Broken(AsyncTask):
+            # fails without ever calling its callback.
+
+            def start_working(self, callback):
+                pass
+
+            def wait_for_result(self):
+                raise ValueError("backend down")
+
+        Broken.admission = admission
+        queue = TaskQueue()
+        queue.add_task(Broken())
+        self.assertEqual(admission.in_flight, 1)
+        self.assertRaises(ValueError, queue.work)
+        # the slot's given back once the task has been waited on.
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(Broken().started, True)
+
+    def test_admission(self):
+        admission = AdmissionController(max_in_flight=3, type_limits={})
+        work_threads = []
+        release = threading.Event()
+
+        class LimitedTask(ThreadTask):
+            def __init__(self, value):
+                self.value = value
+                super(LimitedTask, self).__init__()
+
+            def thread_work(self):
+                work_threads.append(threading.current_thread())
+                release.wait()
+                return self.value
+
+        class OtherTask(LimitedTask):
+            pass
+
+        LimitedTask.admission = admission
+        admission.type_limits[LimitedTask] = 2
+
+        tasks = [LimitedTask(i) for i in range(4)]
+        tasks.extend(OtherTask(i) for i in range(4, 6))
+
+        self.assertEqual(
+            [task.started for task in tasks],
+            [True, True, False, False, True, False],
+        )
+        self.assertEqual(admission.in_flight, 3)
+        self.assertEqual(admission.admitted, 3)
+        self.assertEqual(admission.deferred, 3)
+        self.assertEqual(
+            admission.deferred_by_type,
+            {LimitedTask: 2, OtherTask: 1},
+        )
+
+        release.set()
+        queue = TaskQueue()
+        queue.add_tasks(tasks)
+        queue.work()
+
+        results = []
+        for task in tasks:
+            task.then(results.append)
+        self.assertEqual(results, list(range(6)))
+        self.assertEqual(admission.in_flight, 0)
+        # the deferred tasks were worked in the queue's own thread.
+        self.assertEqual(
+            work_threads.count(threading.current_thread()),
+            3,
+        )
+
+    def test_completion_order(self):
+        slow_may_finish = threading.Event()
+        order = []
+
+        class Lookup(ThreadTask):
+            def __init__(self, name, wait_for=None):
+                self.name = name
+                self.wait_for = wait_for
+                super(Lookup, self).__init__()
+
+            def thread_work(self):
+                if self.wait_for is not None:
+                    # only finishes once the fast lookup's followup has
+                    # been worked, which needs it to go first.
+                    self.wait_for.wait(5)
+                return self.name
+
+        class Followup(Task):
+            def __init__(self, name):
+                self.name = name
+                super(Followup, self).__init__()
+
+            @classmethod
+            def work(cls, tasks):
+                for task in tasks:
+                    order.append(task.name)
+                    slow_may_finish.set()
+                    task.resolve(None)
+
+        def follow(task):
+            def handle_result(value):
+                order.append(value)
+                task.followup(Followup("after " + value))
+            task.then(handle_result)
+            return task
+
+        queue = TaskQueue()
+        queue.add_tasks([
+            follow(Lookup("slow", wait_for=slow_may_finish)),
+            follow(Lookup("fast")),
+        ])
+        log_list = []
+        queue.work(log_list=log_list)
+
+        self.assertEqual(
+            order,
+            ["fast", "after fast", "slow", "after slow"],
+        )
+        self.assertEqual(queue.requeued, 1)
+        self.assertEqual(
+            [entry.priority_name for entry in log_list],
+            ["ASYNC_LOOKUP", "SYNC_LOOKUP", "ASYNC_LOOKUP", "SYNC_LOOKUP"],
+        )
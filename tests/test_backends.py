@@ -0,0 +1,179 @@
+
+import unittest
+import mock
+import time
+import testutil
+from coal import TaskQueue, flatten_promises
+from coal.caching import cache_lookup_promise, CACHE_MISS, KNOWN_ABSENT
+from coal.backends import (
+    ConnectionPool,
+    PoolExhaustedError,
+    KeyValueBackend,
+    KeyValueGetTask,
+    KeyValueSetTask,
+    KeyValueServer,
+)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        connect = mock.MagicMock(side_effect=lambda: mock.MagicMock())
+        pool = ConnectionPool(connect, max_size=2)
+
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+
+        self.assertTrue(first is second)
+        self.assertEqual(pool.created, 1)
+
+    def test_broken(self):
+        pool = ConnectionPool(mock.MagicMock, max_size=1)
+
+        def fail():
+            with pool.connection() as conn:
+                raise IOError("oops")
+
+        self.assertRaises(IOError, fail)
+        self.assertEqual(pool.discarded, 1)
+        self.assertEqual(pool.size, 0)
+
+        with pool.connection() as conn:
+            pass
+        self.assertEqual(pool.created, 2)
+
+    def test_health_check(self):
+        health_check = mock.MagicMock(return_value=False)
+        pool = ConnectionPool(
+            mock.MagicMock,
+            health_check=health_check,
+            check_interval=0,
+        )
+        conn = pool.acquire()
+        pool.release(conn)
+        time.sleep(0.01)
+        other = pool.acquire()
+
+        health_check.assert_called_with(conn)
+        self.assertTrue(other is not conn)
+        conn.close.assert_called_with()
+        self.assertEqual(pool.size, 1)
+
+    def test_exhausted(self):
+        pool = ConnectionPool(mock.MagicMock, max_size=1, acquire_timeout=0)
+        pool.acquire()
+        self.assertRaises(PoolExhaustedError, pool.acquire)
+
+
+class TestKeyValueBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.server = KeyValueServer()
+        self.backend = KeyValueBackend(self.server.start())
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.stop()
+
+    def test_cache_flow(self):
+        backend = self.backend
+        with backend.connection() as conn:
+            conn.set_multi({"a": "cached"})
+
+        class Get(KeyValueGetTask):
+            pass
+
+        class Set(KeyValueSetTask):
+            pass
+
+        class Load(KeyValueGetTask):
+            # stands in for a more expensive lookup.
+            @classmethod
+            def work_with_connection(cls, conn, tasks):
+                return ["loaded " + task.key for task in tasks]
+
+        Get.backend = Set.backend = Load.backend = backend
+
+        for i in range(2):
+            data = [
+                cache_lookup_promise(
+                    Get(key),
+                    Load(key),
+                    cache_update_task_builder=lambda value, key=key: Set(
+                        key, value,
+                    ),
+                )
+                for key in ("a", "b")
+            ]
+            flatten_promises(data)
+            self.assertEqual(data, ["cached", "loaded b"])
+
+        # all of the batches shared a single warm connection.
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(backend.pool.created, 1)
+
+        with backend.connection() as conn:
+            self.assertTrue(conn.ping())
+            self.assertEqual(conn.get_multi([]), {})
+            self.assertEqual(conn.get_multi(["b"]), {"b": "loaded b"})
+
+    def test_cached_sentinels(self):
+        class Get(KeyValueGetTask):
+            backend = self.backend
+
+        class Set(KeyValueSetTask):
+            backend = self.backend
+
+        class Load(KeyValueGetTask):
+            backend = self.backend
+
+            @classmethod
+            def work_with_connection(cls, conn, tasks):
+                return [KNOWN_ABSENT for task in tasks]
+
+        def lookup(key):
+            return cache_lookup_promise(
+                Get(key),
+                Load(key),
+                cache_update_task_builder=lambda value, **kwargs: Set(
+                    key, value, **kwargs
+                ),
+                negative_ttl=30,
+            )
+
+        for i in range(2):
+            self.assertEqual(
+                flatten_promises([lookup("gone")]),
+                [KNOWN_ABSENT],
+            )
+        self.assertTrue(29 < self.server.expiries["gone"] - time.time() <= 30)
+
+        # expired keys are gone.
+        self.server.expiries["gone"] = time.time()
+        with self.backend.connection() as conn:
+            self.assertEqual(conn.get_multi(["gone"]), {})
+
+    def test_zero_ttl(self):
+        with self.backend.connection() as conn:
+            conn.set_multi({"a": 1}, ttl=0)
+            conn.set_multi({"b": 2})
+            # a ttl of 0 never expires, rather than expiring at once.
+            self.assertEqual(conn.get_multi(["a", "b"]), {"a": 1, "b": 2})
+        self.assertEqual(self.server.expiries, {})
+
+    def test_callback_error_keeps_connection(self):
+        class Get(KeyValueGetTask):
+            backend = self.backend
+
+        def fail(value):
+            raise ValueError(value)
+
+        queue = TaskQueue()
+        queue.add_task(Get("a")).then(fail)
+        self.assertRaises(ValueError, queue.work)
+
+        # the connection was healthy, so it went back into the pool.
+        self.assertEqual(len(self.backend.pool.idle), 1)
+        self.assertEqual(self.backend.pool.created, 1)
@@ -4,7 +4,103 @@ import mock
 import logging
 import testutil
 from coal import Task, TaskQueue, TaskPriority, Promise
-from coal.caching import cache_lookup_promise, CACHE_MISS
+from coal.caching import (
+    cache_hierarchy_promise,
+    cache_lookup_promise,
+    CACHE_MISS,
+    KNOWN_ABSENT,
+    LookupFailed,
+)
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class FakeCache(object):
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+        self.lookups = []
+        self.loads = []
+
+        class TryCache(Task):
+            priority = TaskPriority.CACHE
+
+            def __init__(task, key):
+                task.key = key
+                super(TryCache, task).__init__()
+
+            @property
+            def coalesce_key(task):
+                return task.key
+
+            @classmethod
+            def work(cls, tasks):
+                self.lookups.append(sorted(task.key for task in tasks))
+                for task in tasks:
+                    task.resolve(self.values.get(task.key, CACHE_MISS))
+
+        class Load(Task):
+
+            def __init__(task, key, value):
+                task.key = key
+                task.value = value
+                super(Load, task).__init__()
+
+            @classmethod
+            def work(cls, tasks):
+                for task in tasks:
+                    self.loads.append(task.key)
+                    task.resolve(task.value)
+
+        class Populate(Task):
+            priority = TaskPriority.CLEANUP
+
+            def __init__(task, key, value, ttl=None):
+                task.key = key
+                task.value = value
+                task.ttl = ttl
+                super(Populate, task).__init__()
+
+            @classmethod
+            def work(cls, tasks):
+                for task in tasks:
+                    # round-trip through pickle like a real cache.
+                    self.values[task.key] = pickle.loads(
+                        pickle.dumps(task.value)
+                    )
+                    self.ttls[task.key] = task.ttl
+                    task.resolve(None)
+
+        self.writes = []
+
+        class BatchedPopulate(Populate):
+            @classmethod
+            def work(cls, tasks):
+                self.writes.append(sorted(task.key for task in tasks))
+                super(BatchedPopulate, cls).work(tasks)
+
+        self.BatchedPopulate = BatchedPopulate
+        self.TryCache = TryCache
+        self.Load = Load
+        self.Populate = Populate
+
+    def lookup(self, key, value, **kwargs):
+        result = []
+        promise = cache_lookup_promise(
+            self.TryCache(key),
+            self.Load(key, value),
+            lambda value, **ttl: self.Populate(key, value, **ttl),
+            **kwargs
+        )
+        promise.then(result.append)
+        queue = TaskQueue()
+        queue.add_task(promise.task)
+        queue.work()
+        return result[0]
 
 
 class TestCaching(unittest.TestCase):
@@ -100,3 +196,80 @@ class TestCaching(unittest.TestCase):
                 ('CachePopulate', (), 1),
             ]),
         ])
+
+    def test_negative_caching(self):
+        cache = FakeCache()
+
+        self.assertTrue(
+            cache.lookup("gone", KNOWN_ABSENT, negative_ttl=30)
+            is KNOWN_ABSENT
+        )
+        self.assertEqual(cache.ttls, {"gone": 30})
+
+        # the absence is now cached, so there's no second real lookup.
+        self.assertTrue(
+            cache.lookup("gone", KNOWN_ABSENT, negative_ttl=30)
+            is KNOWN_ABSENT
+        )
+        self.assertEqual(cache.loads, ["gone"])
+
+        # other values are cached without a ttl.
+        self.assertEqual(cache.lookup("here", 5, negative_ttl=30), 5)
+        self.assertEqual(cache.ttls["here"], None)
+
+    def test_error_caching(self):
+        cache = FakeCache()
+        error = LookupFailed("database unavailable")
+
+        # errors aren't cached by default...
+        self.assertEqual(cache.lookup("key", error), error)
+        self.assertEqual(cache.values, {})
+
+        # ...but can be, briefly.
+        self.assertEqual(cache.lookup("key", error, error_ttl=1), error)
+        self.assertEqual(cache.ttls, {"key": 1})
+        self.assertEqual(cache.lookup("key", error, error_ttl=1), error)
+        self.assertEqual(cache.loads, ["key", "key"])
+
+    def test_lookup_failed_hash(self):
+        errors = set([LookupFailed("a"), LookupFailed("a"), LookupFailed("b")])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(LookupFailed("b") in errors)
+
+    def test_cache_hierarchy(self):
+        local = FakeCache()
+        remote = FakeCache()
+        database = FakeCache()
+        local.values = {"a": 1}
+        remote.values = {"b": 2}
+
+        def tier(cache, key):
+            return (
+                cache.TryCache(key),
+                lambda value: cache.BatchedPopulate(key, value),
+            )
+
+        results = {}
+        queue = TaskQueue()
+        for key in ("a", "b", "c", "d"):
+            promise = cache_hierarchy_promise(
+                [tier(local, key), tier(remote, key)],
+                database.Load(key, key.upper()),
+            )
+            promise.then(lambda value, key=key: results.update({key: value}))
+            queue.add_task(promise.task)
+        log_list = []
+        queue.work(log_list=log_list)
+
+        self.assertEqual(results, {"a": 1, "b": 2, "c": "C", "d": "D"})
+        # each tier only saw what the tiers before it missed.
+        self.assertEqual(local.lookups, [["a", "b", "c", "d"]])
+        self.assertEqual(remote.lookups, [["b", "c", "d"]])
+        self.assertEqual(sorted(database.loads), ["c", "d"])
+        # values were written back to the faster tiers in one batch each.
+        self.assertEqual(local.writes, [["b", "c", "d"]])
+        self.assertEqual(remote.writes, [["c", "d"]])
+        self.assertEqual(
+            [entry.priority_name for entry in log_list],
+            ["CACHE", "CACHE", "SYNC_LOOKUP", "CLEANUP"],
+        )
@@ -1,9 +1,28 @@
 
 import unittest
+import collections
 import mock
 import logging
 import testutil
-from coal import Task, TaskPriority, flatten_promises
+from coal import (
+    Task,
+    TaskPriority,
+    Promise,
+    FlattenHandler,
+    FlattenHandlerRegistry,
+    flatten_handlers,
+    flatten_promises,
+)
+
+try:
+    import dataclasses
+except ImportError:
+    dataclasses = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class DummyTask(Task):
@@ -145,7 +164,236 @@ class TestFlattenPromises(unittest.TestCase):
         flatten_promises(string)
         self.assertEqual(string[0], "ha")
 
-        func = lambda: "hey"
+        def func():
+            return "hey"
+
         func_arr = [func]
         flatten_promises(func_arr)
         self.assertEqual(func_arr[0], func)
+
+    def test_fields(self):
+        class Foo(object):
+            def __init__(self, a, b):
+                self.a = a
+                self.b = b
+
+        skipped = DummyTask(3)
+        obj = Foo(
+            [
+                {
+                    "x": DummyTask(1).promise,
+                    "y": skipped.promise,
+                },
+            ],
+            DummyTask(2).then(lambda x: Foo(x, skipped.promise)),
+        )
+
+        log_list = []
+        flatten_promises(obj, log_list=log_list, fields=["a.x", "b.a"])
+
+        self.assertEqual(obj.a[0]["x"], 1)
+        self.assertEqual(obj.a[0]["y"], skipped.promise)
+        self.assertEqual(obj.b.a, 2)
+        self.assertEqual(obj.b.b, skipped.promise)
+        self.assertEqual(
+            sum(batch.count for entry in log_list
+                for batch in entry.task_batches),
+            2,
+        )
+
+    def test_fields_nested_spec(self):
+        d = {
+            "a": {
+                "b": DummyTask(1).promise,
+                "c": DummyTask(2).promise,
+            },
+            "d": DummyTask(3).promise,
+        }
+
+        flatten_promises(d, fields={"a": {"b": True}, "d": True})
+
+        self.assertEqual(d["a"]["b"], 1)
+        self.assertEqual(type(d["a"]["c"]), Promise)
+        self.assertEqual(d["d"], 3)
+
+    def test_shared_and_cyclic(self):
+        class Node(object):
+            def __init__(self, value):
+                self.value = value
+                self.parent = None
+                self.children = []
+
+        shared_promise = DummyTask(7).promise
+        root = Node(DummyTask(1).promise)
+        for i in range(3):
+            child = Node(shared_promise)
+            child.parent = root
+            root.children.append(child)
+        root.children.append(root.children[0])
+
+        log_list = []
+        flatten_promises(root, log_list=log_list)
+
+        self.assertEqual(root.value, 1)
+        self.assertEqual(
+            [child.value for child in root.children],
+            [7, 7, 7, 7],
+        )
+        self.assertEqual(
+            sum(batch.count for entry in log_list
+                for batch in entry.task_batches),
+            2,
+        )
+
+    def test_weak_visited(self):
+        class Foo(object):
+            def __init__(self, a):
+                self.a = a
+                self.me = self
+
+        obj = Foo(DummyTask(4).then(lambda x: Foo(x)))
+        flatten_promises([obj, obj], weak_visited=True)
+
+        self.assertEqual(type(obj.a), Foo)
+        self.assertEqual(obj.a.a, 4)
+
+    def test_deep(self):
+        depth = 100000
+        data = [DummyTask(depth).then(lambda x: [x])]
+        for i in range(depth):
+            data = [data]
+
+        flatten_promises(data)
+
+        for i in range(depth + 1):
+            data = data[0]
+        self.assertEqual(data, [depth])
+
+    def test_tuples(self):
+        Point = collections.namedtuple("Point", ["x", "y"])
+
+        data = {
+            "t": (1, DummyTask(2).promise, (DummyTask(3).promise,)),
+            "p": Point(DummyTask(4).promise, [DummyTask(5).promise]),
+        }
+
+        flatten_promises(data)
+
+        self.assertEqual(data["t"], (1, 2, (3,)))
+        self.assertEqual(type(data["p"]), Point)
+        self.assertEqual(data["p"], Point(4, [5]))
+
+    def test_tuple_fields(self):
+        Point = collections.namedtuple("Point", ["x", "y"])
+
+        data = [Point(DummyTask(1).promise, 2), Point(3, 4)]
+        # fields the namedtuple doesn't have are ignored, as for a dict.
+        self.assertEqual(
+            flatten_promises(data, fields=["x", "z"]),
+            [Point(1, 2), Point(3, 4)],
+        )
+
+    def test_rebuilt_root(self):
+        shared = (DummyTask(1).promise,)
+        result = flatten_promises((shared, [shared]))
+
+        self.assertEqual(result, ((1,), [(1,)]))
+
+    def test_shared_tuples(self):
+        # the shared tuple is visited, as a member of the list, before the
+        # tuple containing it.
+        shared = (DummyTask(1).promise,)
+        self.assertEqual(
+            flatten_promises([(shared,), shared]),
+            [((1,),), (1,)],
+        )
+
+        # and here it's only found within a tuple once a promise resolves.
+        shared = (DummyTask(1).promise,)
+        self.assertEqual(
+            flatten_promises([shared, DummyTask(2).then(lambda x: (shared,))]),
+            [(1,), ((1,),)],
+        )
+
+    def test_sets(self):
+        data = [
+            set([1, DummyTask(2).promise]),
+            frozenset([DummyTask(3).promise]),
+        ]
+
+        flatten_promises(data)
+
+        self.assertEqual(data, [set([1, 2]), frozenset([3])])
+
+    def test_slots(self):
+        class Slotted(object):
+            __slots__ = ("a", "b", "_c")
+
+            def __init__(self, a, b):
+                self.a = a
+                self.b = b
+
+        obj = Slotted(DummyTask(1).promise, Slotted(DummyTask(2).promise, 3))
+
+        flatten_promises(obj)
+
+        self.assertEqual(obj.a, 1)
+        self.assertEqual(obj.b.a, 2)
+        self.assertEqual(
+            FlattenHandlerRegistry(flatten_handlers.handlers).handler_for(
+                Slotted
+            ).__class__.__name__,
+            "SlotsFlattenHandler",
+        )
+
+    def test_custom_handler(self):
+        class Box(object):
+            def __init__(self, contents):
+                self._contents = contents
+
+        class BoxHandler(FlattenHandler):
+            types = (Box,)
+
+            def members(self, obj, spec):
+                yield None, obj._contents, spec
+
+            def replace(self, obj, key, value):
+                obj._contents = value
+
+        handlers = FlattenHandlerRegistry(flatten_handlers.handlers)
+        handlers.register(BoxHandler())
+
+        box = Box(DummyTask(6).promise)
+        flatten_promises([box], handlers=handlers)
+
+        self.assertEqual(box._contents, 6)
+
+    def test_unknown_container(self):
+        class Bag(object):
+            def __contains__(self, item):
+                return False
+
+        self.assertRaises(TypeError, lambda: flatten_promises(Bag()))
+
+    @unittest.skipIf(dataclasses is None, "dataclasses not available")
+    def test_dataclasses(self):
+        Mutable = dataclasses.make_dataclass("Mutable", ["a", "b"])
+        Frozen = dataclasses.make_dataclass("Frozen", ["a"], frozen=True)
+
+        obj = Mutable(DummyTask(1).promise, Frozen(DummyTask(2).promise))
+
+        flatten_promises(obj)
+
+        self.assertEqual(obj, Mutable(1, Frozen(2)))
+
+    @unittest.skipIf(numpy is None, "numpy not available")
+    def test_numpy(self):
+        arr = numpy.empty((2, 2), dtype=object)
+        arr[0, 0] = DummyTask(1).promise
+        arr[0, 1] = 2
+        arr[1, 0] = [DummyTask(3).promise]
+        arr[1, 1] = None
+
+        flatten_promises(arr)
+
+        self.assertEqual(arr.tolist(), [[1, 2], [[3], None]])
@@ -0,0 +1,162 @@
+
+import gc
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from coal import fork
+from coal.adaptive import AdaptiveBatchController
+from coal.asynchronous import AdmissionController
+from coal.backends import ConnectionPool
+from coal.persistence import ResultStore
+from coal.trace import TraceWriter
+
+
+def run_in_child(func):
+    # Runs func in a forked child, returning what it returns, which must
+    # be JSON-serializable.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read_fd)
+            # on Python 3.7+ this has already been called, so does nothing.
+            fork.after_fork_in_child()
+            output = json.dumps({"result": func()})
+        except BaseException as e:
+            output = json.dumps({"error": repr(e)})
+            status = 1
+        try:
+            with os.fdopen(write_fd, "w") as f:
+                f.write(output)
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = json.loads(f.read())
+    os.waitpid(pid, 0)
+    if "error" in output:
+        raise AssertionError("Child failed with %s" % output["error"])
+    return output["result"]
+
+
+class Connection(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(not hasattr(os, "fork"), "needs os.fork")
+class TestFork(unittest.TestCase):
+
+    def test_admission_controller(self):
+        controller = AdmissionController(max_in_flight=1)
+        self.assertTrue(controller.try_admit(int))
+        self.assertFalse(controller.try_admit(int))
+        controller.lock.acquire()
+
+        def child():
+            # the parent's task won't finish in the child, and the lock
+            # it held isn't held by anything here.
+            return controller.try_admit(int)
+
+        self.assertEqual(run_in_child(child), True)
+        controller.lock.release()
+        self.assertEqual(controller.in_flight, 1)
+
+    def test_connection_pool(self):
+        created = []
+
+        def connect():
+            created.append(Connection(len(created)))
+            return created[-1]
+
+        pool = ConnectionPool(connect, max_size=1)
+        pool.release(pool.acquire())
+
+        def child():
+            # the parent's connection is closed, and a new one made.
+            conn = pool.acquire()
+            return [conn.number, created[0].closed, pool.size]
+
+        self.assertEqual(run_in_child(child), [1, True, 1])
+        self.assertEqual(pool.acquire().number, 0)
+        self.assertFalse(created[0].closed)
+
+    def test_warm_state_is_kept(self):
+        controller = AdaptiveBatchController(1)
+        controller.sizes[int] = 7
+        directory = tempfile.mkdtemp()
+        try:
+            store = ResultStore(os.path.join(directory, "results"))
+            store.put((int, (), 1), "one")
+
+            def child():
+                store.put((int, (), 2), "two")
+                return [
+                    controller.batch_size(int),
+                    store.get((int, (), 1)),
+                    store.get((int, (), 2)),
+                ]
+
+            self.assertEqual(run_in_child(child), [7, "one", "two"])
+            store.refresh()
+            self.assertEqual(store.get((int, (), 2)), "two")
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_trace_writer(self):
+        writer = TraceWriter(None)
+
+        def child():
+            return writer._prefix
+
+        self.assertNotEqual(run_in_child(child), writer._prefix)
+
+    def test_prepare_to_fork(self):
+        calls = []
+        pool = ConnectionPool(lambda: Connection(0))
+        conn = pool.acquire()
+        pool.release(conn)
+
+        @fork.warmer
+        def warm():
+            calls.append("warm")
+
+        try:
+            fork.prepare_to_fork()
+        finally:
+            fork._warmers.remove(warm)
+            if hasattr(gc, "unfreeze"):
+                gc.unfreeze()
+
+        self.assertEqual(calls, ["warm"])
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.idle, [])
+
+    def test_only_once_per_process(self):
+        calls = []
+        fork.at_fork(after_in_child=lambda: calls.append(os.getpid()))
+        try:
+            fork.after_fork_in_child()
+            self.assertEqual(calls, [])
+
+            def child():
+                fork.after_fork_in_child()
+                return len(calls)
+
+            self.assertEqual(run_in_child(child), 1)
+        finally:
+            fork._callbacks.pop()
+
+
+if __name__ == "__main__":
+    unittest.main()
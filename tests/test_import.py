@@ -0,0 +1,56 @@
+
+import importlib
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def modules_loaded_by(statement):
+    # the modules that statement loads, in a fresh interpreter, leaving
+    # out Python 2's placeholders for failed relative imports.
+    script = (
+        "import json, sys\n"
+        "before = set(sys.modules)\n"
+        "%s\n"
+        "print(json.dumps(sorted(\n"
+        "    name for name in set(sys.modules) - before\n"
+        "    if sys.modules[name] is not None\n"
+        ")))\n"
+    ) % statement
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT
+    output = subprocess.check_output(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        env=env,
+    )
+    return json.loads(output.decode("utf-8"))
+
+
+class TestImport(unittest.TestCase):
+
+    def test_import_coal(self):
+        loaded = modules_loaded_by("import coal")
+        self.assertTrue("coal" in loaded)
+        # only the private modules that make up the core.
+        self.assertEqual(
+            [name for name in loaded
+             if name.startswith("coal.") and not name.startswith("coal._")],
+            [],
+        )
+        self.assertFalse("threading" in loaded)
+
+    def test_async_shim(self):
+        from coal.asynchronous import AsyncTask
+        shim = importlib.import_module("coal.async")
+        self.assertTrue(shim.AsyncTask is AsyncTask)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "needs module __getattr__")
+    def test_lazy_submodules(self):
+        loaded = modules_loaded_by("import coal; coal.caching.CACHE_MISS")
+        self.assertTrue("coal.caching" in loaded)
+        self.assertFalse("coal.asynchronous" in loaded)
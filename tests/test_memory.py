@@ -0,0 +1,117 @@
+
+import gc
+import unittest
+import weakref
+from coal import Defer, Task, TaskQueue, flatten_promises
+
+
+class DummyTask(Task):
+
+    def __init__(self, result):
+        self.future_result = result
+        super(DummyTask, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.future_result
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(task.future_result)
+
+
+class TestMemory(unittest.TestCase):
+    """
+    Tasks, defers and promises mustn't form reference cycles, so these
+    tests run with the cycle collector disabled and expect everything to be
+    freed by reference counting alone.
+    """
+
+    def setUp(self):
+        gc.collect()
+        self.gc_was_enabled = gc.isenabled()
+        gc.disable()
+
+    def tearDown(self):
+        if self.gc_was_enabled:
+            gc.enable()
+
+    def assert_freed(self, refs):
+        self.assertEqual(
+            [ref for ref in refs if ref() is not None],
+            [],
+        )
+
+    def test_unused_task(self):
+        task = DummyTask(1)
+        refs = [weakref.ref(task), weakref.ref(task.defer)]
+        del task
+        self.assert_freed(refs)
+
+    def test_promise_keeps_task(self):
+        task = DummyTask(1)
+        refs = [weakref.ref(task), weakref.ref(task.defer)]
+        promise = task.then(lambda x: x + 1)
+        del task
+        self.assertTrue(refs[0]() is not None)
+        self.assertTrue(promise.task is refs[0]())
+        del promise
+        self.assert_freed(refs)
+
+    def test_defer(self):
+        defer = Defer()
+        promise = defer.promise.then(lambda x: x + 1)
+        refs = [weakref.ref(defer), weakref.ref(promise)]
+        defer.resolve(1)
+        del defer, promise
+        self.assert_freed(refs)
+
+    def test_flatten_promises(self):
+        data = [
+            {
+                "plain": DummyTask(i).promise,
+                "chained": DummyTask(i).then(lambda x: [
+                    DummyTask(x + 1).then(lambda y: y * 2),
+                ]),
+            }
+            for i in range(1000)
+        ]
+        refs = []
+        for item in data:
+            refs.append(weakref.ref(item["plain"].task))
+            refs.append(weakref.ref(item["chained"].task))
+
+        log_list = []
+        flatten_promises(data, log_list)
+
+        self.assertEqual(data[10], {"plain": 10, "chained": [22]})
+        self.assert_freed(refs)
+
+        # the work log only refers weakly to the tasks.
+        self.assertEqual(log_list[0].task_batches[0].count, 1000)
+        self.assertEqual(log_list[0].task_batches[0].tasks, [])
+
+    def test_task_queue(self):
+        queue = TaskQueue()
+        tasks = [DummyTask(i) for i in range(100)]
+        # (generators, as list comprehensions leak their variable)
+        promises = list(task.promise for task in tasks)
+        refs = list(weakref.ref(task) for task in tasks)
+        queue.add_tasks(tasks)
+        del tasks
+        queue.work()
+
+        results = []
+        promises[5].then(results.append)
+        self.assertEqual(results, [5])
+        del promises
+        self.assert_freed(refs)
+        self.assertEqual(len(queue.results), 100)
+
+    def test_no_garbage(self):
+        data = [DummyTask(i).then(lambda x: [x]) for i in range(100)]
+        flatten_promises(data)
+        del data
+        self.assertEqual(gc.collect(), 0)
+        self.assertEqual(gc.garbage, [])
@@ -0,0 +1,92 @@
+
+import unittest
+from coal import TaskPriority, TaskQueue, flatten_promises, optional
+from coal.simulation import Simulation, constant
+
+
+class TestOptional(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.Get = self.sim.task_type("Get", batch_cost=constant(0.01))
+
+    def fetch_type(self, latency):
+        return self.sim.async_task_type("Fetch", latency=constant(latency))
+
+    def flatten(self, data, **kwargs):
+        queue = kwargs.pop("queue", None) or TaskQueue(clock=self.sim.clock)
+        return flatten_promises(data, queue=queue, **kwargs)
+
+    def test_default_after_timeout(self):
+        Fetch = self.fetch_type(0.5)
+        data = {
+            "user": self.Get(1).promise,
+            "feed": optional(Fetch(2).promise, default=[]),
+        }
+        self.assertEqual(
+            self.flatten(data, timeout=0.1),
+            {"user": 1, "feed": []},
+        )
+        # only as long as the budget, not the slow lookup.
+        self.assertAlmostEqual(self.sim.clock.elapsed, 0.1)
+
+    def test_value_within_timeout(self):
+        Fetch = self.fetch_type(0.05)
+        data = {
+            "user": self.Get(1).promise,
+            "feed": optional(Fetch(2).promise, default=[]),
+        }
+        self.assertEqual(
+            self.flatten(data, timeout=0.1),
+            {"user": 1, "feed": 2},
+        )
+        self.assertAlmostEqual(self.sim.clock.elapsed, 0.05)
+
+    def test_own_timeout(self):
+        Fetch = self.fetch_type(0.2)
+        data = [
+            optional(Fetch(1).promise, timeout=0.1),
+            optional(Fetch(2).promise, default=0, timeout=0.3),
+        ]
+        self.assertEqual(self.flatten(data), [None, 2])
+        self.assertAlmostEqual(self.sim.clock.elapsed, 0.2)
+
+    def test_required_promises_are_waited_for(self):
+        Fetch = self.fetch_type(0.5)
+        data = [Fetch(1).promise, optional(self.Get(2).promise, -1)]
+        self.assertEqual(self.flatten(data, timeout=0.1), [1, 2])
+        self.assertAlmostEqual(self.sim.clock.elapsed, 0.5)
+
+    def test_nested_promises_are_abandoned(self):
+        Quick = self.fetch_type(0.01)
+        Slow = self.sim.async_task_type("Slow", latency=constant(1))
+        quick = Quick(1)
+        data = {
+            "user": self.Get(1).promise,
+            "feed": optional(
+                quick.then(lambda value: {
+                    "items": quick.followup(Slow(value)).promise,
+                }),
+                default={},
+                timeout=0.1,
+            ),
+        }
+        queue = TaskQueue(clock=self.sim.clock)
+        self.assertEqual(
+            self.flatten(data, queue=queue),
+            {"user": 1, "feed": {}},
+        )
+        self.assertAlmostEqual(self.sim.clock.elapsed, 0.1)
+        # the slow task is handed back to the queue it was worked by.
+        self.assertEqual(queue.requeued, 1)
+        self.assertEqual(len(queue.subqueues[TaskPriority.ASYNC_LOOKUP]), 1)
+
+    def test_no_optionals(self):
+        Fetch = self.fetch_type(0.2)
+        data = [Fetch(1).promise, self.Get(2).promise]
+        self.assertEqual(self.flatten(data, timeout=0.1), [1, 2])
+        self.assertAlmostEqual(self.sim.clock.elapsed, 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+from coal import Task, TaskQueue, flatten_promises
+from coal.persistence import ResultStore, ResultStoreError
+
+
+class Square(Task):
+    persist_results = True
+    worked = []
+
+    def __init__(self, number):
+        self.number = number
+        super(Square, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.number
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            cls.worked.append(task.number)
+            task.resolve(task.number * task.number)
+
+
+class TestPersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "results")
+        Square.worked = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get(self):
+        store = ResultStore(self.path)
+        store.put((Square, (), 1), {"a": [1, 2]})
+        store.put((Square, (), 2), None)
+        store.put((Square, (), 1), "updated")
+
+        self.assertEqual(store.get((Square, (), 1)), "updated")
+        self.assertEqual(store.get((Square, (), 2), "missing"), None)
+        self.assertEqual(store.get((Square, (), 3), "missing"), "missing")
+        self.assertEqual(len(store), 2)
+        store.close()
+
+        # warm start from the file.
+        store = ResultStore(self.path)
+        self.assertEqual(store.get((Square, (), 1)), "updated")
+        self.assertTrue((Square, (), 2) in store)
+        store.close()
+
+    def test_not_a_store(self):
+        with open(self.path, "wb") as f:
+            f.write(b"something else")
+        self.assertRaises(ResultStoreError, ResultStore, self.path)
+
+    def test_task_queue(self):
+        store = ResultStore(self.path)
+        data = [Square(i).promise for i in range(5)]
+        flatten_promises(data, queue=TaskQueue(result_store=store))
+        self.assertEqual(data, [0, 1, 4, 9, 16])
+        self.assertEqual(Square.worked, [0, 1, 2, 3, 4])
+        store.close()
+
+        # a new process would find them in the store.
+        Square.worked = []
+        store = ResultStore(self.path)
+        data = [Square(i).promise for i in range(3, 7)]
+        flatten_promises(data, queue=TaskQueue(result_store=store))
+        self.assertEqual(data, [9, 16, 25, 36])
+        self.assertEqual(sorted(Square.worked), [5, 6])
+        self.assertEqual(len(store), 7)
+
+        # task types have to opt in.
+        class Unpersisted(Square):
+            persist_results = False
+
+        flatten_promises(
+            [Unpersisted(8).promise],
+            queue=TaskQueue(result_store=store),
+        )
+        self.assertEqual(len(store), 7)
+        store.close()
+
+    def test_compaction(self):
+        store = ResultStore(self.path, max_size=2000)
+        for i in range(200):
+            store.put((Square, (), i), "x" * 20)
+            self.assertTrue(os.path.getsize(self.path) <= 2000)
+
+        # only the most recent results are kept.
+        self.assertEqual(store.get((Square, (), 199)), "x" * 20)
+        self.assertEqual(store.get((Square, (), 0)), None)
+        self.assertTrue(0 < len(store) < 200)
+        store.close()
+
+        store = ResultStore(self.path)
+        self.assertEqual(store.get((Square, (), 199)), "x" * 20)
+        store.compact()
+        self.assertEqual(store.get((Square, (), 199)), "x" * 20)
+        store.close()
+
+    def test_compaction_large_record(self):
+        store = ResultStore(self.path, max_size=2000)
+        store.put((Square, (), 1), 1)
+        store.put((Square, (), 2), "x" * 3000)
+
+        # the result that was just put is kept, even though it's too big.
+        self.assertEqual(store.get((Square, (), 2)), "x" * 3000)
+        self.assertEqual(store.get((Square, (), 1)), None)
+        store.close()
+
+        store = ResultStore(self.path)
+        self.assertEqual(store.get((Square, (), 2)), "x" * 3000)
+        store.close()
+
+    def test_readonly_sharing(self):
+        writer = ResultStore(self.path, max_size=4000)
+        writer.put((Square, (), 1), 1)
+
+        reader = ResultStore(self.path, readonly=True)
+        self.assertEqual(reader.get((Square, (), 1)), 1)
+        self.assertRaises(ResultStoreError, reader.put, (Square, (), 2), 4)
+
+        writer.put((Square, (), 2), 4)
+        self.assertEqual(reader.get((Square, (), 2)), None)
+        reader.refresh()
+        self.assertEqual(reader.get((Square, (), 2)), 4)
+
+        # the reader follows the writer to the compacted file.
+        writer.compact()
+        writer.put((Square, (), 3), 9)
+        reader.refresh()
+        self.assertEqual(reader.get((Square, (), 3)), 9)
+        self.assertEqual(reader.get((Square, (), 1)), 1)
+
+        reader.close()
+        writer.close()
+
+    def test_partial_record(self):
+        store = ResultStore(self.path)
+        store.put((Square, (), 1), 1)
+        store.put((Square, (), 2), 4)
+        store.close()
+
+        # as if the process died while writing the last record.
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+
+        store = ResultStore(self.path)
+        self.assertEqual(store.get((Square, (), 1)), 1)
+        self.assertFalse((Square, (), 2) in store)
+        store.put((Square, (), 3), 9)
+        store.close()
+
+        store = ResultStore(self.path)
+        self.assertEqual(store.get((Square, (), 3)), 9)
+        store.close()
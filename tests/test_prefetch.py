@@ -0,0 +1,91 @@
+
+import unittest
+import testutil
+from coal import Task, TaskPriority
+from coal.prefetch import Prefetcher
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_prefetch(self):
+        fake_cache = {
+            "user": "post",
+            "post": "comment",
+            "comment": "done",
+        }
+        lookups = []
+
+        class TryCache(Task):
+            priority = TaskPriority.CACHE
+
+            def __init__(self, key):
+                self.key = key
+                super(TryCache, self).__init__()
+
+            @property
+            def coalesce_key(self):
+                return self.key
+
+            @classmethod
+            def prefetch_task(cls, batch_key, coalesce_key):
+                return cls(coalesce_key)
+
+            @classmethod
+            def work(cls, tasks):
+                lookups.append(sorted(task.key for task in tasks))
+                for task in tasks:
+                    task.resolve(fake_cache[task.key])
+
+        def follow(key):
+            if key == "done":
+                return key
+            return [TryCache(key).then(follow)]
+
+        prefetcher = Prefetcher()
+
+        data = follow("user")
+        log_list = []
+        prefetcher.flatten_promises("page", data, log_list=log_list)
+        self.assertEqual(data, [[["done"]]])
+        self.assertEqual(lookups, [["user"], ["post"], ["comment"]])
+
+        lookups[:] = []
+        data = follow("user")
+        log_list = []
+        prefetcher.flatten_promises("page", data, log_list=log_list)
+        self.assertEqual(data, [[["done"]]])
+        # the later lookups were all prefetched into the first round-trip.
+        self.assertEqual(lookups, [["comment", "post", "user"]])
+
+        self.assertEqual(
+            sorted(key[2] for key in prefetcher.likely_keys("page")),
+            ["comment", "post", "user"],
+        )
+        self.assertEqual(prefetcher.likely_keys("other"), [])
+
+    def test_history(self):
+        class Lookup(Task):
+            priority = TaskPriority.CACHE
+
+            def __init__(self, key):
+                self.key = key
+                super(Lookup, self).__init__()
+
+            @property
+            def coalesce_key(self):
+                return self.key
+
+            @classmethod
+            def prefetch_task(cls, batch_key, coalesce_key):
+                return cls(coalesce_key)
+
+        prefetcher = Prefetcher(history=2, threshold=1)
+        for keys in (["a", "b"], ["a"], ["a", "c"]):
+            queue = prefetcher.task_queue()
+            queue.add_tasks(Lookup(key) for key in keys)
+            prefetcher.record("page", queue)
+
+        self.assertEqual(
+            [key[2] for key in prefetcher.likely_keys("page")],
+            ["a"],
+        )
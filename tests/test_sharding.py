@@ -0,0 +1,138 @@
+
+import unittest
+import threading
+import testutil
+from coal import TaskQueue, flatten_promises
+from coal.sharding import HashRing, ShardedTask
+
+
+class TestSharding(unittest.TestCase):
+
+    assert_work_log = testutil.assert_work_log
+
+    def test_hash_ring(self):
+        ring = HashRing(["a", "b", "c"])
+        keys = ["key%i" % i for i in range(1000)]
+        before = dict((key, ring.node_for(key)) for key in keys)
+
+        # every node gets a reasonable share of the keys.
+        for node in ("a", "b", "c"):
+            share = sum(1 for key in keys if before[key] == node)
+            self.assertTrue(200 < share < 500, (node, share))
+
+        # adding a node only moves keys to that node.
+        bigger = HashRing(["a", "b", "c", "d"])
+        for key in keys:
+            after = bigger.node_for(key)
+            self.assertTrue(after == before[key] or after == "d")
+
+        self.assertRaises(ValueError, lambda: HashRing([]).node_for("x"))
+
+    def test_sharded_task(self):
+        calls = []
+        concurrent = []
+        lock = threading.Lock()
+        both_started = threading.Event()
+
+        class Get(ShardedTask):
+            hash_ring = HashRing(["a", "b"])
+
+            def __init__(self, key):
+                self.key = key
+                super(Get, self).__init__()
+
+            @property
+            def coalesce_key(self):
+                return self.key
+
+            @classmethod
+            def work_shard(cls, node, tasks):
+                with lock:
+                    calls.append((node, sorted(task.key for task in tasks)))
+                    if len(calls) == 2:
+                        both_started.set()
+                # worked one after the other, the first would time out.
+                concurrent.append(both_started.wait(5))
+                return [(node, task.key) for task in tasks]
+
+        keys = ["key%i" % i for i in range(20)]
+        tasks = [Get(key) for key in keys]
+        queue = TaskQueue()
+        queue.add_tasks(tasks)
+        log_list = []
+        queue.work(log_list=log_list)
+
+        # the two shards were worked concurrently.
+        self.assertEqual(concurrent, [True, True])
+        self.assertEqual(
+            sorted(calls),
+            [
+                (node, sorted(
+                    key for key in keys
+                    if Get.hash_ring.node_for(key) == node
+                ))
+                for node in ("a", "b")
+            ],
+        )
+        results = []
+        for task in tasks:
+            task.then(results.append)
+        self.assertEqual(
+            results,
+            [(Get.hash_ring.node_for(key), key) for key in keys],
+        )
+
+        self.assert_work_log(log_list, [
+            ('SYNC_LOOKUP', [
+                ('Get', (), 20),
+            ]),
+        ])
+        self.assertEqual(
+            log_list[0].task_batches[0].shards,
+            dict((node, len(node_keys)) for node, node_keys in calls),
+        )
+
+    def test_callbacks_run_in_queue_thread(self):
+        class Get(ShardedTask):
+            hash_ring = HashRing(["node%i" % i for i in range(8)])
+
+            def __init__(self, key):
+                self.key = key
+                super(Get, self).__init__()
+
+            @property
+            def coalesce_key(self):
+                return self.key
+
+            @classmethod
+            def work_shard(cls, node, tasks):
+                return [task.key for task in tasks]
+
+        threads = set()
+
+        def lookup(key):
+            task = Get(key)
+
+            def followup(value):
+                threads.add(threading.current_thread())
+                return task.followup(Get(("followup", value))).promise
+            return task.then(followup)
+
+        data = [lookup(i) for i in range(400)]
+        self.assertEqual(
+            flatten_promises(data),
+            [("followup", i) for i in range(400)],
+        )
+        self.assertEqual(threads, set([threading.current_thread()]))
+
+    def test_errors(self):
+        class Broken(ShardedTask):
+            hash_ring = HashRing(["a", "b"])
+
+            @classmethod
+            def work_shard(cls, node, tasks):
+                raise KeyError(node)
+
+        queue = TaskQueue()
+        queue.add_tasks(Broken() for i in range(10))
+        self.assertRaises(KeyError, queue.work)
@@ -0,0 +1,164 @@
+
+import unittest
+from datetime import datetime
+from coal import TaskPriority, TaskQueue, flatten_promises, optional
+from coal.asynchronous import AdmissionController
+from coal.simulation import (
+    Simulation,
+    VirtualClock,
+    constant,
+    exponential,
+    linear_cost,
+    lognormal,
+)
+
+
+class TestSimulation(unittest.TestCase):
+
+    def assertLatencies(self, simulation, expected):
+        self.assertEqual(len(simulation.latencies), len(expected))
+        for latency, value in zip(simulation.latencies, expected):
+            self.assertAlmostEqual(latency, value)
+
+    def test_virtual_clock(self):
+        clock = VirtualClock(datetime(2014, 1, 1))
+        clock.advance(1.5)
+        clock.advance_to(1.0)
+        self.assertEqual(clock.elapsed, 1.5)
+        self.assertEqual(clock.now(), datetime(2014, 1, 1, 0, 0, 1, 500000))
+
+        # the queue times its batches with it.
+        sim = Simulation()
+        Get = sim.task_type("Get", batch_cost=constant(0.25))
+        log_list = []
+        data = [Get(1).promise]
+        flatten_promises(
+            data,
+            queue=TaskQueue(clock=sim.clock),
+            log_list=log_list,
+        )
+        batch = log_list[0].task_batches[0]
+        self.assertEqual(batch.time_spent.total_seconds(), 0.25)
+
+    def test_batches(self):
+        sim = Simulation()
+        Get = sim.task_type(
+            "Get",
+            latency=constant(0.002),
+            batch_cost=linear_cost(0.001, 0.0001),
+            max_batch_size=10,
+        )
+
+        def request(random):
+            return [Get(i % 15).promise for i in range(20)]
+
+        sim.run(request, count=2)
+        # 15 distinct keys in two batches, for each request.
+        self.assertLatencies(sim, [0.0075, 0.0075])
+        self.assertEqual(sim.backend_calls, {"Get": 4})
+        self.assertEqual(sim.tasks_worked, {"Get": 30})
+
+    def test_async_overlap(self):
+        sim = Simulation()
+        Get = sim.task_type("Get", batch_cost=constant(0.01))
+        Fetch = sim.async_task_type("Fetch", latency=constant(0.05))
+
+        def request(random):
+            return [Fetch(1).promise, Get(1).promise]
+
+        sim.run(request)
+        self.assertLatencies(sim, [0.05])
+
+    def test_completion_order(self):
+        def run(notifies_completion):
+            sim = Simulation()
+            Get = sim.task_type("Get", batch_cost=constant(0.02))
+            Fetch = sim.async_task_type(
+                "Fetch",
+                latency=lambda random: 0.01 if key[0] == 1 else 0.1,
+                notifies_completion=notifies_completion,
+            )
+            key = [None]
+
+            def fetch(i):
+                key[0] = i
+                return Fetch(i)
+
+            def request(random):
+                first = fetch(1)
+                return [
+                    first.then(lambda value: first.followup(Get(value))),
+                    fetch(2),
+                ]
+
+            return sim.run(request)
+
+        # the followup of the quick task runs while the slow one works.
+        self.assertLatencies(run(True), [0.1])
+        self.assertLatencies(run(False), [0.12])
+
+    def test_optional_timeout(self):
+        sim = Simulation()
+        Fetch = sim.async_task_type("Fetch", latency=constant(0.1))
+
+        def request(random):
+            return [optional(Fetch(1).promise, default=0, timeout=0.03)]
+
+        # the clock only moves on as far as the timeout.
+        sim.run(request)
+        self.assertLatencies(sim, [0.03])
+
+    def test_admission(self):
+        sim = Simulation()
+        Fetch = sim.async_task_type(
+            "Fetch",
+            latency=constant(0.01),
+            admission=AdmissionController(max_in_flight=1),
+        )
+
+        def request(random):
+            return [Fetch(i).promise for i in range(3)]
+
+        sim.run(request, count=2)
+        # one works in the background, while the others are worked one at
+        # a time, and the slot is free again for the next request.
+        self.assertLatencies(sim, [0.02, 0.02])
+        self.assertEqual(Fetch.admission.admitted, 2)
+        self.assertEqual(Fetch.admission.in_flight, 0)
+        self.assertEqual(sim.backend_calls, {"Fetch": 6})
+
+    def test_deterministic(self):
+        def run():
+            sim = Simulation(seed=3)
+            Cache = sim.task_type(
+                "Cache",
+                priority=TaskPriority.CACHE,
+                latency=exponential(0.001),
+            )
+            Get = sim.task_type("Get", latency=exponential(0.002))
+            Fetch = sim.async_task_type("Fetch", latency=lognormal(0.01, 1))
+
+            def fetch_then_get(key):
+                fetch = Fetch(key)
+                return fetch.then(lambda value: fetch.followup(Get(value)))
+
+            def request(random):
+                keys = random.sample(range(100), 10)
+                return {
+                    "cached": [Cache(k).promise for k in keys],
+                    "users": [fetch_then_get(k) for k in keys[:3]],
+                }
+
+            return sim.run(request, count=50)
+
+        first = run()
+        second = run()
+        self.assertEqual(first.latencies, second.latencies)
+        self.assertEqual(first.report(), second.report())
+        self.assertTrue("requests: 50" in first.report())
+        self.assertEqual(first.backend_calls["Fetch"], 150)
+        self.assertEqual(first.tasks_worked["Get"], 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+
+import os
+import subprocess
+import sys
+import unittest
+
+import coal
+from coal import Defer, DuplicateResolutionError, Task, TaskQueue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS = os.path.join(ROOT, "tests")
+
+
+class Keyed(Task):
+
+    def __init__(self, batch_key, coalesce_key):
+        self._batch_key = batch_key
+        self._coalesce_key = coalesce_key
+        super(Keyed, self).__init__()
+
+    @property
+    def batch_key(self):
+        return self._batch_key
+
+    @property
+    def coalesce_key(self):
+        return self._coalesce_key
+
+
+class PyDefer(coal._PyDeferBase):
+    # a Defer with the pure-Python implementation, whichever is in use.
+    NOT_YET_RESOLVED = Defer.NOT_YET_RESOLVED
+
+    def __init__(self):
+        self.pending = []
+        self.value = self.NOT_YET_RESOLVED
+
+
+if coal._TaskQueueBase is coal._PyTaskQueueBase:
+    PyTaskQueue = TaskQueue
+else:
+    class PyTaskQueue(coal._PyTaskQueueBase, TaskQueue):
+        pass
+
+
+class TestSpeedups(unittest.TestCase):
+
+    def defer_types(self):
+        return [PyDefer, Defer]
+
+    def test_selection(self):
+        if coal._speedups is None:
+            self.assertTrue(coal._DeferBase is coal._PyDeferBase)
+            self.assertTrue(coal._TaskQueueBase is coal._PyTaskQueueBase)
+        else:
+            self.assertTrue(
+                Defer.resolve is coal._speedups.defer_resolve or
+                Defer.resolve.__func__ is coal._speedups.defer_resolve
+            )
+            self.assertTrue(isinstance(
+                TaskQueue().add_tasks.__doc__, type("")
+            ))
+
+    def test_defer_equivalence(self):
+        for defer_type in self.defer_types():
+            calls = []
+            defer = defer_type()
+            defer._add_callback(calls.append)
+            defer.resolve(1)
+            defer._add_callback(calls.append)
+            self.assertEqual(calls, [1, 1])
+            self.assertEqual(defer.pending, None)
+            self.assertRaises(DuplicateResolutionError, defer.resolve, 2)
+
+            # a promise value passes its eventual value to the callbacks.
+            inner = Defer()
+            defer = defer_type()
+            defer._add_callback(calls.append)
+            defer.resolve(inner.promise)
+            defer._add_callback(calls.append)
+            self.assertEqual(calls, [1, 1])
+            inner.resolve(2)
+            self.assertEqual(calls, [1, 1, 2, 2])
+
+    def test_chain_equivalence(self):
+        for chain in (coal._py_chain, coal._chain):
+            result = Defer()
+            chain(result, lambda x: x * 2)(3)
+            self.assertEqual(result.value, 6)
+            self.assertRaises(
+                ZeroDivisionError,
+                chain(Defer(), lambda x: 1 / x),
+                0,
+            )
+
+    def test_callback_errors(self):
+        def fail(value):
+            raise KeyError(value)
+
+        for defer_type in self.defer_types():
+            defer = defer_type()
+            defer._add_callback(fail)
+            self.assertRaises(KeyError, defer.resolve, 1)
+
+    def test_task_queue_equivalence(self):
+        for queue_type in (PyTaskQueue, TaskQueue):
+            queue = queue_type()
+            tasks = [Keyed(i % 2, i % 3) for i in range(6)]
+            self.assertTrue(queue.add_task(tasks[0]) is tasks[0])
+            queue.add_tasks(tasks[1:])
+            queue.add_task(tasks[0])
+
+            subqueue = queue.subqueues[Keyed.priority]
+            self.assertEqual(
+                dict(
+                    (key, sorted(batch))
+                    for key, batch in subqueue.items()
+                ),
+                {(Keyed, 0): [0, 1, 2], (Keyed, 1): [0, 1, 2]},
+            )
+            self.assertEqual(queue.merges[Keyed.priority], {})
+            queue.add_task(Keyed(0, 0))
+            queue.add_tasks([Keyed(0, 0), Keyed(1, 2)])
+            self.assertEqual(
+                queue.merges[Keyed.priority],
+                {(Keyed, 0): 2, (Keyed, 1): 1},
+            )
+            self.assertRaises(TypeError, queue.add_task, Keyed([], 0))
+
+    @unittest.skipIf(coal._speedups is None, "coal._speedups isn't built")
+    def test_pure_python_suite(self):
+        # the rest of the suite runs with the speedups, so run all of it
+        # again without them.
+        env = dict(os.environ)
+        env["COAL_NO_SPEEDUPS"] = "1"
+        env["PYTHONPATH"] = ROOT
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "unittest", "discover",
+                "-s", TESTS, "-p", "test_*.py",
+            ],
+            cwd=TESTS,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output.decode("utf-8"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+
+import random
+import threading
+import unittest
+from coal import Task, TaskQueue, flatten_promises
+from coal.asynchronous import ThreadTask
+from coal.stats import CoalescingStats, HotKeys
+
+
+class Get(Task):
+
+    def __init__(self, key):
+        self.key = key
+        super(Get, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(task.key)
+
+
+class Other(Task):
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(None)
+
+
+class Fetch(ThreadTask):
+
+    def __init__(self, key, release=None):
+        self.key = key
+        self.release = release
+        super(Fetch, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    def thread_work(self):
+        if self.release is not None:
+            self.release.wait()
+        return self.key
+
+
+class TestHotKeys(unittest.TestCase):
+
+    def test_exact_within_capacity(self):
+        sketch = HotKeys(capacity=3)
+        for key in "abacab":
+            sketch.add(key)
+        self.assertEqual(
+            sketch.top(),
+            [("a", 3, 0), ("b", 2, 0), ("c", 1, 0)],
+        )
+        self.assertEqual(sketch.top(1), [("a", 3, 0)])
+
+    def test_eviction(self):
+        sketch = HotKeys(capacity=2)
+        for key in "aaabc":
+            sketch.add(key)
+        # c replaced b, the least counted, and took over its count.
+        self.assertEqual(sketch.top(), [("a", 3, 0), ("c", 2, 1)])
+        self.assertEqual(sketch.total, 5)
+
+    def test_bounded(self):
+        sketch = HotKeys(capacity=10)
+        rand = random.Random(0)
+        for i in range(5000):
+            if i % 4 == 0:
+                sketch.add("hot")
+            else:
+                sketch.add(rand.randint(0, 1000))
+        self.assertEqual(len(sketch), 10)
+        key, count, error = sketch.top(1)[0]
+        self.assertEqual(key, "hot")
+        self.assertTrue(count - error <= 1250 <= count)
+
+
+class TestCoalescingStats(unittest.TestCase):
+
+    def test_counts(self):
+        stats = CoalescingStats()
+        for i in range(2):
+            queue = TaskQueue(stats=stats)
+            data = [Get(1).promise, Get(1).promise, Get(2).promise]
+            self.assertEqual(flatten_promises(data, queue=queue), [1, 1, 2])
+            # resolved from the queue's earlier result.
+            queue.add_task(Get(2))
+            queue.work()
+
+        self.assertEqual(stats.requested[Get], 8)
+        self.assertEqual(stats.merged[Get], 2)
+        self.assertEqual(stats.cached[Get], 2)
+        self.assertEqual(stats.worked[Get], 4)
+        self.assertEqual(stats.coalescing_efficiency(Get), 0.5)
+        self.assertEqual(stats.coalescing_efficiency(Other), 0.0)
+        self.assertTrue("Get: 8 requested" in stats.report())
+
+    def test_hot_keys(self):
+        stats = CoalescingStats(capacity=2)
+        queue = TaskQueue(stats=stats)
+        queue.add_tasks([Get(1), Get(1), Get(2), Other(), Get(3)])
+        queue.work()
+        queue = TaskQueue(stats=stats)
+        queue.add_tasks([Get(3), Other()])
+        queue.work()
+
+        # tasks without a coalesce key aren't tracked, merged tasks only
+        # count once per batch, and 3 took over the count of 1.
+        self.assertEqual(
+            stats.hot_keys(),
+            [((Get, (), 3), 3, 1), ((Get, (), 2), 1, 0)],
+        )
+        self.assertEqual(stats.hot_keys(1), [((Get, (), 3), 3, 1)])
+        self.assertEqual(stats.hot_keys(task_type=Other), [])
+
+    def test_requeued(self):
+        stats = CoalescingStats()
+        queue = TaskQueue(stats=stats)
+        release = threading.Event()
+
+        class Release(Get):
+            @classmethod
+            def work(cls, tasks):
+                release.set()
+                super(Release, cls).work(tasks)
+
+        fast = Fetch("fast")
+        slow = Fetch("slow", release)
+        data = [
+            fast.then(lambda value: fast.followup(Release(value)).promise),
+            slow.promise,
+        ]
+        # the slow task is handed back while the followup is worked, and
+        # only counted the first time around.
+        self.assertEqual(
+            flatten_promises(data, queue=queue),
+            ["fast", "slow"],
+        )
+        self.assertEqual(queue.requeued, 1)
+        self.assertEqual(stats.requested[Fetch], 2)
+        self.assertEqual(stats.worked[Fetch], 2)
+        self.assertEqual(
+            sorted(stats.hot_keys(task_type=Fetch)),
+            [((Fetch, (), "fast"), 1, 0), ((Fetch, (), "slow"), 1, 0)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
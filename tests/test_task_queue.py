@@ -3,7 +3,29 @@ import unittest
 import mock
 import logging
 import testutil
-from coal import Task, TaskQueue, TaskPriority, Promise
+from coal import (
+    DuplicateResolutionError,
+    Promise,
+    Task,
+    TaskPriority,
+    TaskQueue,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Double(Task):
+
+    def __init__(self, number):
+        self.number = number
+        super(Double, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.number
 
 
 class TestTaskQueue(unittest.TestCase):
@@ -168,3 +190,123 @@ class TestTaskQueue(unittest.TestCase):
                 ('TaskType2', 'a', 1)
             ]),
         ])
+
+    def test_add_same_task_twice(self):
+        task = testutil.MockTask(TaskPriority.CACHE, 'a', 'b')
+        callback = mock.MagicMock()
+        task.then(callback)
+
+        queue = TaskQueue()
+        queue.add_task(task)
+        queue.add_task(task)
+
+        task.resolve(3)
+        callback.assert_called_once_with(3)
+
+    def test_work_return_value_ignored(self):
+        class Counted(Double):
+            @classmethod
+            def work(cls, tasks):
+                for task in tasks:
+                    task.resolve(task.number * 2)
+                return len(tasks)
+
+        queue = TaskQueue()
+        task = queue.add_task(Counted(4))
+        log_list = []
+        self.assertEqual(queue.work(log_list=log_list), 1)
+        self.assertEqual(log_list[0].task_batches[0].shards, None)
+        task.then(lambda value: self.assertEqual(value, 8))
+
+    def test_resolve_many(self):
+        queue = TaskQueue()
+        tasks = [Double(i) for i in range(5)]
+        queue.add_tasks(tasks)
+        results = []
+        for task in tasks:
+            task.then(results.append)
+
+        Double.resolve_many(tasks, (task.number * 2 for task in tasks))
+
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        self.assertEqual(queue.results[(Double, (), 3)], 6)
+        self.assertRaises(ValueError, Double.resolve_many, tasks, [1])
+
+    def test_resolve_many_callback_error(self):
+        queue = TaskQueue()
+        tasks = [Double(i) for i in range(3)]
+        queue.add_tasks(tasks)
+
+        def fail(value):
+            raise ValueError(value)
+        tasks[0].then(fail)
+
+        self.assertRaises(
+            ValueError,
+            Double.resolve_many, tasks, [0, 2, 4],
+        )
+        self.assertEqual(queue.results, {
+            (Double, (), 0): 0,
+            (Double, (), 1): 2,
+            (Double, (), 2): 4,
+        })
+
+    def test_resolve_twice(self):
+        queue = TaskQueue()
+        task = queue.add_task(Double(1))
+        task.resolve(2)
+
+        self.assertRaises(DuplicateResolutionError, task.resolve, 3)
+        self.assertRaises(
+            DuplicateResolutionError, Double.resolve_many, [task], [3],
+        )
+        self.assertEqual(queue.results, {(Double, (), 1): 2})
+
+    def test_result_store_error(self):
+        class Persisted(Double):
+            persist_results = True
+
+        class BrokenStore(object):
+            def get(self, key, default):
+                return default
+
+            def put(self, key, value):
+                raise ValueError(value)
+
+        queue = TaskQueue(result_store=BrokenStore())
+        task = queue.add_task(Persisted(1))
+        tasks = [Persisted(2), Persisted(3)]
+        queue.add_tasks(tasks)
+        results = []
+        for each in [task] + tasks:
+            each.then(results.append)
+
+        # the tasks are resolved even though their results can't be kept.
+        self.assertRaises(ValueError, task.resolve, 2)
+        self.assertRaises(ValueError, Persisted.resolve_many, tasks, [4, 6])
+        self.assertEqual(results, [2, 4, 6])
+
+    def test_resolve_many_queues(self):
+        queue_1 = TaskQueue()
+        queue_2 = TaskQueue()
+        task_1 = queue_1.add_task(Double(1))
+        task_2 = queue_2.add_task(Double(2))
+
+        Double.resolve_many([task_1, task_2], [2, 4])
+
+        self.assertEqual(queue_1.results, {(Double, (), 1): 2})
+        self.assertEqual(queue_2.results, {(Double, (), 2): 4})
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_resolve_many_numpy(self):
+        queue = TaskQueue()
+        tasks = [Double(i) for i in range(4)]
+        queue.add_tasks(tasks)
+        results = []
+        for task in tasks:
+            task.then(results.append)
+
+        Double.resolve_many(tasks, numpy.arange(4) * 2)
+
+        self.assertEqual(results, [0, 2, 4, 6])
+        self.assertEqual(type(results[0]), int)
@@ -0,0 +1,143 @@
+
+import unittest
+import mock
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import tempfile
+import os
+from coal import Task, TaskQueue, TaskPriority
+from coal.trace import TraceWriter, TraceAnalysis, read_trace, replay, main
+
+
+class Lookup(Task):
+    priority = TaskPriority.CACHE
+
+    def __init__(self, key):
+        self.key = key
+        super(Lookup, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(task.key)
+
+
+class Load(Task):
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(None)
+
+
+def traced_request():
+    queue = TaskQueue()
+    first = Lookup("a")
+    first.then(lambda value: first.followup(Load()))
+    queue.add_tasks([first, Lookup("a"), Lookup("b")])
+    log_list = []
+    queue.work(log_list=log_list)
+    return log_list
+
+
+class TestTrace(unittest.TestCase):
+
+    def write_trace(self, count):
+        fileobj = StringIO()
+        writer = TraceWriter(fileobj)
+        for i in range(count):
+            writer.write(traced_request())
+        return fileobj.getvalue()
+
+    def test_round_trip(self):
+        trace = self.write_trace(2)
+        requests = list(read_trace(StringIO(trace)))
+
+        self.assertEqual(len(requests), 2)
+        self.assertNotEqual(
+            requests[0][0]["request"],
+            requests[1][0]["request"],
+        )
+        self.assertEqual(
+            [
+                (r["phase"], r["priority"], r["task_type"], r["count"],
+                 r["merged"])
+                for r in requests[0]
+            ],
+            [
+                (0, "CACHE", "test_trace.Lookup", 2, 1),
+                (1, "SYNC_LOOKUP", "test_trace.Load", 1, 0),
+            ],
+        )
+
+    def test_analysis(self):
+        trace = self.write_trace(3)
+        analysis = TraceAnalysis(read_trace(StringIO(trace)))
+
+        self.assertEqual(analysis.request_count, 3)
+        self.assertEqual(analysis.phase_counts, [2, 2, 2])
+        self.assertEqual(len(analysis.critical_paths), 3)
+        self.assertEqual(analysis.batch_sizes["test_trace.Lookup"], [2, 2, 2])
+        self.assertAlmostEqual(
+            analysis.coalescing_efficiency("test_trace.Lookup"),
+            1.0 / 3,
+        )
+        self.assertEqual(
+            analysis.coalescing_efficiency("test_trace.Load"),
+            0.0,
+        )
+        self.assertTrue("requests: 3" in analysis.report())
+
+    def test_replay(self):
+        trace = self.write_trace(2)
+        log_list = []
+        elapsed = replay(
+            read_trace(StringIO(trace)),
+            speed=0,
+            log_list=log_list,
+        )
+
+        self.assertTrue(elapsed >= 0)
+        self.assertEqual(
+            [
+                (entry.priority_name, [
+                    (batch.task_type.__name__, batch.count)
+                    for batch in entry.task_batches
+                ])
+                for entry in log_list
+            ],
+            [
+                ("CACHE", [("Lookup", 2)]),
+                ("SYNC_LOOKUP", [("Load", 1)]),
+            ] * 2,
+        )
+
+    def test_main(self):
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "w") as fileobj:
+                fileobj.write(self.write_trace(1))
+
+            with mock.patch("sys.stdout", new_callable=StringIO) \
+                    as stdout:
+                main(["analyze", filename])
+                main(["replay", "--speed", "0", filename])
+
+            output = stdout.getvalue()
+            self.assertTrue("requests: 1" in output)
+            self.assertTrue("replayed 1 requests" in output)
+        finally:
+            os.unlink(filename)
+
+    def test_main_without_command(self):
+        with mock.patch("sys.stderr", new_callable=StringIO) as stderr:
+            with self.assertRaises(SystemExit) as raised:
+                main([])
+        self.assertEqual(raised.exception.code, 2)
+        self.assertTrue("usage:" in stderr.getvalue())
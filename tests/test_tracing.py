@@ -0,0 +1,77 @@
+
+import unittest
+import testutil
+from coal import Task, TaskQueue, TaskPriority
+from coal.tracing import InMemoryTracer
+
+
+class Lookup(Task):
+    priority = TaskPriority.CACHE
+
+    def __init__(self, key):
+        self.key = key
+        super(Lookup, self).__init__()
+
+    @property
+    def coalesce_key(self):
+        return self.key
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(task.key)
+
+
+class Load(Task):
+
+    @classmethod
+    def work(cls, tasks):
+        for task in tasks:
+            task.resolve(None)
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_spans(self):
+        tracer = InMemoryTracer()
+        queue = TaskQueue(tracer=tracer)
+
+        first = Lookup("a")
+        first.then(lambda value: first.followup(Load()))
+        queue.add_tasks([first, Lookup("a"), Lookup("b")])
+        queue.work()
+
+        work_spans = tracer.root_spans
+        self.assertEqual([span.name for span in work_spans], ["coal.work"])
+        self.assertEqual(work_spans[0].attributes["coal.cycles"], 2)
+        self.assertEqual(work_spans[0].attributes["coal.attempted"], 3)
+
+        phase_spans = work_spans[0].children
+        self.assertEqual(
+            [span.attributes["coal.priority"] for span in phase_spans],
+            ["CACHE", "SYNC_LOOKUP"],
+        )
+
+        batch_spans = tracer.spans("coal.batch")
+        self.assertEqual(
+            [
+                (
+                    span.parent.attributes["coal.priority"],
+                    span.attributes["coal.task_type"],
+                    span.attributes["coal.batch.size"],
+                    span.attributes["coal.batch.coalesced"],
+                    span.attributes["coal.batch.cache_hits"],
+                )
+                for span in batch_spans
+            ],
+            [
+                ("CACHE", "Lookup", 2, 1, 0),
+                ("SYNC_LOOKUP", "Load", 1, 0, 0),
+            ],
+        )
+        for span in batch_spans:
+            self.assertTrue(span.attributes["coal.batch.duration_ms"] >= 0)
+            self.assertTrue(span.duration >= 0)
+
+        tracer.clear()
+        self.assertEqual(tracer.spans(), [])